@@ -0,0 +1,281 @@
+"""
+Бенчмарки серверной части.
+
+Запуск из папки Server:
+    python benchmark.py ingest --sizes 1000 10000 100000
+    python benchmark.py reports --campaigns 1000 --accounts 100
+    python benchmark.py stream --sizes 10000 100000
+    python benchmark.py cache --campaigns 1000 --accounts 100
+    python benchmark.py stats --accounts 50000
+
+Совпадение векторного и построчного расчета статистики проверяет test_stats.py.
+"""
+import argparse
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import server
+
+STATUSES = ['Working', 'Working', 'Working', 'Frozen', 'Temporary Spamblock', 'Permanent Spamblock']
+
+# ===============================================================
+#  ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ
+# ===============================================================
+
+def fresh_database(tmp_dir, name='bench.db'):
+    """Переключает сервер на новую пустую БД во временной папке."""
+    server.DATABASE_FILE = os.path.join(tmp_dir, name)
+    server.init_db()
+
+def create_campaign(conn, name, campaign_date=None, cost_per_message=1.5, cost_per_invite=3.0):
+    cursor = conn.cursor()
+    cursor.execute(
+        "INSERT INTO campaigns (name, client_code, campaign_date, cost_per_message, cost_per_invite) VALUES (?, ?, ?, ?, ?)",
+        (name, server.client_code_from_name(name), campaign_date or time.strftime("%Y-%m-%d"), cost_per_message, cost_per_invite)
+    )
+    conn.commit()
+    return cursor.lastrowid
+
+def make_accounts(count, rnd, offset=0):
+    return [{
+        'phone': f"7{offset + i:010d}",
+        'registration_date': '2024-01-01',
+        'status': 'Working',
+        'messages_sent': rnd.randint(0, 500),
+        'invites_sent': rnd.randint(0, 50),
+    } for i in range(count)]
+
+def advance_accounts(accounts, rnd):
+    """Имитирует результат рассылки: счетчики растут, часть аккаунтов получает ограничения."""
+    return [dict(acc,
+                 status=rnd.choice(STATUSES),
+                 messages_sent=acc['messages_sent'] + rnd.randint(0, 40),
+                 invites_sent=acc['invites_sent'] + rnd.randint(0, 5)) for acc in accounts]
+
+# ===============================================================
+#  СЦЕНАРИИ
+# ===============================================================
+
+def bench_ingest(sizes):
+    """Скорость записи снимков 'ДО' и 'ПОСЛЕ' через bulk_ingest_snapshot."""
+    rnd = random.Random(42)
+    print(f"{'аккаунтов':>10} | {'снимок':<16} | {'время, с':>9} | {'строк/с':>10}")
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fresh_database(tmp_dir)
+            conn = server.get_db_connection()
+            campaign_id = create_campaign(conn, f"BENCH_{size}")
+            costs = conn.execute("SELECT cost_per_message, cost_per_invite FROM campaigns WHERE id = ?", (campaign_id,)).fetchone()
+
+            before = make_accounts(size, rnd)
+            after = advance_accounts(before, rnd)
+            for snapshot_type, accounts in (('before', before), ('after_immediate', after)):
+                started = time.perf_counter()
+                server.bulk_ingest_snapshot(conn, campaign_id, snapshot_type, accounts, costs)
+                conn.commit()
+                elapsed = time.perf_counter() - started
+                print(f"{size:>10} | {snapshot_type:<16} | {elapsed:>9.3f} | {size / elapsed:>10.0f}")
+            conn.close()
+            server.close_db_pools()
+
+def legacy_period_summary(conn, start_date, end_date):
+    """Прежний расчет отчета за период: цикл по кампаниям с calculate_campaign_stats."""
+    campaigns = conn.execute("SELECT * FROM campaigns WHERE campaign_date BETWEEN ? AND ? ORDER BY campaign_date DESC",
+                             (start_date.isoformat(), end_date.isoformat())).fetchall()
+    unique_accounts = set()
+    total_revenue = total_messages = total_invites = 0
+    total_restricted_accounts = total_messages_restricted = total_revenue_restricted = 0
+    for campaign in campaigns:
+        summary, results = server.calculate_campaign_stats(campaign['id'], conn)
+        total_revenue += summary['total_revenue']
+        total_messages += summary['total_messages']
+        total_invites += summary['total_invites']
+        unique_accounts.update(res['phone'] for res in results)
+        restricted = [res for res in results if res['status_after'] not in ('Working', 'Temporary Spamblock (Resolved)')]
+        total_restricted_accounts += len(restricted)
+        total_messages_restricted += sum(res['msg_sent'] for res in restricted)
+        total_revenue_restricted += sum(res['revenue'] for res in restricted)
+        server.calculate_campaign_stats(campaign['id'], conn)  # второй вызов для списка кампаний, как в старом маршруте
+    unique = len(unique_accounts)
+    return {
+        'total_campaigns': len(campaigns),
+        'total_unique_accounts': unique,
+        'total_revenue': total_revenue,
+        'total_messages': total_messages,
+        'total_invites': total_invites,
+        'avg_revenue_per_account': total_revenue / unique if unique else 0,
+        'avg_messages_all_accounts': total_messages / unique if unique else 0,
+        'total_restricted_accounts': total_restricted_accounts,
+        'percentage_restricted': total_restricted_accounts / unique * 100 if unique else 0,
+        'avg_revenue_per_restricted_account': total_revenue_restricted / total_restricted_accounts if total_restricted_accounts else 0,
+        'avg_messages_restricted_accounts': total_messages_restricted / total_restricted_accounts if total_restricted_accounts else 0
+    }
+
+def populate_campaigns(conn, campaigns, accounts_per_campaign, days, rnd):
+    """Заполняет БД кампаниями с клиентами AA/BB/CC, снимками 'ДО' и 'ПОСЛЕ'."""
+    today = datetime.now().date()
+    pool = make_accounts(accounts_per_campaign * 20, rnd)
+    for i in range(campaigns):
+        campaign_date = (today - timedelta(days=i % days)).isoformat()
+        campaign_id = create_campaign(conn, f"{('AA', 'BB', 'CC')[i % 3]}_{i}", campaign_date,
+                                      cost_per_message=rnd.choice([0.5, 1.0, 1.5]), cost_per_invite=rnd.choice([0.0, 2.0]))
+        costs = conn.execute("SELECT cost_per_message, cost_per_invite FROM campaigns WHERE id = ?", (campaign_id,)).fetchone()
+        before = rnd.sample(pool, accounts_per_campaign)
+        server.bulk_ingest_snapshot(conn, campaign_id, 'before', before, costs)
+        server.bulk_ingest_snapshot(conn, campaign_id, 'after_immediate', advance_accounts(before, rnd), costs)
+    conn.commit()
+
+def bench_reports(campaigns, accounts_per_campaign, repeats):
+    """Сравнивает прежний расчет отчета за период с агрегацией в SQL."""
+    rnd = random.Random(7)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fresh_database(tmp_dir)
+        conn = server.get_db_connection()
+        print(f"Заполнение БД: {campaigns} кампаний по {accounts_per_campaign} аккаунтов...")
+        populate_campaigns(conn, campaigns, accounts_per_campaign, 60, rnd)
+
+        end_date = datetime.now().date()
+        start_date = end_date - timedelta(days=59)
+        for title, build in (
+            ("цикл с calculate_campaign_stats", lambda: legacy_period_summary(conn, start_date, end_date)),
+            ("aggregate_period_report", lambda: server.aggregate_period_report(conn, start_date, end_date)[0]),
+        ):
+            started = time.perf_counter()
+            for _ in range(repeats):
+                summary = build()
+            elapsed = (time.perf_counter() - started) / repeats
+            print(f"{title:<34} | {elapsed * 1000:>9.1f} мс | выручка {summary['total_revenue']:.2f}, "
+                  f"уникальных {summary['total_unique_accounts']}, ограниченных {summary['total_restricted_accounts']}")
+        conn.close()
+        server.close_db_pools()
+
+def bench_stream(sizes):
+    """Пиковая память массового обновления: разбор всего тела json.loads против потокового разбора."""
+    rnd = random.Random(3)
+    print(f"{'аккаунтов':>10} | {'способ':<16} | {'время, с':>9} | {'пик памяти, МБ':>15}")
+    for size in sizes:
+        body = json.dumps(make_accounts(size, rnd)).encode('utf-8')
+        for title, ingest in (
+            ("json.loads", lambda conn: server.bulk_upsert_accounts(conn, json.loads(body))),
+            ("потоковый", lambda conn: server.ingest_update_all_stream(conn, io.BytesIO(body))),
+        ):
+            # Время и память меряются отдельными прогонами: tracemalloc сильно замедляет разбор
+            for traced in (False, True):
+                with tempfile.TemporaryDirectory() as tmp_dir:
+                    fresh_database(tmp_dir)
+                    conn = server.get_db_connection()
+                    if traced:
+                        tracemalloc.start()
+                    started = time.perf_counter()
+                    ingest(conn)
+                    conn.commit()
+                    if traced:
+                        peak = tracemalloc.get_traced_memory()[1]
+                        tracemalloc.stop()
+                    else:
+                        elapsed = time.perf_counter() - started
+                    conn.close()
+                    server.close_db_pools()
+            print(f"{size:>10} | {title:<16} | {elapsed:>9.3f} | {peak / 2 ** 20:>15.1f}")
+
+def bench_report_cache(campaigns, accounts_per_campaign, repeats):
+    """Время страниц отчетов: первый просмотр (расчет) против повторного (из кэша отчетов)."""
+    rnd = random.Random(11)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fresh_database(tmp_dir)
+        conn = server.get_db_connection()
+        print(f"Заполнение БД: {campaigns} кампаний по {accounts_per_campaign} аккаунтов...")
+        populate_campaigns(conn, campaigns, accounts_per_campaign, 60, rnd)
+        conn.close()
+
+        client = server.app.test_client()
+        print(f"{'страница':<52} | {'расчет, мс':>10} | {'из кэша, мс':>11}")
+        for url in ('/report/period?period=month', '/report/client?client_code=AA&period=month',
+                    '/report/campaign?client_code=BB&campaign_name=BB_1'):
+            server.data_changed()
+            started = time.perf_counter()
+            client.get(url)
+            cold = time.perf_counter() - started
+            started = time.perf_counter()
+            for _ in range(repeats):
+                client.get(url)
+            warm = (time.perf_counter() - started) / repeats
+            print(f"{url:<52} | {cold * 1000:>10.1f} | {warm * 1000:>11.2f}")
+        server.close_db_pools()
+
+def campaign_stats_with(engine, campaign_id, conn):
+    """Статистика кампании заданным расчетом; настройка сервера STATS_ENGINE восстанавливается."""
+    previous = server.STATS_ENGINE
+    server.STATS_ENGINE = engine
+    try:
+        return server.calculate_campaign_stats(campaign_id, conn)
+    finally:
+        server.STATS_ENGINE = previous
+
+def bench_stats(accounts):
+    """Время векторного расчета статистики кампании против построчного."""
+    if server.np is None:
+        sys.exit("numpy не установлен: векторный расчет недоступен")
+    rnd = random.Random(5)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fresh_database(tmp_dir)
+        conn = server.get_db_connection()
+        campaign_id = create_campaign(conn, "BENCH_STATS")
+        costs = conn.execute("SELECT cost_per_message, cost_per_invite FROM campaigns WHERE id = ?", (campaign_id,)).fetchone()
+        before = make_accounts(accounts, rnd)
+        server.bulk_ingest_snapshot(conn, campaign_id, 'before', before, costs)
+        server.bulk_ingest_snapshot(conn, campaign_id, 'after_immediate', advance_accounts(before, rnd), costs)
+        server.bulk_ingest_snapshot(conn, campaign_id, 'after_day_2', advance_accounts(before, rnd), costs)
+        conn.commit()
+        print(f"{'расчет':<10} | {'время, мс':>10}  (кампания: {accounts} аккаунтов, 3 снимка)")
+        for engine in ('python', 'numpy'):
+            started = time.perf_counter()
+            campaign_stats_with(engine, campaign_id, conn)
+            print(f"{engine:<10} | {(time.perf_counter() - started) * 1000:>10.1f}")
+        conn.close()
+        server.close_db_pools()
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки сервера мониторинга")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    ingest = subparsers.add_parser('ingest', help="скорость записи снимков")
+    ingest.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+
+    reports = subparsers.add_parser('reports', help="отчет за период: старый расчет против SQL-агрегации")
+    reports.add_argument('--campaigns', type=int, default=1000)
+    reports.add_argument('--accounts', type=int, default=100, help="аккаунтов в кампании")
+    reports.add_argument('--repeats', type=int, default=3)
+
+    stream = subparsers.add_parser('stream', help="память массового обновления: json.loads против потокового разбора")
+    stream.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+
+    cache = subparsers.add_parser('cache', help="страницы отчетов: расчет против кэша отчетов")
+    cache.add_argument('--campaigns', type=int, default=1000)
+    cache.add_argument('--accounts', type=int, default=100, help="аккаунтов в кампании")
+    cache.add_argument('--repeats', type=int, default=20)
+
+    stats = subparsers.add_parser('stats', help="статистика кампании: векторный расчет против построчного")
+    stats.add_argument('--accounts', type=int, default=50000)
+
+    args = parser.parse_args()
+    if args.command == 'ingest':
+        bench_ingest(args.sizes)
+    elif args.command == 'reports':
+        bench_reports(args.campaigns, args.accounts, args.repeats)
+    elif args.command == 'stream':
+        bench_stream(args.sizes)
+    elif args.command == 'cache':
+        bench_report_cache(args.campaigns, args.accounts, args.repeats)
+    elif args.command == 'stats':
+        bench_stats(args.accounts)
+
+if __name__ == '__main__':
+    main()
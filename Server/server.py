@@ -1,24 +1,388 @@
-from flask import Flask, request, jsonify, render_template, redirect, url_for
+from flask import Flask, request, jsonify, render_template, redirect, url_for, Response, stream_with_context, g, has_request_context
 import sqlite3
 import os
+import re
+import codecs
+import csv
+import functools
+import gzip
+import io
+import json
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta
+from itertools import groupby
+
+try:
+    import numpy as np  # необязателен: векторный расчет статистики кампаний
+except ImportError:
+    np = None
+
+try:
+    import pyarrow as pa  # необязателен: выгрузка отчетов в Parquet
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
 
 # --- Настройки ---
 DATABASE_FILE = 'database.db'
 API_KEY = "qwertyuiop"
 
+# --- Настройки SQLite ---
+DB_POOL_SIZE = 8                  # простаивающих соединений в каждом пуле
+DB_CACHE_SIZE_KB = 65536          # кэш страниц на соединение
+DB_MMAP_SIZE = 256 * 1024 * 1024  # отображение файла БД в память
+DB_BUSY_TIMEOUT_MS = 10000        # ожидание блокировки записи
+
+# --- Загрузка снимков частями ---
+UPLOAD_TTL_HOURS = 24             # незавершенные загрузки старше удаляются
+
+# --- Потоковый разбор тела запроса ---
+STREAM_READ_SIZE = 64 * 1024      # байт, читаемых из тела запроса за раз
+STREAM_BATCH_SIZE = 2000          # аккаунтов, записываемых одной пачкой при потоковом разборе
+
+# --- Фоновая запись (очередь заданий) ---
+INGEST_BATCH_SIZE = 5000          # аккаунтов в одной транзакции фоновой записи
+INGEST_POLL_SECONDS = 5           # как часто фоновый поток проверяет очередь без уведомлений
+
+# --- Расчет статистики ---
+STATS_ENGINE = 'numpy'            # 'numpy' - векторный расчет (если numpy установлен), 'python' - цикл по номерам
+
+# --- Кэш отчетов ---
+REPORT_CACHE_SIZE = 128           # готовых страниц отчетов в памяти (0 - кэш выключен)
+REPORT_CACHE_TTL_SECONDS = 300    # страница старше пересчитывается, даже если данные не менялись
+REPORT_PAGE_MAX_LENGTH = 500      # строк таблицы аккаунтов в одном ответе /report/campaign/<id>/accounts
+
+# --- Выгрузка отчетов ---
+EXPORT_FETCH_SIZE = 5000          # строк, читаемых из БД и отдаваемых клиенту за раз (CSV)
+EXPORT_PARQUET_ROW_GROUP = 20000  # строк в группе Parquet (столько строк одновременно в памяти)
+EXPORT_CACHE_SIZE_KB = 2048       # кэш страниц соединения на время выгрузки
+
+# --- Отчет по прогреву ---
+WARMUP_BRACKETS = (7, 14, 30, 60) # верхние границы групп по дням отдыха (включительно), последняя группа - больше
+
+# --- История счетчиков аккаунтов ---
+HISTORY_MAX_POINTS = 10000        # точек в одном ответе /api/accounts/<phone>/history
+
+# --- Сжатие и архив campaign_log ---
+LOG_COMPACT_AFTER_DAYS = 30       # кампании с датой старше считаются закрытыми, их лог сжимается
+ARCHIVE_DATABASE_FILE = 'archive.db'  # куда переносятся лишние строки лога ('' - удаляются без архива)
+COMPACT_BATCH_CAMPAIGNS = 20      # кампаний, сжимаемых одной транзакцией
+VACUUM_PAGES_PER_RUN = 0          # страниц, возвращаемых ОС после сжатия (0 - все свободные)
+
+# --- Метрики и профилирование ---
+METRICS_ENABLED = True            # замер маршрутов и SQL-запросов, отдача на /metrics
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # границы гистограммы времени маршрутов, сек
+SLOW_QUERY_MS = 200               # запросы дольше попадают в журнал медленных запросов с планом
+SLOW_QUERY_LOG_SIZE = 50          # последних медленных запросов, отдаваемых /api/metrics/slow_queries
+SQL_LABEL_MAX_LENGTH = 200        # символов текста запроса в метке метрики
+SQL_LABEL_MAX_COUNT = 500         # разных запросов в метриках, остальные учитываются как 'other'
+SERVER_TIMING_HEADER = False      # добавлять к ответам заголовок Server-Timing (время приложения и БД)
+
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'a_very_secret_key_for_sessions_and_forms'
 
 # ===============================================================
-#  ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ (БД и РАСЧЕТЫ)
+#  ПУЛ СОЕДИНЕНИЙ С БД
 # ===============================================================
+# Соединения переиспользуются между запросами: close() возвращает соединение в пул.
+# Пишущие и читающие (только для отчетов) соединения живут в разных пулах, в режиме
+# WAL чтение отчетов не блокируется записью больших снимков.
 
-def get_db_connection():
-    """Устанавливает соединение с БД."""
-    conn = sqlite3.connect(DATABASE_FILE)
-    conn.row_factory = sqlite3.Row
-    return conn
+class PooledConnection(sqlite3.Connection):
+    """Соединение из пула: close() возвращает его в пул вместо закрытия."""
+    pool = None
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.release(self)
+        else:
+            super().close()
+
+    def close_for_real(self):
+        self.pool = None
+        super().close()
+
+    # Connection.execute не вызывает cursor(), поэтому замер подключается и здесь
+    def cursor(self, factory=None):
+        if factory is None:
+            factory = TimedCursor if METRICS_ENABLED else sqlite3.Cursor
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+class ConnectionPool:
+    """Пул соединений к одному файлу БД (пишущих или только для чтения)."""
+
+    def __init__(self, database, readonly=False, size=DB_POOL_SIZE):
+        self.database = database
+        self.readonly = readonly
+        self.size = size
+        self._idle = queue.LifoQueue()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.database, factory=PooledConnection, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        if not self.readonly:
+            # Действует только для новой БД (до первой таблицы и до перехода в WAL); существующую
+            # переводит в этот режим vacuum_database()
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+        conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        if self.readonly:
+            conn.execute("PRAGMA query_only=ON")
+        conn.pool = self
+        return conn
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._connect()
+
+    def release(self, conn):
+        # Незавершенная транзакция не должна достаться следующему запросу
+        if conn.in_transaction:
+            conn.rollback()
+        if self._idle.qsize() < self.size:
+            self._idle.put(conn)
+        else:
+            conn.close_for_real()
+
+    def close_all(self):
+        while True:
+            try:
+                self._idle.get_nowait().close_for_real()
+            except queue.Empty:
+                break
+
+_db_pools = {}
+_db_pools_lock = threading.Lock()
+
+def _get_pool(readonly):
+    key = (DATABASE_FILE, readonly)
+    with _db_pools_lock:
+        pool = _db_pools.get(key)
+        if pool is None:
+            pool = _db_pools[key] = ConnectionPool(DATABASE_FILE, readonly=readonly)
+        return pool
+
+def close_db_pools():
+    """Закрывает все простаивающие соединения (например, перед заменой файла БД)."""
+    with _db_pools_lock:
+        for pool in _db_pools.values():
+            pool.close_all()
+        _db_pools.clear()
+
+def get_db_connection(readonly=False):
+    """Берет соединение с БД из пула. readonly=True - отдельное соединение только для чтения отчетов."""
+    return _get_pool(readonly).acquire()
+
+# ===============================================================
+#  МЕТРИКИ И ПРОФИЛИРОВАНИЕ
+# ===============================================================
+# Метрики копятся в памяти процесса и отдаются в формате Prometheus на /metrics: время
+# маршрутов (гистограмма), время и число выполнений каждого SQL-запроса, время основных
+# функций расчета и число записанных аккаунтов. Курсоры пула замеряют каждый execute и
+# fetch; запрос дольше SLOW_QUERY_MS попадает в журнал медленных запросов вместе с планом.
+
+METRIC_DESCRIPTIONS = {
+    'http_request_duration_seconds': ('histogram', "Время обработки запроса до отправки заголовков ответа"),
+    'sql_statement_duration_seconds': ('summary', "Время SQL-запросов (выполнение и чтение строк)"),
+    'sql_slow_statements_total': ('counter', "Запросов дольше SLOW_QUERY_MS"),
+    'function_duration_seconds': ('summary', "Время функций записи и расчета статистики"),
+    'ingest_rows_total': ('counter', "Записанных аккаунтов (снимки и массовое обновление)"),
+}
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class MetricsRegistry:
+    """Счетчики, гистограммы и суммы (sum/count) с метками; потокобезопасно."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._values = {}  # (имя, метки) -> число или [счетчики корзин..., сумма, количество]
+
+    def inc(self, name, labels=(), value=1):
+        with self._lock:
+            self._values[name, labels] = self._values.get((name, labels), 0) + value
+
+    def observe(self, name, labels, seconds):
+        """Наблюдение гистограммы."""
+        with self._lock:
+            series = self._values.get((name, labels))
+            if series is None:
+                series = self._values[name, labels] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    series[i] += 1
+            series[-2] += seconds
+            series[-1] += 1
+
+    def observe_summary(self, name, labels, seconds, count=1):
+        """Наблюдение суммы: count=0 добавляет время к уже посчитанному вызову."""
+        with self._lock:
+            series = self._values.get((name, labels))
+            if series is None:
+                series = self._values[name, labels] = [0.0, 0]
+            series[0] += seconds
+            series[1] += count
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self):
+        """Текстовый формат Prometheus."""
+        with self._lock:
+            items = sorted(self._values.items(), key=lambda item: item[0])
+            items = [(key, list(value) if isinstance(value, list) else value) for key, value in items]
+        lines = []
+        for name, group in groupby(items, key=lambda item: item[0][0]):
+            kind, description = METRIC_DESCRIPTIONS.get(name, ('untyped', name))
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (_, labels), value in group:
+                label_text = ','.join(f'{key}="{_escape_label(val)}"' for key, val in labels)
+                suffix = f"{{{label_text}}}" if label_text else ''
+                if kind == 'histogram':
+                    for bound, bucket_count in zip(self.buckets + ('+Inf',), value[:-2] + [value[-1]]):
+                        bucket_labels = ','.join(filter(None, (label_text, f'le="{bound}"')))
+                        lines.append(f"{name}_bucket{{{bucket_labels}}} {bucket_count}")
+                if kind in ('histogram', 'summary'):
+                    lines.append(f"{name}_sum{suffix} {value[-2]}")
+                    lines.append(f"{name}_count{suffix} {value[-1]}")
+                else:
+                    lines.append(f"{name}{suffix} {value}")
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry(LATENCY_BUCKETS)
+slow_queries = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+_sql_labels = set()
+
+@functools.lru_cache(maxsize=2048)
+def _sql_label(sql):
+    """Метка запроса: текст без лишних пробелов, не длиннее SQL_LABEL_MAX_LENGTH."""
+    label = ' '.join(sql.split())[:SQL_LABEL_MAX_LENGTH]
+    # Число разных меток ограничено, чтобы запросы с переменным текстом не раздували /metrics
+    if label not in _sql_labels:
+        if len(_sql_labels) >= SQL_LABEL_MAX_COUNT:
+            return 'other'
+        _sql_labels.add(label)
+    return label
+
+def _log_slow_query(connection, sql, parameters, elapsed):
+    """Сохраняет медленный запрос с планом (EXPLAIN QUERY PLAN на том же соединении)."""
+    metrics.inc('sql_slow_statements_total')
+    try:
+        plan = [row[3] for row in connection.cursor(sqlite3.Cursor).execute(
+            "EXPLAIN QUERY PLAN " + sql, parameters if parameters is not None else ())]
+    except (sqlite3.Error, ValueError) as exc:
+        plan = [f"план недоступен: {exc}"]
+    slow_queries.append({
+        'time': datetime.now().isoformat(),
+        'duration_ms': round(elapsed * 1000, 1),
+        'statement': ' '.join(sql.split()),
+        'route': request.path if has_request_context() else threading.current_thread().name,
+        'plan': plan,
+    })
+    app.logger.warning("Медленный запрос %.0f мс: %s", elapsed * 1000, _sql_label(sql))
+
+class TimedCursor(sqlite3.Cursor):
+    """
+    Курсор, замеряющий execute и fetch*; время относится к последнему выполненному запросу.
+    Перебор курсора в for не замеряется (строки выгрузок читаются без лишнего вызова на строку).
+    """
+    _sql = None
+    _parameters = None
+    _elapsed = 0.0
+    _slow_logged = False
+
+    def _record(self, elapsed, executed=False):
+        if self._sql is None:
+            return
+        self._elapsed += elapsed
+        metrics.observe_summary('sql_statement_duration_seconds', (('statement', _sql_label(self._sql)),),
+                                elapsed, 1 if executed else 0)
+        if has_request_context():
+            g.db_seconds = g.get('db_seconds', 0.0) + elapsed
+            g.db_statements = g.get('db_statements', 0) + executed
+        if not self._slow_logged and self._elapsed * 1000 >= SLOW_QUERY_MS:
+            self._slow_logged = True
+            _log_slow_query(self.connection, self._sql, self._parameters, self._elapsed)
+
+    def _start(self, sql, parameters):
+        self._sql, self._parameters, self._elapsed, self._slow_logged = sql, parameters, 0.0, False
+
+    def execute(self, sql, parameters=()):
+        self._start(sql, parameters)
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._record(time.perf_counter() - started, executed=True)
+
+    def executemany(self, sql, seq_of_parameters):
+        # Параметры пачки не сохраняются: план медленного запроса строится без них
+        self._start(sql, None)
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._record(time.perf_counter() - started, executed=True)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            self._record(time.perf_counter() - started)
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        try:
+            return super().fetchmany(self.arraysize if size is None else size)
+        finally:
+            self._record(time.perf_counter() - started)
+
+    def fetchall(self):
+        started = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            self._record(time.perf_counter() - started)
+
+def timed(func):
+    """Декоратор: время вызовов функции в function_duration_seconds."""
+    labels = (('function', func.__name__),)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not METRICS_ENABLED:
+            return func(*args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            metrics.observe_summary('function_duration_seconds', labels, time.perf_counter() - started)
+    return wrapper
+
+# ===============================================================
+#  ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ (БД и РАСЧЕТЫ)
+# ===============================================================
 
 def init_db():
     """Инициализирует базу данных и создает таблицы, если они не существуют."""
@@ -51,23 +415,338 @@ def init_db():
         status TEXT NOT NULL, timestamp TEXT NOT NULL,
         FOREIGN KEY (campaign_id) REFERENCES campaigns (id),
         FOREIGN KEY (account_phone) REFERENCES accounts (phone) ) ''')
+
+    # --- МАТЕРИАЛИЗОВАННАЯ СТАТИСТИКА КАМПАНИЙ ---
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS campaign_account_stats (
+        campaign_id INTEGER NOT NULL, account_phone TEXT NOT NULL,
+        after_snapshot_type TEXT NOT NULL, status_before TEXT NOT NULL, final_status TEXT NOT NULL, report_status TEXT NOT NULL,
+        msg_sent INTEGER NOT NULL, inv_sent INTEGER NOT NULL, revenue REAL NOT NULL, temp_spam_resolved INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (campaign_id, account_phone),
+        FOREIGN KEY (campaign_id) REFERENCES campaigns (id) ) ''')
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS campaign_stats_summary (
+        campaign_id INTEGER PRIMARY KEY, accounts_in_report INTEGER NOT NULL DEFAULT 0,
+        total_revenue REAL NOT NULL DEFAULT 0.0, total_messages INTEGER NOT NULL DEFAULT 0, total_invites INTEGER NOT NULL DEFAULT 0,
+        accounts_restricted INTEGER NOT NULL DEFAULT 0,
+        frozen_count INTEGER NOT NULL DEFAULT 0, frozen_messages INTEGER NOT NULL DEFAULT 0,
+        temp_spam_count INTEGER NOT NULL DEFAULT 0, temp_spam_messages INTEGER NOT NULL DEFAULT 0,
+        perm_spam_count INTEGER NOT NULL DEFAULT 0, perm_spam_messages INTEGER NOT NULL DEFAULT 0,
+        temp_spam_resolved_count INTEGER NOT NULL DEFAULT 0, temp_spam_resolved_messages INTEGER NOT NULL DEFAULT 0,
+        updated_at TEXT NOT NULL,
+        FOREIGN KEY (campaign_id) REFERENCES campaigns (id) ) ''')
+
+    conn.commit()
+    run_migrations(conn)
+
+    # Для старых БД: считаем статистику кампаний, у которых еще нет сводной строки
+    cursor.execute('''
+        SELECT DISTINCT campaign_id FROM campaign_log
+        WHERE campaign_id NOT IN (SELECT campaign_id FROM campaign_stats_summary)
+    ''')
+    for row in cursor.fetchall():
+        refresh_campaign_stats(conn, row['campaign_id'])
     conn.commit()
     conn.close()
 
-def calculate_campaign_stats(campaign_id, conn):
-    """Рассчитывает всю статистику с учетом новой логики фильтрации."""
+# ===============================================================
+#  МИГРАЦИИ СХЕМЫ БД
+# ===============================================================
+# Каждая миграция выполняется один раз в своей транзакции, номер записывается в
+# schema_version. Новые изменения схемы добавляются в конец списка MIGRATIONS.
+
+def client_code_from_name(name):
+    """Код клиента - часть названия кампании до первого '_'."""
+    return name.split('_')[0]
+
+def _migration_indexes(cursor):
+    # Покрывающий индекс для пересчета статистики кампании по номерам из снимка
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_campaign_log_campaign_phone
+        ON campaign_log (campaign_id, account_phone, snapshot_type, messages_count, invites_count, status)''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_campaign_log_phone ON campaign_log (account_phone, snapshot_type)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_campaigns_date ON campaigns (campaign_date)")
+
+def _migration_client_code(cursor):
+    cursor.execute("ALTER TABLE campaigns ADD COLUMN client_code TEXT COLLATE NOCASE")
+    cursor.execute('''
+        UPDATE campaigns SET client_code =
+            CASE WHEN instr(name, '_') > 0 THEN substr(name, 1, instr(name, '_') - 1) ELSE name END''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_campaigns_client_date ON campaigns (client_code, campaign_date)")
+
+def _migration_snapshot_uploads(cursor):
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS snapshot_uploads (
+        upload_id TEXT PRIMARY KEY, campaign_name TEXT NOT NULL, snapshot_type TEXT NOT NULL,
+        total_chunks INTEGER NOT NULL, status TEXT NOT NULL DEFAULT 'open', processed_count INTEGER,
+        created_at TEXT NOT NULL, completed_at TEXT ) ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS snapshot_upload_chunks (
+        upload_id TEXT NOT NULL, chunk_index INTEGER NOT NULL, accounts TEXT NOT NULL,
+        PRIMARY KEY (upload_id, chunk_index) ) WITHOUT ROWID ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_snapshot_uploads_created ON snapshot_uploads (created_at)")
+
+def _migration_idempotency_key(cursor):
+    cursor.execute("ALTER TABLE campaign_log ADD COLUMN idempotency_key TEXT")
+    # Строки без ключа (старые клиенты, повторы номера в одном снимке) не ограничиваются
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_campaign_log_idempotency
+        ON campaign_log (campaign_id, account_phone, snapshot_type, idempotency_key)
+        WHERE idempotency_key IS NOT NULL''')
+
+def _migration_ingest_jobs(cursor):
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS ingest_jobs (
+        seq INTEGER PRIMARY KEY, job_id TEXT NOT NULL UNIQUE, kind TEXT NOT NULL, payload TEXT NOT NULL,
+        idempotency_key TEXT, status TEXT NOT NULL DEFAULT 'queued', total_items INTEGER NOT NULL,
+        processed_items INTEGER NOT NULL DEFAULT 0, result TEXT, error TEXT,
+        created_at TEXT NOT NULL, started_at TEXT, finished_at TEXT ) ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_ingest_jobs_status ON ingest_jobs (status, seq)")
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_ingest_jobs_idempotency ON ingest_jobs (kind, idempotency_key)
+        WHERE idempotency_key IS NOT NULL''')
+
+def _migration_campaign_results_indexes(cursor):
+    # Постраничная таблица аккаунтов отчета: фильтр по статусу и сортировка по доходу. Остальные
+    # колонки сортируются без индекса (SQLite держит в памяти только start + length строк),
+    # чтобы не замедлять запись снимков
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_campaign_account_stats_status
+        ON campaign_account_stats (campaign_id, report_status, account_phone)''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_campaign_account_stats_revenue
+        ON campaign_account_stats (campaign_id, revenue, account_phone)''')
+
+def _migration_accounts_rest_days(cursor):
+    # Дни отдыха аккаунта до первой кампании для отчета по прогреву. Дальше колонку
+    # поддерживают запросы, меняющие registration_date и first_campaign_date
+    cursor.execute("ALTER TABLE accounts ADD COLUMN rest_days REAL")
+    cursor.execute('''
+        UPDATE accounts SET rest_days = JULIANDAY(first_campaign_date) - JULIANDAY(registration_date)
+        WHERE first_campaign_date IS NOT NULL''')
+
+def _migration_account_history(cursor):
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS account_keys (
+        id INTEGER PRIMARY KEY, phone TEXT NOT NULL UNIQUE ) ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS status_dict (
+        id INTEGER PRIMARY KEY, status TEXT NOT NULL UNIQUE ) ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS account_history (
+        account_id INTEGER NOT NULL, ts INTEGER NOT NULL, messages INTEGER, invites INTEGER, status_id INTEGER,
+        PRIMARY KEY (account_id, ts) ) WITHOUT ROWID ''')
+
+    # Начальная история - наблюдения из campaign_log и текущие значения accounts
+    # (ISO-время сервера переводится в секунды Unix)
+    cursor.execute('''
+        CREATE TEMP TABLE history_backfill AS
+        SELECT account_phone AS phone, CAST(strftime('%s', timestamp, 'utc') AS INTEGER) AS ts, log_id AS ord,
+               messages_count AS messages, invites_count AS invites, status
+        FROM campaign_log
+        UNION ALL
+        SELECT phone, CAST(strftime('%s', last_updated, 'utc') AS INTEGER), 9223372036854775807,
+               total_messages, total_invites, current_status
+        FROM accounts''')
+    cursor.execute("INSERT OR IGNORE INTO account_keys (phone) SELECT DISTINCT phone FROM history_backfill ORDER BY phone")
+    cursor.execute("INSERT OR IGNORE INTO status_dict (status) SELECT DISTINCT status FROM history_backfill WHERE status IS NOT NULL")
+    cursor.execute('''
+        INSERT INTO account_history (account_id, ts, messages, invites, status_id)
+        SELECT k.id, o.ts, o.messages, o.invites, d.id
+        FROM (
+            SELECT phone, ts, ord, messages, invites, status,
+                   LAG(messages) OVER w AS prev_messages, LAG(invites) OVER w AS prev_invites,
+                   LAG(status) OVER w AS prev_status, ROW_NUMBER() OVER w AS n
+            FROM history_backfill WHERE ts IS NOT NULL
+            WINDOW w AS (PARTITION BY phone ORDER BY ts, ord)
+        ) o
+        JOIN account_keys k ON k.phone = o.phone
+        LEFT JOIN status_dict d ON d.status = o.status
+        WHERE o.n = 1 OR o.messages IS NOT o.prev_messages OR o.invites IS NOT o.prev_invites
+              OR o.status IS NOT o.prev_status
+        ORDER BY k.id, o.ts, o.ord
+        ON CONFLICT (account_id, ts) DO UPDATE SET
+            messages = excluded.messages, invites = excluded.invites, status_id = excluded.status_id''')
+    cursor.execute("DROP TABLE history_backfill")
+
+def _migration_daily_rollups(cursor):
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS daily_client_stats (
+        day TEXT NOT NULL, client_code TEXT NOT NULL COLLATE NOCASE, offer TEXT NOT NULL,
+        campaigns INTEGER NOT NULL, account_rows INTEGER NOT NULL,
+        revenue REAL NOT NULL, messages INTEGER NOT NULL, invites INTEGER NOT NULL,
+        restricted INTEGER NOT NULL, restricted_messages INTEGER NOT NULL, restricted_revenue REAL NOT NULL,
+        PRIMARY KEY (day, client_code, offer) ) WITHOUT ROWID ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS daily_client_accounts (
+        day TEXT NOT NULL, client_code TEXT NOT NULL COLLATE NOCASE, account_id INTEGER NOT NULL,
+        restricted INTEGER NOT NULL,
+        PRIMARY KEY (day, client_code, account_id) ) WITHOUT ROWID ''')
+    # Отчет по клиенту без периода и с периодом: выборка по клиенту, затем по дням
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_daily_client_accounts_client
+        ON daily_client_accounts (client_code, day, restricted)''')
+    for row in cursor.execute("SELECT DISTINCT campaign_date, client_code FROM campaigns").fetchall():
+        refresh_rollup_group(cursor, row[0], row[1])
+
+def _migration_log_compaction(cursor):
+    cursor.execute("ALTER TABLE campaigns ADD COLUMN log_compacted_at TEXT")
+
+def _migration_history_milliseconds(cursor):
+    # Секунды не различали две записи одного аккаунта за секунду: вторая затирала первую
+    cursor.execute('''
+    CREATE TABLE account_history_ms (
+        account_id INTEGER NOT NULL, ts INTEGER NOT NULL, messages INTEGER, invites INTEGER, status_id INTEGER,
+        PRIMARY KEY (account_id, ts) ) WITHOUT ROWID ''')
+    cursor.execute('''
+        INSERT INTO account_history_ms (account_id, ts, messages, invites, status_id)
+        SELECT account_id, ts * 1000, messages, invites, status_id FROM account_history ORDER BY account_id, ts''')
+    cursor.execute("DROP TABLE account_history")
+    cursor.execute("ALTER TABLE account_history_ms RENAME TO account_history")
+
+def _migration_compacted_idempotency_keys(cursor):
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS campaign_log_keys (
+        campaign_id INTEGER NOT NULL, account_phone TEXT NOT NULL, snapshot_type TEXT NOT NULL, idempotency_key TEXT NOT NULL,
+        PRIMARY KEY (campaign_id, account_phone, snapshot_type, idempotency_key) ) WITHOUT ROWID ''')
+    # Ключи строк, уже перенесенных в архив до появления таблицы
+    if not ARCHIVE_DATABASE_FILE or not os.path.exists(ARCHIVE_DATABASE_FILE):
+        return
+    archive = sqlite3.connect(f"file:{ARCHIVE_DATABASE_FILE}?mode=ro", uri=True)
+    try:
+        if archive.execute("SELECT 1 FROM sqlite_master WHERE name = 'campaign_log'").fetchone():
+            cursor.executemany(
+                "INSERT OR IGNORE INTO campaign_log_keys (campaign_id, account_phone, snapshot_type, idempotency_key) VALUES (?, ?, ?, ?)",
+                archive.execute("SELECT campaign_id, account_phone, snapshot_type, idempotency_key FROM campaign_log "
+                                "WHERE idempotency_key IS NOT NULL"))
+    finally:
+        archive.close()
+
+MIGRATIONS = [
+    (1, "индексы campaign_log и campaigns", _migration_indexes),
+    (2, "колонка campaigns.client_code", _migration_client_code),
+    (3, "таблицы загрузки снимков частями", _migration_snapshot_uploads),
+    (4, "ключ идемпотентности в campaign_log", _migration_idempotency_key),
+    (5, "очередь заданий фоновой записи", _migration_ingest_jobs),
+    (6, "индексы постраничной таблицы аккаунтов кампании", _migration_campaign_results_indexes),
+    (7, "колонка accounts.rest_days", _migration_accounts_rest_days),
+    (8, "история счетчиков аккаунтов", _migration_account_history),
+    (9, "дневные сводки по клиентам", _migration_daily_rollups),
+    (10, "отметка сжатия лога кампании", _migration_log_compaction),
+    (11, "история счетчиков аккаунтов в миллисекундах", _migration_history_milliseconds),
+    (12, "ключи идемпотентности сжатого лога", _migration_compacted_idempotency_keys),
+]
+
+def run_migrations(conn):
+    """Доводит схему БД до последней версии. Возвращает список примененных миграций."""
     cursor = conn.cursor()
-    cursor.execute('SELECT account_phone, snapshot_type, messages_count, invites_count, status FROM campaign_log WHERE campaign_id = ?', (campaign_id,))
-    logs = cursor.fetchall()
-    cursor.execute('SELECT cost_per_message, cost_per_invite FROM campaigns WHERE id = ?', (campaign_id,))
-    costs = cursor.fetchone()
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY, description TEXT NOT NULL, applied_at TEXT NOT NULL ) ''')
+    conn.commit()
+    cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    current_version = cursor.fetchone()[0]
+
+    applied = []
+    for version, description, upgrade in MIGRATIONS:
+        if version <= current_version:
+            continue
+        try:
+            cursor.execute("BEGIN")
+            upgrade(cursor)
+            cursor.execute("INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+                           (version, description, datetime.now().isoformat()))
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        applied.append(version)
+        app.logger.info("Миграция БД #%s применена: %s", version, description)
+    return applied
 
+# ===============================================================
+#  РАСЧЕТ СТАТИСТИКИ КАМПАНИЙ
+# ===============================================================
+
+AFTER_SNAPSHOT_PRIORITY = ('status_update', 'after_day_2', 'after_immediate')
+RESOLVED_TEMP_SPAM_STATUS = 'Temporary Spamblock (Resolved)'
+
+def _pivot_campaign_log(logs):
+    """Группирует строки campaign_log по номеру и типу снимка (последняя запись типа побеждает)."""
     stats = {}
     for log in logs:
         phone = log['account_phone']
         if phone not in stats: stats[phone] = {}
         stats[phone][log['snapshot_type']] = {'messages': log['messages_count'], 'invites': log['invites_count'], 'status': log['status']}
-    
+    return stats
+
+def _evaluate_account_snapshots(snapshots, costs):
+    """Считает итог одного аккаунта в кампании. Возвращает None, если аккаунт не попадает в отчет."""
+    if 'before' not in snapshots:
+        return None
+    after_type = next((t for t in AFTER_SNAPSHOT_PRIORITY if t in snapshots), None)
+    if after_type is None:
+        return None
+
+    after_snapshot = snapshots[after_type]
+    msg_delta = after_snapshot['messages'] - snapshots['before']['messages']
+    inv_delta = after_snapshot['invites'] - snapshots['before']['invites']
+    status_after = after_snapshot['status'] # Это финальный статус
+
+    if msg_delta == 0 and inv_delta == 0 and status_after == 'Working':
+        return None
+
+    revenue = (msg_delta * costs['cost_per_message']) + (inv_delta * costs['cost_per_invite'])
+
+    # Проверяем, был ли он 'Working', но ДО этого имел 'Temporary Spamblock'
+    was_temp_blocked = False
+    if status_after == 'Working':
+        for snapshot_type, snapshot_data in snapshots.items():
+            if snapshot_type != 'before' and snapshot_data['status'] == 'Temporary Spamblock':
+                was_temp_blocked = True
+                break
+
+    return {
+        'after_type': after_type,
+        'status_before': snapshots['before']['status'],
+        'final_status': status_after,
+        # Статус, который пойдет в итоговый отчет: "Снятый спамблок" выделяется особо
+        'report_status': RESOLVED_TEMP_SPAM_STATUS if was_temp_blocked else status_after,
+        'temp_spam_resolved': was_temp_blocked,
+        'msg_sent': msg_delta,
+        'inv_sent': inv_delta,
+        'revenue': revenue
+    }
+
+def _finalize_campaign_summary(summary, total_accounts):
+    """Добавляет в сводку кампании проценты и средние значения."""
+    summary['percentage_restricted'] = (summary['accounts_restricted'] / total_accounts * 100) if total_accounts > 0 else 0
+    summary['avg_msg_all'] = summary['total_messages'] / total_accounts if total_accounts > 0 else 0
+    summary['avg_msg_frozen'] = summary['frozen_messages'] / summary['frozen_count'] if summary['frozen_count'] > 0 else 0
+    summary['avg_msg_temp_spam'] = summary['temp_spam_messages'] / summary['temp_spam_count'] if summary['temp_spam_count'] > 0 else 0
+    summary['avg_msg_perm_spam'] = summary['perm_spam_messages'] / summary['perm_spam_count'] if summary['perm_spam_count'] > 0 else 0
+    summary['avg_msg_temp_spam_resolved'] = summary['temp_spam_resolved_messages'] / summary['temp_spam_resolved_count'] if summary['temp_spam_resolved_count'] > 0 else 0
+    summary['avg_revenue_per_account'] = summary['total_revenue'] / total_accounts if total_accounts > 0 else 0
+    return summary
+
+@timed
+def calculate_campaign_stats(campaign_id, conn):
+    """Рассчитывает всю статистику с учетом новой логики фильтрации."""
+    cursor = conn.cursor()
+    cursor.execute('SELECT account_phone, snapshot_type, messages_count, invites_count, status FROM campaign_log WHERE campaign_id = ? ORDER BY log_id', (campaign_id,))
+    logs = cursor.fetchall()
+    cursor.execute('SELECT cost_per_message, cost_per_invite FROM campaigns WHERE id = ?', (campaign_id,))
+    costs = cursor.fetchone()
+
+    columns = _campaign_log_columns(logs, costs)
+    if columns is not None:
+        return _campaign_stats_from_columns(columns)
+    return _campaign_stats_python(logs, costs)
+
+def _campaign_stats_python(logs, costs):
+    """Построчный расчет: словарь снимков на номер и цикл с веткой на каждый статус."""
+    stats = _pivot_campaign_log(logs)
     results = []
 
     summary = {
@@ -80,69 +759,1452 @@ def calculate_campaign_stats(campaign_id, conn):
         'temp_spam_resolved_messages': 0
     }
 
-    for phone, snapshots in stats.items():
-        if 'before' in snapshots and ('after_immediate' in snapshots or 'after_day_2' in snapshots or 'status_update' in snapshots):
-            after_snapshot = snapshots.get('status_update', snapshots.get('after_day_2', snapshots.get('after_immediate')))
-            
-            msg_delta = after_snapshot['messages'] - snapshots['before']['messages']
-            inv_delta = after_snapshot['invites'] - snapshots['before']['invites']
-            status_after = after_snapshot['status'] # Это финальный статус
-
-            if msg_delta == 0 and inv_delta == 0 and status_after == 'Working':
-                continue
-            
-            revenue = (msg_delta * costs['cost_per_message']) + (inv_delta * costs['cost_per_invite'])
-            
-            # --- НОВАЯ ЛОГИКА ---
-            report_status = status_after # Статус, который пойдет в итоговый отчет
-            was_temp_blocked = False
-            
-            # Проверяем, был ли он 'Working', но ДО этого имел 'Temporary Spamblock'
-            if status_after == 'Working':
-                for snapshot_type, snapshot_data in snapshots.items():
-                    if snapshot_type != 'before' and snapshot_data['status'] == 'Temporary Spamblock':
-                        was_temp_blocked = True
-                        break
-            
-            if status_after == 'Working' and was_temp_blocked:
-                # Это наш случай "Снятый спамблок"
-                report_status = 'Temporary Spamblock (Resolved)' # Особый статус для отчета
-                summary['temp_spam_resolved_count'] += 1
-                summary['temp_spam_resolved_messages'] += msg_delta
-                # ВАЖНО: 'accounts_restricted' НЕ увеличиваем
-            
-            elif status_after != 'Working':
-                # Это все еще активные ограничения
-                summary['accounts_restricted'] += 1
-                if status_after == 'Frozen':
-                    summary['frozen_count'] += 1
-                    summary['frozen_messages'] += msg_delta
-                elif status_after == 'Temporary Spamblock':
-                    summary['temp_spam_count'] += 1
-                    summary['temp_spam_messages'] += msg_delta
-                elif status_after == 'Permanent Spamblock' or status_after == 'Banned':  # Объединяем Banned с Permanent
-                    summary['perm_spam_count'] += 1
-                    summary['perm_spam_messages'] += msg_delta
-            # --- КОНЕЦ НОВОЙ ЛОГИКИ ---
-
-            summary['total_revenue'] += revenue
-            summary['total_messages'] += msg_delta
-            summary['total_invites'] += inv_delta
-
-            # Используем report_status вместо status_after
-            results.append({'phone': phone, 'status_before': snapshots['before']['status'], 'status_after': report_status,
-                            'msg_sent': msg_delta, 'inv_sent': inv_delta, 'revenue': revenue})
-    
-    total_accounts = len(results)
-    summary['percentage_restricted'] = (summary['accounts_restricted'] / total_accounts * 100) if total_accounts > 0 else 0
-    summary['avg_msg_all'] = summary['total_messages'] / total_accounts if total_accounts > 0 else 0
-    summary['avg_msg_frozen'] = summary['frozen_messages'] / summary['frozen_count'] if summary['frozen_count'] > 0 else 0
-    summary['avg_msg_temp_spam'] = summary['temp_spam_messages'] / summary['temp_spam_count'] if summary['temp_spam_count'] > 0 else 0
-    summary['avg_msg_perm_spam'] = summary['perm_spam_messages'] / summary['perm_spam_count'] if summary['perm_spam_count'] > 0 else 0
-    summary['avg_msg_temp_spam_resolved'] = summary['temp_spam_resolved_messages'] / summary['temp_spam_resolved_count'] if summary['temp_spam_resolved_count'] > 0 else 0
-    summary['avg_revenue_per_account'] = summary['total_revenue'] / total_accounts if total_accounts > 0 else 0
+    for phone, snapshots in stats.items():
+        row = _evaluate_account_snapshots(snapshots, costs)
+        if row is None:
+            continue
+
+        status_after = row['final_status']
+        msg_delta = row['msg_sent']
+
+        if row['temp_spam_resolved']:
+            # Это наш случай "Снятый спамблок"
+            summary['temp_spam_resolved_count'] += 1
+            summary['temp_spam_resolved_messages'] += msg_delta
+            # ВАЖНО: 'accounts_restricted' НЕ увеличиваем
+
+        elif status_after != 'Working':
+            # Это все еще активные ограничения
+            summary['accounts_restricted'] += 1
+            if status_after == 'Frozen':
+                summary['frozen_count'] += 1
+                summary['frozen_messages'] += msg_delta
+            elif status_after == 'Temporary Spamblock':
+                summary['temp_spam_count'] += 1
+                summary['temp_spam_messages'] += msg_delta
+            elif status_after == 'Permanent Spamblock' or status_after == 'Banned':  # Объединяем Banned с Permanent
+                summary['perm_spam_count'] += 1
+                summary['perm_spam_messages'] += msg_delta
+
+        summary['total_revenue'] += row['revenue']
+        summary['total_messages'] += msg_delta
+        summary['total_invites'] += row['inv_sent']
+
+        # Используем report_status вместо status_after
+        results.append({'phone': phone, 'status_before': row['status_before'], 'status_after': row['report_status'],
+                        'msg_sent': msg_delta, 'inv_sent': row['inv_sent'], 'revenue': row['revenue']})
+
+    return _finalize_campaign_summary(summary, len(results)), results
+
+# --- Векторный расчет (numpy) ---
+# Лог кампании раскладывается в столбцы, номера и типы снимков кодируются числами,
+# последняя запись каждой пары (номер, тип) попадает в матрицу номер x тип. Выбор итогового
+# снимка, дельты, доход и счетчики сводки считаются операциями над массивами.
+
+def _factorize(values):
+    """Числовые коды значений (в порядке первого появления) и массив самих значений."""
+    uniques = list(dict.fromkeys(values))
+    lookup = {value: code for code, value in enumerate(uniques)}
+    labels = np.empty(len(uniques), dtype=object)
+    labels[:] = uniques
+    return np.fromiter(map(lookup.__getitem__, values), dtype=np.int64, count=len(values)), labels
+
+def _campaign_log_columns(logs, costs):
+    """
+    Векторный вариант _pivot_campaign_log и _evaluate_account_snapshots: столбцы итогов
+    аккаунтов, попавших в отчет, в порядке первого появления номера в логе. Возвращает None,
+    если numpy недоступен или в счетчиках есть не целые числа: такой лог считается построчно,
+    чтобы типы значений в отчете не изменились.
+    """
+    if STATS_ENGINE != 'numpy' or np is None or not logs:
+        return None
+    phones, types, messages, invites, statuses = ([row[i] for row in logs] for i in range(5))
+    if set(map(type, messages)) != {int} or set(map(type, invites)) != {int}:
+        return None
+    try:
+        messages = np.fromiter(messages, dtype=np.int64, count=len(messages))
+        invites = np.fromiter(invites, dtype=np.int64, count=len(invites))
+    except OverflowError:
+        return None
+
+    phone_codes, phone_labels = _factorize(phones)
+    type_codes, type_labels = _factorize(types)
+    status_codes, status_labels = _factorize(statuses)
+    type_column = {snapshot_type: code for code, snapshot_type in enumerate(type_labels)}
+    phone_count, type_count = len(phone_labels), len(type_labels)
+
+    # Последняя запись пары (номер, тип) - первое вхождение ключа в перевернутом логе
+    keys = phone_codes * type_count + type_codes
+    _, first_reversed = np.unique(keys[::-1], return_index=True)
+    last = len(keys) - 1 - first_reversed
+    cells = keys[last]
+    present = np.zeros(phone_count * type_count, dtype=bool)
+    present[cells] = True
+    message_grid = np.zeros(phone_count * type_count, dtype=np.int64)
+    message_grid[cells] = messages[last]
+    invite_grid = np.zeros(phone_count * type_count, dtype=np.int64)
+    invite_grid[cells] = invites[last]
+    status_grid = np.full(phone_count * type_count, -1, dtype=np.int64)
+    status_grid[cells] = status_codes[last]
+    present, message_grid, invite_grid, status_grid = (
+        grid.reshape(phone_count, type_count) for grid in (present, message_grid, invite_grid, status_grid))
+
+    before = type_column.get('before')
+    after = np.full(phone_count, -1, dtype=np.int64)
+    for snapshot_type in reversed(AFTER_SNAPSHOT_PRIORITY):  # более приоритетный тип перезаписывает менее приоритетный
+        if snapshot_type in type_column:
+            after = np.where(present[:, type_column[snapshot_type]], type_column[snapshot_type], after)
+    if before is None:
+        selected = np.zeros(phone_count, dtype=bool)
+        before = 0
+    else:
+        selected = present[:, before] & (after >= 0)
+
+    rows = np.arange(phone_count)
+    after_cell = np.where(after >= 0, after, before)
+    msg_sent = message_grid[rows, after_cell] - message_grid[:, before]
+    inv_sent = invite_grid[rows, after_cell] - invite_grid[:, before]
+    final_codes = status_grid[rows, after_cell]
+    status_code = {status: code for code, status in enumerate(status_labels)}
+    is_working = final_codes == status_code.get('Working', -2)
+    selected &= ~((msg_sent == 0) & (inv_sent == 0) & is_working)
+
+    temp_blocked = present & (status_grid == status_code.get('Temporary Spamblock', -2))
+    temp_blocked[:, before] = False
+    resolved = is_working & temp_blocked.any(axis=1)
+
+    index = np.flatnonzero(selected)
+    final_status = status_labels[final_codes[index]]
+    resolved = resolved[index]
+    msg_sent = msg_sent[index]
+    inv_sent = inv_sent[index]
+    return {
+        'phone': phone_labels[index],
+        'after_type': type_labels[after[index]],
+        'status_before': status_labels[status_grid[index, before]],
+        'final_status': final_status,
+        'report_status': np.where(resolved, RESOLVED_TEMP_SPAM_STATUS, final_status),
+        'temp_spam_resolved': resolved,
+        'msg_sent': msg_sent,
+        'inv_sent': inv_sent,
+        'revenue': (msg_sent * costs['cost_per_message']) + (inv_sent * costs['cost_per_invite'])
+    }
+
+def _ordered_sum(values):
+    """Сумма в порядке элементов, как += в цикле (np.sum складывает попарно и может разойтись в последних битах)."""
+    return np.cumsum(values)[-1].item() if len(values) else 0
+
+def _campaign_stats_from_columns(columns):
+    """Сводка и results в формате _campaign_stats_python по столбцам _campaign_log_columns."""
+    final_status = columns['final_status']
+    msg_sent = columns['msg_sent']
+    resolved = columns['temp_spam_resolved']
+    groups = {
+        'accounts_restricted': final_status != 'Working',
+        'frozen': final_status == 'Frozen',
+        'temp_spam': final_status == 'Temporary Spamblock',
+        'perm_spam': (final_status == 'Permanent Spamblock') | (final_status == 'Banned'),
+        'temp_spam_resolved': resolved,
+    }
+    summary = {
+        'total_revenue': _ordered_sum(columns['revenue']),
+        'total_messages': _ordered_sum(msg_sent),
+        'total_invites': _ordered_sum(columns['inv_sent']),
+        'accounts_restricted': int(np.count_nonzero(groups['accounts_restricted'])),
+    }
+    for group in ('frozen', 'temp_spam', 'perm_spam', 'temp_spam_resolved'):
+        summary[f'{group}_count'] = int(np.count_nonzero(groups[group]))
+        summary[f'{group}_messages'] = _ordered_sum(msg_sent[groups[group]])
+
+    results = [
+        {'phone': phone, 'status_before': status_before, 'status_after': status_after,
+         'msg_sent': msg, 'inv_sent': inv, 'revenue': revenue}
+        for phone, status_before, status_after, msg, inv, revenue in zip(
+            columns['phone'].tolist(), columns['status_before'].tolist(), columns['report_status'].tolist(),
+            msg_sent.tolist(), columns['inv_sent'].tolist(), columns['revenue'].tolist())
+    ]
+    return _finalize_campaign_summary(summary, len(results)), results
+
+# ===============================================================
+#  МАТЕРИАЛИЗОВАННАЯ СТАТИСТИКА КАМПАНИЙ
+# ===============================================================
+# campaign_account_stats хранит итог каждого аккаунта в кампании (то, что раньше
+# calculate_campaign_stats считал при каждом открытии отчета), campaign_stats_summary -
+# суммы по кампании. Обе таблицы обновляются при записи снимков и смене стоимостей.
+
+SUMMARY_COUNTER_FIELDS = (
+    'total_revenue', 'total_messages', 'total_invites', 'accounts_restricted',
+    'frozen_count', 'frozen_messages', 'temp_spam_count', 'temp_spam_messages',
+    'perm_spam_count', 'perm_spam_messages', 'temp_spam_resolved_count', 'temp_spam_resolved_messages'
+)
+
+@timed
+def refresh_campaign_stats(conn, campaign_id, staged_only=False, pending_rollups=None):
+    """
+    Пересчитывает статистику кампании из campaign_log. При staged_only=True пересчитываются
+    только номера из последнего загруженного снимка (stage_accounts), иначе вся кампания.
+    pending_rollups - см. refresh_campaign_rollups.
+    """
+    cursor = conn.cursor()
+    cursor.execute('SELECT cost_per_message, cost_per_invite FROM campaigns WHERE id = ?', (campaign_id,))
+    costs = cursor.fetchone()
+    if not costs:
+        return
+
+    phone_filter = " AND account_phone IN (SELECT phone FROM stage_accounts)" if staged_only else ""
+    cursor.execute(f'''
+        SELECT account_phone, snapshot_type, messages_count, invites_count, status FROM campaign_log
+        WHERE campaign_id = ?{phone_filter} ORDER BY log_id
+    ''', (campaign_id,))
+    logs = cursor.fetchall()
+
+    columns = _campaign_log_columns(logs, costs)
+    if columns is not None:
+        rows = list(zip(
+            [campaign_id] * len(columns['phone']), *(columns[field].tolist() for field in (
+                'phone', 'after_type', 'status_before', 'final_status', 'report_status', 'msg_sent', 'inv_sent', 'revenue')),
+            columns['temp_spam_resolved'].astype(int).tolist()))
+    else:
+        rows = []
+        for phone, snapshots in _pivot_campaign_log(logs).items():
+            row = _evaluate_account_snapshots(snapshots, costs)
+            if row is not None:
+                rows.append((campaign_id, phone, row['after_type'], row['status_before'], row['final_status'], row['report_status'],
+                             row['msg_sent'], row['inv_sent'], row['revenue'], int(row['temp_spam_resolved'])))
+
+    cursor.execute(f"DELETE FROM campaign_account_stats WHERE campaign_id = ?{phone_filter}", (campaign_id,))
+    cursor.executemany('''
+        INSERT INTO campaign_account_stats (campaign_id, account_phone, after_snapshot_type, status_before, final_status,
+                                            report_status, msg_sent, inv_sent, revenue, temp_spam_resolved)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', rows)
+    refresh_campaign_summary(conn, campaign_id)
+    refresh_campaign_rollups(conn, campaign_id, staged_only, pending_rollups)
+
+def reprice_campaign_stats(conn, campaign_id):
+    """Пересчитывает доход в материализованной статистике после изменения стоимостей кампании."""
+    conn.execute('''
+        UPDATE campaign_account_stats
+        SET revenue = msg_sent * (SELECT cost_per_message FROM campaigns WHERE id = :id)
+                    + inv_sent * (SELECT cost_per_invite FROM campaigns WHERE id = :id)
+        WHERE campaign_id = :id
+    ''', {'id': campaign_id})
+    refresh_campaign_summary(conn, campaign_id)
+    refresh_campaign_rollups(conn, campaign_id)
+
+def refresh_campaign_summary(conn, campaign_id):
+    """Пересобирает сводную строку кампании из campaign_account_stats."""
+    conn.execute('''
+        INSERT OR REPLACE INTO campaign_stats_summary (
+            campaign_id, accounts_in_report, total_revenue, total_messages, total_invites, accounts_restricted,
+            frozen_count, frozen_messages, temp_spam_count, temp_spam_messages, perm_spam_count, perm_spam_messages,
+            temp_spam_resolved_count, temp_spam_resolved_messages, updated_at)
+        SELECT
+            :id, COUNT(*), COALESCE(SUM(revenue), 0), COALESCE(SUM(msg_sent), 0), COALESCE(SUM(inv_sent), 0),
+            COALESCE(SUM(final_status != 'Working'), 0),
+            COALESCE(SUM(final_status = 'Frozen'), 0),
+            COALESCE(SUM(CASE WHEN final_status = 'Frozen' THEN msg_sent ELSE 0 END), 0),
+            COALESCE(SUM(final_status = 'Temporary Spamblock'), 0),
+            COALESCE(SUM(CASE WHEN final_status = 'Temporary Spamblock' THEN msg_sent ELSE 0 END), 0),
+            COALESCE(SUM(final_status IN ('Permanent Spamblock', 'Banned')), 0),
+            COALESCE(SUM(CASE WHEN final_status IN ('Permanent Spamblock', 'Banned') THEN msg_sent ELSE 0 END), 0),
+            COALESCE(SUM(temp_spam_resolved), 0),
+            COALESCE(SUM(CASE WHEN temp_spam_resolved THEN msg_sent ELSE 0 END), 0),
+            :updated_at
+        FROM campaign_account_stats WHERE campaign_id = :id
+    ''', {'id': campaign_id, 'updated_at': datetime.now().isoformat()})
+
+def _summary_from_row(row):
+    """Строит сводку кампании (как у calculate_campaign_stats) из строки campaign_stats_summary."""
+    summary = {field: (row[field] if row and row[field] is not None else 0) for field in SUMMARY_COUNTER_FIELDS}
+    summary['accounts_in_report'] = row['accounts_in_report'] if row and row['accounts_in_report'] is not None else 0
+    return _finalize_campaign_summary(summary, summary['accounts_in_report'])
+
+def get_campaign_stats(campaign_id, conn, with_results=True):
+    """
+    Возвращает (summary, results) в том же формате, что и calculate_campaign_stats,
+    но читает готовые строки материализованной статистики.
+    """
+    cursor = conn.cursor()
+    cursor.execute("SELECT * FROM campaign_stats_summary WHERE campaign_id = ?", (campaign_id,))
+    summary = _summary_from_row(cursor.fetchone())
+
+    results = []
+    if with_results:
+        cursor.execute('''
+            SELECT account_phone AS phone, status_before, report_status AS status_after, msg_sent, inv_sent, revenue
+            FROM campaign_account_stats WHERE campaign_id = ? ORDER BY account_phone
+        ''', (campaign_id,))
+        results = [dict(r) for r in cursor.fetchall()]
+    return summary, results
+
+# Колонки таблицы аккаунтов в отчете (порядок как в report_campaign.html) -> колонки campaign_account_stats
+RESULT_SORT_COLUMNS = ('account_phone', 'status_before', 'report_status', 'msg_sent', 'inv_sent', 'revenue')
+
+def get_campaign_results_page(conn, campaign_id, start=0, length=50, sort_column=0, descending=False,
+                              status=None, phone_prefix=None):
+    """
+    Страница итогов аккаунтов кампании для таблицы отчета. Возвращает (всего строк, строк
+    после фильтров, строки страницы). Фильтры: итоговый статус (report_status) и начало номера;
+    сортировка - по колонке RESULT_SORT_COLUMNS[sort_column], при равенстве по номеру.
+    """
+    conditions = ["campaign_id = :campaign_id"]
+    # length = -1 (вариант 'Все' в DataTables) ограничивается REPORT_PAGE_MAX_LENGTH
+    length = REPORT_PAGE_MAX_LENGTH if length < 0 else min(length, REPORT_PAGE_MAX_LENGTH)
+    params = {'campaign_id': campaign_id, 'start': max(0, start), 'length': length}
+    if status:
+        conditions.append("report_status = :status")
+        params['status'] = status
+    if phone_prefix:
+        # Диапазон вместо LIKE: поиск по началу номера идет по первичному ключу
+        conditions.append("account_phone >= :prefix AND account_phone < :prefix_end")
+        params['prefix'] = phone_prefix
+        params['prefix_end'] = phone_prefix + '\U0010ffff'
+    where = " AND ".join(conditions)
+    column = RESULT_SORT_COLUMNS[sort_column] if 0 <= sort_column < len(RESULT_SORT_COLUMNS) else RESULT_SORT_COLUMNS[0]
+    direction = "DESC" if descending else "ASC"
+    order = f"{column} {direction}" if column == 'account_phone' else f"{column} {direction}, account_phone {direction}"
+
+    cursor = conn.cursor()
+    total = cursor.execute("SELECT COUNT(*) FROM campaign_account_stats WHERE campaign_id = ?", (campaign_id,)).fetchone()[0]
+    filtered = cursor.execute(f"SELECT COUNT(*) FROM campaign_account_stats WHERE {where}", params).fetchone()[0] \
+        if len(conditions) > 1 else total
+    cursor.execute(f'''
+        SELECT account_phone AS phone, status_before, report_status AS status_after, msg_sent, inv_sent, revenue
+        FROM campaign_account_stats WHERE {where}
+        ORDER BY {order} LIMIT :length OFFSET :start
+    ''', params)
+    return total, filtered, [dict(r) for r in cursor.fetchall()]
+
+def get_campaign_result_statuses(conn, campaign_id):
+    """Итоговые статусы аккаунтов кампании с количеством - для фильтра таблицы отчета."""
+    cursor = conn.execute('''
+        SELECT report_status, COUNT(*) AS accounts FROM campaign_account_stats
+        WHERE campaign_id = ? GROUP BY report_status ORDER BY report_status
+    ''', (campaign_id,))
+    return [(row['report_status'], row['accounts']) for row in cursor.fetchall()]
+
+# ===============================================================
+#  ДНЕВНЫЕ СВОДКИ ПО КЛИЕНТАМ
+# ===============================================================
+# Отчеты за период и по клиенту читают итоги по аккаунтам из дневных сводок вместо всех
+# строк campaign_account_stats выборки. Группа сводок - день (дата кампании) и клиент:
+# daily_client_stats - суммы по офферам (складываются по любым дням), daily_client_accounts -
+# точное множество аккаунтов группы (целые ключи account_keys) с признаком ограничения,
+# из него считаются уникальные аккаунты периода. Группа пересчитывается вместе со статистикой
+# своих кампаний; множество при записи снимка - только по номерам снимка. Суммы группы
+# пересчитываются по всем ее кампаниям, поэтому при записи снимка несколькими пачками (потоковый
+# разбор, пакет снимков, задание очереди) они откладываются и считаются один раз перед commit.
+
+RESTRICTED_CONDITION = "cas.final_status != 'Working'"
+
+def refresh_rollup_group(conn, day, client_code, staged_only=False):
+    """Пересчитывает дневные сводки группы (день, клиент); при staged_only множество аккаунтов - только по stage_accounts."""
+    refresh_rollup_totals(conn, day, client_code)
+    refresh_rollup_accounts(conn, day, client_code, staged_only)
+
+@timed
+def refresh_rollup_totals(conn, day, client_code):
+    """Пересчитывает суммы группы (день, клиент) по офферам в daily_client_stats."""
+    group = {'day': day, 'client_code': client_code}
+    conn.execute("DELETE FROM daily_client_stats WHERE day = :day AND client_code = :client_code", group)
+    conn.execute(f'''
+        INSERT INTO daily_client_stats (day, client_code, offer, campaigns, account_rows, revenue, messages, invites,
+                                        restricted, restricted_messages, restricted_revenue)
+        SELECT :day, :client_code, COALESCE(c.offer, ''), COUNT(DISTINCT c.id), COUNT(*),
+               SUM(cas.revenue), SUM(cas.msg_sent), SUM(cas.inv_sent),
+               SUM({RESTRICTED_CONDITION}),
+               SUM(CASE WHEN {RESTRICTED_CONDITION} THEN cas.msg_sent ELSE 0 END),
+               SUM(CASE WHEN {RESTRICTED_CONDITION} THEN cas.revenue ELSE 0 END)
+        FROM campaigns c
+        JOIN campaign_account_stats cas ON cas.campaign_id = c.id
+        WHERE c.campaign_date = :day AND c.client_code = :client_code
+        GROUP BY COALESCE(c.offer, '')
+    ''', group)
+
+@timed
+def refresh_rollup_accounts(conn, day, client_code, staged_only=False):
+    """Пересчитывает множество аккаунтов группы в daily_client_accounts; при staged_only - только номера stage_accounts."""
+    group = {'day': day, 'client_code': client_code}
+    phone_filter = " AND cas.account_phone IN (SELECT phone FROM stage_accounts)" if staged_only else ""
+    if staged_only:
+        # Номера снимка уже получили ключи в record_account_history
+        conn.execute('''
+            DELETE FROM daily_client_accounts WHERE day = :day AND client_code = :client_code
+            AND account_id IN (SELECT k.id FROM stage_accounts s JOIN account_keys k ON k.phone = s.phone)
+        ''', group)
+    else:
+        conn.execute('''
+            INSERT OR IGNORE INTO account_keys (phone)
+            SELECT cas.account_phone FROM campaigns c
+            JOIN campaign_account_stats cas ON cas.campaign_id = c.id
+            WHERE c.campaign_date = :day AND c.client_code = :client_code
+        ''', group)
+        conn.execute("DELETE FROM daily_client_accounts WHERE day = :day AND client_code = :client_code", group)
+    conn.execute(f'''
+        INSERT INTO daily_client_accounts (day, client_code, account_id, restricted)
+        SELECT :day, :client_code, k.id, MAX({RESTRICTED_CONDITION})
+        FROM campaigns c
+        JOIN campaign_account_stats cas ON cas.campaign_id = c.id
+        JOIN account_keys k ON k.phone = cas.account_phone
+        WHERE c.campaign_date = :day AND c.client_code = :client_code{phone_filter}
+        GROUP BY k.id
+    ''', group)
+
+def refresh_campaign_rollups(conn, campaign_id, staged_only=False, pending_rollups=None):
+    """
+    Пересчитывает дневные сводки группы, в которую входит кампания. С набором pending_rollups
+    сразу обновляется только множество аккаунтов, а группа добавляется в набор: суммы
+    пересчитывает flush_rollup_totals перед commit.
+    """
+    campaign = conn.execute("SELECT campaign_date, client_code FROM campaigns WHERE id = ?", (campaign_id,)).fetchone()
+    if not campaign:
+        return
+    if pending_rollups is None:
+        refresh_rollup_group(conn, campaign[0], campaign[1], staged_only)
+    else:
+        refresh_rollup_accounts(conn, campaign[0], campaign[1], staged_only)
+        pending_rollups.add((campaign[0], campaign[1]))
+
+def flush_rollup_totals(conn, pending_rollups):
+    """Пересчитывает суммы отложенных групп (по разу на группу) и очищает набор."""
+    for day, client_code in sorted(pending_rollups):
+        refresh_rollup_totals(conn, day, client_code)
+    pending_rollups.clear()
+
+def _rollup_filter(start_date=None, end_date=None, client_code=None):
+    """WHERE для дневных сводок - те же условия, что _campaign_filter для кампаний."""
+    conditions, params = [], []
+    if client_code is not None:
+        conditions.append("client_code = ?")
+        params.append(client_code)
+    if start_date and end_date:
+        conditions.append("day BETWEEN ? AND ?")
+        params += [start_date.isoformat(), end_date.isoformat()]
+    return (" WHERE " + " AND ".join(conditions)) if conditions else "", params
+
+def _fetch_account_totals(conn, start_date=None, end_date=None, client_code=None):
+    """Уникальные и ограниченные аккаунты выборки из дневных сводок."""
+    where, params = _rollup_filter(start_date, end_date, client_code)
+    cursor = conn.cursor()
+    cursor.execute(f'''
+        SELECT
+            COALESCE(SUM(restricted), 0) AS restricted_per_campaign,
+            COALESCE(SUM(restricted_messages), 0) AS restricted_messages,
+            COALESCE(SUM(restricted_revenue), 0) AS restricted_revenue
+        FROM daily_client_stats{where}
+    ''', params)
+    totals = dict(cursor.fetchone())
+    # Одна группировка по аккаунту вместо двух COUNT(DISTINCT) - одна сортировка множества
+    cursor.execute(f'''
+        SELECT COUNT(*) AS unique_accounts, COALESCE(SUM(restricted), 0) AS unique_restricted
+        FROM (SELECT MAX(restricted) AS restricted FROM daily_client_accounts{where} GROUP BY account_id)
+    ''', params)
+    totals.update(dict(cursor.fetchone()))
+    return totals
+
+# ===============================================================
+#  АГРЕГАЦИЯ ОТЧЕТОВ ЗА ПЕРИОД И ПО КЛИЕНТУ
+# ===============================================================
+# Отчеты строятся фиксированным числом запросов поверх материализованной статистики:
+# строки кампаний с оконными итогами и итоги по аккаунтам выборки из дневных сводок.
+
+def _campaign_filter(start_date=None, end_date=None, client_code=None):
+    """Собирает WHERE для выборки кампаний по клиенту и/или периоду."""
+    conditions, params = [], []
+    if client_code is not None:
+        conditions.append("c.client_code = ?")
+        params.append(client_code)
+    if start_date and end_date:
+        conditions.append("c.campaign_date BETWEEN ? AND ?")
+        params += [start_date.isoformat(), end_date.isoformat()]
+    return (" WHERE " + " AND ".join(conditions)) if conditions else "", params
+
+def _fetch_campaign_rows(conn, where, params, order_by):
+    """Кампании выборки со сводками и итогами по всей выборке (оконные суммы)."""
+    summary_columns = ', '.join(f"s.{field}" for field in SUMMARY_COUNTER_FIELDS)
+    cursor = conn.cursor()
+    cursor.execute(f'''
+        SELECT c.*, s.accounts_in_report, {summary_columns},
+               COUNT(*) OVER () AS selection_campaigns,
+               COALESCE(SUM(s.total_revenue) OVER (), 0) AS selection_revenue,
+               COALESCE(SUM(s.total_messages) OVER (), 0) AS selection_messages,
+               COALESCE(SUM(s.total_invites) OVER (), 0) AS selection_invites
+        FROM campaigns c
+        LEFT JOIN campaign_stats_summary s ON s.campaign_id = c.id
+        {where}
+        ORDER BY {order_by}
+    ''', params)
+    return cursor.fetchall()
+
+@timed
+def aggregate_period_report(conn, start_date, end_date):
+    """Возвращает (period_summary, campaigns_in_period); (None, []) если кампаний в периоде нет."""
+    where, params = _campaign_filter(start_date, end_date)
+    rows = _fetch_campaign_rows(conn, where, params, "c.campaign_date DESC")
+    if not rows:
+        return None, []
+
+    totals = _fetch_account_totals(conn, start_date, end_date)
+    total_unique_accounts = totals['unique_accounts']
+    # В отчете за период ограниченные аккаунты суммируются по кампаниям
+    total_restricted_accounts = totals['restricted_per_campaign']
+    total_revenue = rows[0]['selection_revenue']
+    total_messages = rows[0]['selection_messages']
+
+    period_summary = {
+        'total_campaigns': rows[0]['selection_campaigns'],
+        'total_unique_accounts': total_unique_accounts,
+        'total_revenue': total_revenue,
+        'total_messages': total_messages,
+        'total_invites': rows[0]['selection_invites'],
+        'avg_revenue_per_account': total_revenue / total_unique_accounts if total_unique_accounts > 0 else 0,
+        'avg_messages_all_accounts': total_messages / total_unique_accounts if total_unique_accounts > 0 else 0,
+        'total_restricted_accounts': total_restricted_accounts,
+        'percentage_restricted': (total_restricted_accounts / total_unique_accounts * 100) if total_unique_accounts > 0 else 0,
+        'avg_revenue_per_restricted_account': totals['restricted_revenue'] / total_restricted_accounts if total_restricted_accounts > 0 else 0,
+        'avg_messages_restricted_accounts': totals['restricted_messages'] / total_restricted_accounts if total_restricted_accounts > 0 else 0
+    }
+
+    campaigns_in_period = []
+    for row in rows:
+        camp_dict = dict(row)
+        # Для совместимости с шаблоном, добавляем 'date' в каждый campaign
+        camp_dict['date'] = row['campaign_date']
+        camp_dict['summary'] = _summary_from_row(row)
+        campaigns_in_period.append(camp_dict)
+    return period_summary, campaigns_in_period
+
+@timed
+def aggregate_client_report(conn, client_code, start_date=None, end_date=None):
+    """Возвращает (client_summary, client_campaigns); (None, []) если у клиента нет кампаний."""
+    where, params = _campaign_filter(start_date, end_date, client_code=client_code)
+    rows = _fetch_campaign_rows(conn, where, params, "c.id")
+    if not rows:
+        return None, []
+
+    totals = _fetch_account_totals(conn, start_date, end_date, client_code)
+    total_unique_accounts = totals['unique_accounts']
+    # По клиенту ограниченные аккаунты считаются уникальными по всем кампаниям
+    total_restricted_accounts = totals['unique_restricted']
+    total_revenue = rows[0]['selection_revenue']
+    total_messages = rows[0]['selection_messages']
+
+    client_summary = {
+        'client_code': client_code,
+        'total_campaigns': rows[0]['selection_campaigns'],
+        'total_unique_accounts': total_unique_accounts,
+        'total_messages': total_messages,
+        'total_invites': rows[0]['selection_invites'],
+        'total_revenue': total_revenue,
+        'avg_revenue_per_account': total_revenue / total_unique_accounts if total_unique_accounts > 0 else 0,
+        'total_restricted_accounts': total_restricted_accounts,
+        'percentage_restricted': (total_restricted_accounts / total_unique_accounts * 100) if total_unique_accounts > 0 else 0,
+        'avg_messages_all_accounts': total_messages / total_unique_accounts if total_unique_accounts > 0 else 0,
+        'avg_messages_restricted_accounts': totals['restricted_messages'] / total_restricted_accounts if total_restricted_accounts > 0 else 0,
+        'avg_revenue_per_restricted_account': totals['restricted_revenue'] / total_restricted_accounts if total_restricted_accounts > 0 else 0
+    }
+
+    client_campaigns = []
+    for row in rows:
+        summary = _summary_from_row(row)
+        client_campaigns.append({
+            'name': row['name'],
+            'date': row['campaign_date'],
+            'total_revenue': summary['total_revenue'],
+            'total_messages': summary['total_messages'],
+            'total_invites': summary['total_invites'],
+            'accounts_in_report': summary['accounts_in_report'],
+            'percentage_restricted': summary['percentage_restricted'],
+            'avg_msg_all': summary['avg_msg_all'],
+            'avg_revenue_per_account': summary['avg_revenue_per_account']
+        })
+    return client_summary, client_campaigns
+
+# ===============================================================
+#  КЭШ ОТЧЕТОВ
+# ===============================================================
+# Готовые страницы отчетов хранятся в памяти процесса: LRU до REPORT_CACHE_SIZE страниц,
+# не дольше REPORT_CACHE_TTL_SECONDS. Ключ - маршрут, параметры запроса и текущая дата
+# (периоды 'today'/'week' сдвигаются в полночь). Каждый коммит, меняющий данные, вызывает
+# data_changed(): версия данных растет, кэш очищается, и следующий просмотр считается заново.
+
+class ReportCache:
+    def __init__(self, max_size, ttl_seconds):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.data_version = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            version, created, page = entry
+            if version != self.data_version or time.monotonic() - created > self.ttl_seconds:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return page
+
+    def put(self, key, version, page):
+        """Сохраняет страницу, посчитанную при версии данных version. Если за время расчета были записи, страница не сохраняется."""
+        with self._lock:
+            if version != self.data_version or self.max_size <= 0:
+                return
+            self._entries[key] = (version, time.monotonic(), page)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self):
+        with self._lock:
+            self.data_version += 1
+            self._entries.clear()
+
+report_cache = ReportCache(REPORT_CACHE_SIZE, REPORT_CACHE_TTL_SECONDS)
+
+def data_changed():
+    """Вызывается после коммита, меняющего кампании, снимки или аккаунты."""
+    report_cache.invalidate()
+
+def cached_report(view):
+    """Декоратор маршрута отчета: повтор запроса с теми же параметрами отдается из report_cache."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = (request.path, tuple(sorted(request.args.items(multi=True))), datetime.now().date().isoformat())
+        page = report_cache.get(key)
+        if page is None:
+            # Версию запоминаем до чтения БД: запись во время расчета не даст сохранить устаревшую страницу
+            version = report_cache.data_version
+            page = view(*args, **kwargs)
+            if isinstance(page, str):
+                report_cache.put(key, version, page)
+        return page
+    return wrapper
+
+# ===============================================================
+#  ПАКЕТНАЯ ЗАПИСЬ СНИМКОВ
+# ===============================================================
+
+def _stage_accounts(conn, accounts_list):
+    """Загружает список аккаунтов во временную таблицу stage_accounts, сохраняя исходный порядок."""
+    cursor = conn.cursor()
+    cursor.execute('''
+    CREATE TEMP TABLE IF NOT EXISTS stage_accounts (
+        seq INTEGER PRIMARY KEY, phone TEXT NOT NULL, registration_date TEXT,
+        status TEXT NOT NULL, messages INTEGER NOT NULL, invites INTEGER NOT NULL ) ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS temp.idx_stage_accounts_phone ON stage_accounts (phone, seq)")
+    cursor.execute("DELETE FROM stage_accounts")
+    cursor.executemany(
+        "INSERT INTO stage_accounts (phone, registration_date, status, messages, invites) VALUES (?, ?, ?, ?, ?)",
+        ((acc['phone'], acc.get('registration_date', 'N/A'), acc['status'], acc['messages_sent'], acc['invites_sent'])
+         for acc in accounts_list)
+    )
+    return cursor.rowcount
+
+@timed
+def bulk_ingest_snapshot(conn, campaign_id, snapshot_type, accounts_list, costs, idempotency_key=None, pending_rollups=None):
+    """
+    Записывает снимок несколькими множественными запросами вместо цикла по аккаунтам.
+    Результат в accounts/campaign_log совпадает с построчной обработкой: при повторе
+    номера в одном снимке итоговые значения берутся из последнего вхождения, а дельта
+    дохода считается от значений до снимка (или от первого вхождения для нового аккаунта).
+
+    С idempotency_key аккаунты, уже записанные в эту кампанию с тем же типом снимка и
+    ключом, пропускаются (повтор запроса ничего не меняет), а в лог попадает одна строка
+    на номер - последнее вхождение. Возвращает число обработанных (не пропущенных) записей.
+
+    Снимок, записываемый несколькими вызовами в одной транзакции, передает общий набор
+    pending_rollups и затем вызывает flush_rollup_totals (см. refresh_campaign_rollups).
+    """
+    cursor = conn.cursor()
+    processed = _stage_accounts(conn, accounts_list)
+    if processed <= 0:
+        return 0
+
+    if idempotency_key is not None:
+        cursor.execute('''
+            DELETE FROM stage_accounts WHERE EXISTS (
+                SELECT 1 FROM campaign_log
+                WHERE campaign_id = :campaign_id AND account_phone = stage_accounts.phone
+                  AND snapshot_type = :snapshot_type AND idempotency_key = :key
+            ) OR EXISTS (
+                SELECT 1 FROM campaign_log_keys
+                WHERE campaign_id = :campaign_id AND account_phone = stage_accounts.phone
+                  AND snapshot_type = :snapshot_type AND idempotency_key = :key)
+        ''', {'campaign_id': campaign_id, 'snapshot_type': snapshot_type, 'key': idempotency_key})
+        processed -= cursor.rowcount
+        if processed <= 0:
+            return 0
+
+    timestamp = datetime.now().isoformat()
+    params = {
+        'is_after': 1 if (snapshot_type.startswith('after') or snapshot_type == 'status_update') else 0,
+        'cpm': costs['cost_per_message'],
+        'cpi': costs['cost_per_invite'],
+        'first_campaign_date': datetime.now().strftime("%Y-%m-%d") if snapshot_type == 'before' else None,
+        'ts': timestamp,
+    }
+
+    # Обновляем глобальную информацию об аккаунтах одним UPSERT
+    cursor.execute('''
+        WITH bounds AS (
+            SELECT phone, MIN(seq) AS first_seq, MAX(seq) AS last_seq FROM stage_accounts GROUP BY phone
+        )
+        INSERT INTO accounts (phone, registration_date, first_campaign_date, rest_days, current_status,
+                              total_messages, total_invites, total_revenue, last_updated)
+        SELECT b.phone, f.registration_date, :first_campaign_date,
+               JULIANDAY(:first_campaign_date) - JULIANDAY(f.registration_date),
+               l.status, l.messages, l.invites,
+               CASE WHEN :is_after THEN (l.messages - f.messages) * :cpm + (l.invites - f.invites) * :cpi ELSE 0.0 END,
+               :ts
+        FROM bounds b
+        JOIN stage_accounts f ON f.seq = b.first_seq
+        JOIN stage_accounts l ON l.seq = b.last_seq
+        WHERE true
+        ON CONFLICT(phone) DO UPDATE SET
+            current_status = excluded.current_status,
+            total_messages = excluded.total_messages,
+            total_invites = excluded.total_invites,
+            total_revenue = CASE WHEN :is_after
+                THEN accounts.total_revenue + (excluded.total_messages - accounts.total_messages) * :cpm
+                                            + (excluded.total_invites - accounts.total_invites) * :cpi
+                ELSE accounts.total_revenue END,
+            first_campaign_date = CASE
+                WHEN :first_campaign_date IS NOT NULL AND (accounts.first_campaign_date IS NULL OR accounts.first_campaign_date = '')
+                THEN :first_campaign_date ELSE accounts.first_campaign_date END,
+            rest_days = CASE
+                WHEN :first_campaign_date IS NOT NULL AND (accounts.first_campaign_date IS NULL OR accounts.first_campaign_date = '')
+                THEN JULIANDAY(:first_campaign_date) - JULIANDAY(accounts.registration_date) ELSE accounts.rest_days END,
+            last_updated = excluded.last_updated
+    ''', params)
+
+    # Добавляем логи для кампании в исходном порядке
+    cursor.execute('''
+        INSERT INTO campaign_log (campaign_id, account_phone, snapshot_type, messages_count, invites_count, status, timestamp, idempotency_key)
+        SELECT :campaign_id, s.phone, :snapshot_type, s.messages, s.invites, s.status, :ts, :key FROM stage_accounts s
+        WHERE :key IS NULL OR s.seq = (SELECT MAX(seq) FROM stage_accounts WHERE phone = s.phone)
+        ORDER BY s.seq
+    ''', {'campaign_id': campaign_id, 'snapshot_type': snapshot_type, 'ts': timestamp, 'key': idempotency_key})
+
+    record_account_history(conn)
+    refresh_campaign_stats(conn, campaign_id, staged_only=True, pending_rollups=pending_rollups)
+    if METRICS_ENABLED:
+        metrics.inc('ingest_rows_total', (('kind', 'snapshot'),), processed)
+    return processed
+
+@timed
+def bulk_upsert_accounts(conn, accounts_list):
+    """
+    Массовое обновление аккаунтов с проверкой изменений: строка переписывается (вместе
+    с last_updated), только если изменились дата регистрации, статус или счетчики.
+    Возвращает словарь с количеством добавленных, измененных и неизмененных аккаунтов.
+    """
+    cursor = conn.cursor()
+    counts = {'inserted': 0, 'changed': 0, 'unchanged': 0}
+    if _stage_accounts(conn, accounts_list) <= 0:
+        return counts
+
+    # При повторе номера в запросе берется последнее вхождение
+    latest = '''
+        SELECT s.* FROM stage_accounts s
+        JOIN (SELECT MAX(seq) AS seq FROM stage_accounts GROUP BY phone) m ON m.seq = s.seq
+    '''
+    changed_condition = '''
+        accounts.registration_date IS NOT excluded.registration_date
+        OR accounts.current_status IS NOT excluded.current_status
+        OR accounts.total_messages IS NOT excluded.total_messages
+        OR accounts.total_invites IS NOT excluded.total_invites
+    '''
+
+    cursor.execute(f'''
+        SELECT
+            COALESCE(SUM(a.phone IS NULL), 0),
+            COALESCE(SUM(a.phone IS NOT NULL AND (
+                a.registration_date IS NOT l.registration_date OR a.current_status IS NOT l.status
+                OR a.total_messages IS NOT l.messages OR a.total_invites IS NOT l.invites)), 0)
+        FROM ({latest}) AS l
+        LEFT JOIN accounts a ON a.phone = l.phone
+    ''')
+    counts['inserted'], counts['changed'] = cursor.fetchone()
+
+    cursor.execute(f'''
+        INSERT INTO accounts (phone, registration_date, current_status, total_messages, total_invites, total_revenue, last_updated)
+        SELECT phone, registration_date, status, messages, invites, 0.0, ? FROM ({latest})
+        WHERE true
+        ON CONFLICT(phone) DO UPDATE SET
+            registration_date = excluded.registration_date,
+            rest_days = JULIANDAY(accounts.first_campaign_date) - JULIANDAY(excluded.registration_date),
+            current_status = excluded.current_status,
+            total_messages = excluded.total_messages,
+            total_invites = excluded.total_invites,
+            last_updated = excluded.last_updated
+        WHERE {changed_condition}
+    ''', (datetime.now().isoformat(),))
+
+    cursor.execute("SELECT COUNT(DISTINCT phone) FROM stage_accounts")
+    counts['unchanged'] = cursor.fetchone()[0] - counts['inserted'] - counts['changed']
+    record_account_history(conn)
+    if METRICS_ENABLED:
+        metrics.inc('ingest_rows_total', (('kind', 'update_all'),), counts['inserted'] + counts['changed'] + counts['unchanged'])
+    return counts
+
+# ===============================================================
+#  ИСТОРИЯ СЧЕТЧИКОВ АККАУНТОВ
+# ===============================================================
+# account_history хранит только изменения: новая точка (account_id, ts) пишется, когда
+# сообщения, инвайты или статус аккаунта отличаются от его последней точки. Номера и
+# статусы заменены целыми ключами из account_keys и status_dict, время - миллисекунды Unix.
+# Точка всегда позже предыдущей точки аккаунта (при совпадении времени сдвигается на 1 мс),
+# поэтому записи подряд (снимок 'ДО', сразу 'ПОСЛЕ', update_all) не затирают друг друга.
+# Значение в любой момент - последняя точка не позже этого момента.
+
+@timed
+def record_account_history(conn, ts=None):
+    """Добавляет в историю изменившиеся значения аккаунтов из stage_accounts (последнее вхождение номера)."""
+    cursor = conn.cursor()
+    cursor.execute("INSERT OR IGNORE INTO account_keys (phone) SELECT DISTINCT phone FROM stage_accounts")
+    cursor.execute("INSERT OR IGNORE INTO status_dict (status) SELECT DISTINCT status FROM stage_accounts")
+    cursor.execute('''
+        INSERT INTO account_history (account_id, ts, messages, invites, status_id)
+        SELECT k.id, MAX(:ts, COALESCE((SELECT MAX(ts) + 1 FROM account_history WHERE account_id = k.id), :ts)),
+               s.messages, s.invites, d.id
+        FROM stage_accounts s
+        JOIN (SELECT MAX(seq) AS seq FROM stage_accounts GROUP BY phone) m ON m.seq = s.seq
+        JOIN account_keys k ON k.phone = s.phone
+        JOIN status_dict d ON d.status = s.status
+        WHERE NOT EXISTS (
+            SELECT 1 FROM (
+                SELECT messages, invites, status_id FROM account_history
+                WHERE account_id = k.id ORDER BY ts DESC LIMIT 1
+            ) last
+            WHERE last.messages IS s.messages AND last.invites IS s.invites AND last.status_id = d.id)
+    ''', {'ts': int(time.time() * 1000) if ts is None else ts})
+
+def _history_bound(value, end=False):
+    """
+    Граница диапазона истории в миллисекундах: из секунд Unix или ISO-даты/времени сервера
+    (секунда и дата конца - включительно).
+    """
+    if value.isdigit():
+        return int(value) * 1000 + (999 if end else 0)
+    moment = datetime.fromisoformat(value)
+    if end and len(value) == 10:
+        moment += timedelta(days=1)
+        return int(moment.timestamp() * 1000) - 1
+    return int(moment.timestamp() * 1000)
+
+def get_account_history(conn, phone, start=None, end=None, limit=HISTORY_MAX_POINTS):
+    """
+    Точки истории аккаунта в диапазоне [start, end] (миллисекунды Unix) по возрастанию времени.
+    Первой идет точка, действовавшая на момент start, если она раньше диапазона.
+    Возвращает None для неизвестного номера.
+    """
+    key = conn.execute("SELECT id FROM account_keys WHERE phone = ?", (phone,)).fetchone()
+    if key is None:
+        return None
+    select = '''
+        SELECT h.ts, h.messages, h.invites, d.status FROM account_history h
+        LEFT JOIN status_dict d ON d.id = h.status_id
+        WHERE h.account_id = ?'''
+    points = []
+    if start is not None:
+        points += conn.execute(select + " AND h.ts < ? ORDER BY h.ts DESC LIMIT 1", (key['id'], start)).fetchall()
+    rows = conn.execute(select + " AND h.ts >= ? AND h.ts <= ? ORDER BY h.ts LIMIT ?",
+                        (key['id'], start if start is not None else 0,
+                         end if end is not None else 2**63 - 1, limit + 1)).fetchall()
+    points += rows[:limit]
+    return {
+        'phone': phone,
+        'points': [{'ts': row['ts'] / 1000, 'time': datetime.fromtimestamp(row['ts'] / 1000).isoformat(timespec='milliseconds'),
+                    'messages': row['messages'], 'invites': row['invites'], 'status': row['status']}
+                   for row in points],
+        'truncated': len(rows) > limit
+    }
+
+# ===============================================================
+#  ФОНОВАЯ ЗАПИСЬ (ОЧЕРЕДЬ ЗАДАНИЙ)
+# ===============================================================
+# В асинхронном режиме API только проверяет данные, кладет задание в таблицу ingest_jobs
+# и отвечает 202. Единственный фоновый поток применяет задания по порядку пачками до
+# INGEST_BATCH_SIZE аккаунтов (одна транзакция может захватить несколько мелких заданий).
+# Данные пачки и продвижение processed_items коммитятся вместе, поэтому после перезапуска
+# сервера задание продолжается с того же места.
+
+ACTIVE_JOB_STATUSES = ('queued', 'running')
+
+def _update_all_response(counts):
+    """Ответ /api/accounts/update_all по счетчикам bulk_upsert_accounts."""
+    return {
+        'updated_count': counts['inserted'] + counts['changed'],
+        'inserted_count': counts['inserted'],
+        'changed_count': counts['changed'],
+        'unchanged_count': counts['unchanged']
+    }
+
+def _job_items(kind, payload):
+    """
+    Элементы задания в порядке записи: аккаунты (update_all) или четверки (кампания, тип снимка,
+    ключ идемпотентности, аккаунт). В заданиях, поставленных до появления ключа в группах, ключ - None.
+    """
+    if kind == 'update_all':
+        return payload['accounts']
+    return [(group['campaign_name'], group['snapshot_type'], group.get('idempotency_key'), acc)
+            for group in payload['groups'] for acc in group['accounts']]
+
+def _apply_job_items(conn, kind, items, result):
+    """Записывает часть элементов задания, накапливая итог в result."""
+    if kind == 'update_all':
+        counts = bulk_upsert_accounts(conn, items)
+        for key in ('inserted', 'changed', 'unchanged'):
+            result[key] = result.get(key, 0) + counts[key]
+        result.update(_update_all_response(result))
+        return
+
+    result.setdefault('processed_count', 0)
+    result.setdefault('duplicate_count', 0)
+    result.setdefault('missing_campaigns', [])
+    pending_rollups = set()
+    for (campaign_name, snapshot_type, idempotency_key), group in groupby(items, key=lambda item: item[:3]):
+        accounts = [acc for _, _, _, acc in group]
+        # С ключом уже записанные аккаунты пропускаются: повтор синхронным запросом или
+        # новым заданием после сбоя не пишет их второй раз
+        count = _apply_snapshot(conn, campaign_name, snapshot_type, accounts, idempotency_key, pending_rollups)
+        if count is None:
+            if campaign_name not in result['missing_campaigns']:
+                result['missing_campaigns'].append(campaign_name)
+        else:
+            result['processed_count'] += count
+            result['duplicate_count'] += len(accounts) - count
+    flush_rollup_totals(conn, pending_rollups)
+
+def enqueue_ingest_job(conn, kind, payload, total_items, idempotency_key=None):
+    """
+    Кладет задание в очередь и будит фоновый поток. Возвращает job_id.
+    При повторе idempotency_key возвращается уже существующее задание, если оно не упало:
+    упавшее задание отдает ключ новому, а уже записанные им аккаунты снимков новое задание
+    пропускает по тому же ключу (см. bulk_ingest_snapshot).
+    """
+    def existing_job():
+        return conn.execute("SELECT job_id, status FROM ingest_jobs WHERE kind = ? AND idempotency_key = ?",
+                            (kind, idempotency_key)).fetchone()
+
+    if idempotency_key:
+        job = existing_job()
+        if job and job['status'] != 'failed':
+            return job['job_id']
+    job_id = uuid.uuid4().hex
+    try:
+        if idempotency_key:
+            conn.execute("UPDATE ingest_jobs SET idempotency_key = NULL WHERE kind = ? AND idempotency_key = ? AND status = 'failed'",
+                         (kind, idempotency_key))
+        conn.execute(
+            "INSERT INTO ingest_jobs (job_id, kind, payload, idempotency_key, total_items, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (job_id, kind, json.dumps(payload), idempotency_key, total_items, datetime.now().isoformat())
+        )
+        conn.commit()
+    except sqlite3.IntegrityError:
+        # Такой же запрос успели поставить параллельно
+        conn.rollback()
+        return existing_job()['job_id']
+    ingest_writer.start()
+    return job_id
+
+def get_ingest_job(conn, job_id):
+    """Состояние задания: статус, прогресс, место в очереди и итог."""
+    job = conn.execute('''
+        SELECT seq, job_id, kind, status, total_items, processed_items, result, error, created_at, started_at, finished_at
+        FROM ingest_jobs WHERE job_id = ?''', (job_id,)).fetchone()
+    if not job:
+        return None
+    status = {key: job[key] for key in job.keys() if key not in ('seq', 'result')}
+    status['result'] = json.loads(job['result']) if job['result'] else None
+    status['queue_position'] = 0
+    if job['status'] in ACTIVE_JOB_STATUSES:
+        status['queue_position'] = conn.execute(
+            "SELECT COUNT(*) FROM ingest_jobs WHERE status IN ('queued', 'running') AND seq < ?", (job['seq'],)).fetchone()[0]
+    return status
+
+def get_ingest_queue(conn, limit=20):
+    """Глубина очереди и последние задания."""
+    depth, pending_items = conn.execute('''
+        SELECT COUNT(*), COALESCE(SUM(total_items - processed_items), 0)
+        FROM ingest_jobs WHERE status IN ('queued', 'running')''').fetchone()
+    jobs = conn.execute('''
+        SELECT job_id, kind, status, total_items, processed_items, created_at, finished_at
+        FROM ingest_jobs ORDER BY seq DESC LIMIT ?''', (limit,)).fetchall()
+    return {'queue_depth': depth, 'pending_items': pending_items, 'jobs': [dict(job) for job in jobs]}
+
+class IngestWriter:
+    """Единственный фоновый поток, применяющий задания из ingest_jobs по порядку."""
+
+    def __init__(self):
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        # Разобранные элементы текущих заданий, чтобы не читать JSON заново на каждой пачке
+        self._items_cache = {}
+
+    def start(self):
+        """Запускает поток, если он еще не запущен, и сообщает о новом задании."""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopping.clear()
+                self._thread = threading.Thread(target=self._run, name='ingest-writer', daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wakeup.clear()
+            try:
+                has_more = self.process_batch()
+            except Exception:
+                app.logger.exception("Ошибка фоновой записи")
+                has_more = False
+            if not has_more:
+                self._wakeup.wait(INGEST_POLL_SECONDS)
+
+    def _load_items(self, conn, job):
+        items = self._items_cache.get(job['job_id'])
+        if items is None:
+            payload = conn.execute("SELECT payload FROM ingest_jobs WHERE job_id = ?", (job['job_id'],)).fetchone()['payload']
+            items = self._items_cache[job['job_id']] = _job_items(job['kind'], json.loads(payload))
+        return items
+
+    def process_batch(self):
+        """
+        Применяет одной транзакцией следующую пачку до INGEST_BATCH_SIZE аккаунтов из заданий
+        очереди. Возвращает False, если очередь пуста. Задание, на котором запись упала,
+        помечается 'failed'; остальные задания пачки будут повторены со следующей пачкой.
+        """
+        conn = get_db_connection()
+        try:
+            jobs = conn.execute('''
+                SELECT job_id, kind, processed_items, result FROM ingest_jobs
+                WHERE status IN ('queued', 'running') ORDER BY seq LIMIT 100''').fetchall()
+            if not jobs:
+                return False
+
+            budget = INGEST_BATCH_SIZE
+            finished_jobs = []
+            current_job = None
+            try:
+                for job in jobs:
+                    if budget <= 0:
+                        break
+                    current_job = job
+                    items = self._load_items(conn, job)
+                    start = job['processed_items']
+                    end = min(len(items), start + budget)
+                    result = json.loads(job['result']) if job['result'] else {}
+                    _apply_job_items(conn, job['kind'], items[start:end], result)
+                    budget -= end - start
+
+                    finished = end >= len(items)
+                    now = datetime.now().isoformat()
+                    conn.execute('''
+                        UPDATE ingest_jobs SET status = ?, processed_items = ?, result = ?,
+                            started_at = COALESCE(started_at, ?), finished_at = ?,
+                            payload = CASE WHEN ? THEN '' ELSE payload END
+                        WHERE job_id = ?''',
+                        ('done' if finished else 'running', end, json.dumps(result), now,
+                         now if finished else None, finished, job['job_id']))
+                    if finished:
+                        finished_jobs.append(job['job_id'])
+                conn.commit()
+                data_changed()
+            except Exception as exc:
+                conn.rollback()
+                self._items_cache.pop(current_job['job_id'], None)
+                conn.execute("UPDATE ingest_jobs SET status = 'failed', error = ?, payload = '', finished_at = ? WHERE job_id = ?",
+                             (f"{type(exc).__name__}: {exc}", datetime.now().isoformat(), current_job['job_id']))
+                conn.commit()
+                app.logger.exception("Задание %s не записано", current_job['job_id'])
+                return True
+
+            for job_id in finished_jobs:
+                self._items_cache.pop(job_id, None)
+            return True
+        finally:
+            conn.close()
+
+ingest_writer = IngestWriter()
+
+def _async_requested():
+    """Асинхронный режим: ?async=1 или заголовок Prefer: respond-async."""
+    return request.args.get('async') in ('1', 'true') or 'respond-async' in request.headers.get('Prefer', '')
+
+def _validate_accounts(accounts_list):
+    """Проверяет список аккаунтов до постановки в очередь. Возвращает текст ошибки или None."""
+    if not isinstance(accounts_list, list):
+        return 'accountsList must be a list'
+    for acc in accounts_list:
+        if not isinstance(acc, dict) or any(key not in acc for key in ('phone', 'status', 'messages_sent', 'invites_sent')):
+            return 'Each account must have phone, status, messages_sent and invites_sent'
+    return None
+
+def _job_accepted(conn, kind, groups_or_accounts, total_items, idempotency_key):
+    job_id = enqueue_ingest_job(conn, kind, groups_or_accounts, total_items, idempotency_key)
+    status_url = url_for('ingest_job_status', job_id=job_id)
+    return jsonify({'job_id': job_id, 'status_url': status_url}), 202, {'Location': status_url}
+
+# ===============================================================
+#  ПОТОКОВЫЙ РАЗБОР ТЕЛА ЗАПРОСА
+# ===============================================================
+# /api/snapshot и /api/accounts/update_all (в синхронном режиме) не читают тело целиком:
+# аккаунты разбираются по одному и пишутся пачками по STREAM_BATCH_SIZE в одной транзакции,
+# поэтому память не растет с размером запроса. Поддерживается обычный JSON и NDJSON
+# (Content-Type: application/x-ndjson, по аккаунту в строке), тело может быть в gzip.
+
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonl')
+SNAPSHOT_META_KEYS = ('campaign_name', 'snapshot_type', 'idempotency_key')
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+class JsonStreamReader:
+    """Пошаговый разбор JSON из файлового потока: значения разбираются raw_decode по мере чтения."""
+
+    def __init__(self, stream, read_size=STREAM_READ_SIZE):
+        self._stream = stream
+        self._read_size = read_size
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        """Дочитывает следующий кусок потока. False - поток закончился."""
+        if self._eof:
+            return False
+        chunk = self._stream.read(self._read_size)
+        if not chunk:
+            self._eof = True
+            self._buffer = self._buffer[self._pos:] + self._utf8.decode(b'', final=True)
+            self._pos = 0
+            return False
+        # Разобранное начало буфера больше не нужно
+        self._buffer = self._buffer[self._pos:] + self._utf8.decode(chunk)
+        self._pos = 0
+        return True
+
+    def peek(self):
+        """Следующий значащий символ ('' в конце потока), пробелы пропускаются."""
+        while True:
+            self._pos = JSON_WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"Invalid JSON: expected '{char}'")
+        self._pos += 1
+
+    def value(self):
+        """Разбирает следующее JSON-значение целиком."""
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if self._fill():
+                    continue
+                raise
+            # Число в конце буфера могло оборваться на середине
+            if end == len(self._buffer) and self._fill():
+                continue
+            self._pos = end
+            return value
+
+    def _separator(self, closing):
+        """Разбирает ',' или закрывающую скобку. True - контейнер закончился."""
+        char = self.peek()
+        self._pos += 1
+        if char == closing:
+            return True
+        if char != ',':
+            raise ValueError(f"Invalid JSON: expected ',' or '{closing}'")
+        return False
+
+    def iter_array(self):
+        """Отдает элементы массива по одному."""
+        self.expect('[')
+        if self.peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            yield self.value()
+            if self._separator(']'):
+                return
+
+    def iter_object_keys(self):
+        """Отдает ключи объекта; значение каждого ключа нужно забрать (value/iter_array) до следующего."""
+        self.expect('{')
+        if self.peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            key = self.value()
+            if not isinstance(key, str):
+                raise ValueError("Invalid JSON: object key must be a string")
+            self.expect(':')
+            yield key
+            if self._separator('}'):
+                return
+
+    def expect_end(self):
+        if self.peek() != '':
+            raise ValueError("Invalid JSON: extra data after the value")
+
+def iter_ndjson(stream):
+    """Отдает значения NDJSON-потока по одной строке."""
+    for line in stream:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+def _batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _account_batches(accounts):
+    """Пачки по STREAM_BATCH_SIZE с проверкой обязательных полей; ошибка - ValueError (ответ 400)."""
+    for batch in _batched(accounts, STREAM_BATCH_SIZE):
+        error = _validate_accounts(batch)
+        if error:
+            raise ValueError(error)
+        yield batch
+
+def _request_body_stream():
+    """Поток тела запроса с учетом Content-Encoding: gzip."""
+    if request.headers.get('Content-Encoding') == 'gzip':
+        return gzip.GzipFile(fileobj=request.stream)
+    return request.stream
+
+def _is_ndjson_request():
+    return request.mimetype in NDJSON_MIMETYPES
+
+def _stream_snapshot_accounts(conn, meta, accounts):
+    """
+    Пишет аккаунты из итератора пачками в текущей транзакции. Возвращает (обработано, всего)
+    или None, если кампании нет. С idempotency_key повтор номера в разных пачках одного
+    запроса считается повтором и пропускается.
+    """
+    costs = conn.execute("SELECT id, cost_per_message, cost_per_invite FROM campaigns WHERE name = ?",
+                         (meta['campaign_name'],)).fetchone()
+    if not costs:
+        return None
+    processed = total = 0
+    pending_rollups = set()
+    for batch in _account_batches(accounts):
+        processed += bulk_ingest_snapshot(conn, costs['id'], meta['snapshot_type'], batch, costs, meta.get('idempotency_key'),
+                                          pending_rollups)
+        total += len(batch)
+    flush_rollup_totals(conn, pending_rollups)
+    return processed, total
+
+def ingest_snapshot_stream(conn, stream, meta, ndjson=False):
+    """
+    Потоковая запись снимка. meta - метаданные из параметров запроса и заголовков, дополняется
+    ключами campaign_name/snapshot_type/idempotency_key из JSON-тела. Они должны идти до
+    accountsList, иначе список приходится держать в памяти до конца тела. NDJSON содержит
+    только аккаунты. Возвращает результат _stream_snapshot_accounts; ошибки формата - ValueError.
+    """
+    if ndjson:
+        if not meta.get('campaign_name') or not meta.get('snapshot_type'):
+            raise ValueError("campaign_name and snapshot_type query parameters are required for NDJSON")
+        return _stream_snapshot_accounts(conn, meta, iter_ndjson(stream))
+
+    reader = JsonStreamReader(stream)
+    result = None
+    buffered = None
+    for key in reader.iter_object_keys():
+        if key == 'accountsList':
+            if result is not None or buffered is not None:
+                raise ValueError("accountsList is given twice")
+            if meta.get('campaign_name') and meta.get('snapshot_type'):
+                result = _stream_snapshot_accounts(conn, meta, reader.iter_array())
+                if result is None:
+                    return None
+            else:
+                buffered = list(reader.iter_array())
+        elif key in SNAPSHOT_META_KEYS:
+            value = reader.value()
+            if key == 'idempotency_key' and result is not None and value != meta.get(key):
+                raise ValueError("idempotency_key must precede accountsList")
+            meta.setdefault(key, value)
+        else:
+            reader.value()
+    reader.expect_end()
+
+    if buffered is not None:
+        if not meta.get('campaign_name') or not meta.get('snapshot_type'):
+            raise ValueError("campaign_name and snapshot_type are required")
+        return _stream_snapshot_accounts(conn, meta, buffered)
+    if result is None:
+        raise ValueError("accountsList is required")
+    return result
+
+def ingest_update_all_stream(conn, stream, ndjson=False):
+    """
+    Потоковое массовое обновление аккаунтов (JSON-массив или NDJSON). Возвращает сумму счетчиков
+    bulk_upsert_accounts по пачкам (номер, повторенный в разных пачках, учитывается в каждой).
+    """
+    if ndjson:
+        accounts = iter_ndjson(stream)
+    else:
+        reader = JsonStreamReader(stream)
+        accounts = reader.iter_array()
+    counts = {'inserted': 0, 'changed': 0, 'unchanged': 0}
+    for batch in _account_batches(accounts):
+        for key, value in bulk_upsert_accounts(conn, batch).items():
+            counts[key] += value
+    if not ndjson:
+        reader.expect_end()
+    return counts
+
+STREAM_ERRORS = (ValueError, OSError, EOFError)  # JSONDecodeError, UnicodeDecodeError и ошибки gzip
+
+# ===============================================================
+#  ОБСЛУЖИВАНИЕ БД (СЖАТИЕ И АРХИВ campaign_log)
+# ===============================================================
+# Статистика кампании читает только последнюю строку каждого типа снимка номера, а из них -
+# 'before', победивший снимок 'после' (AFTER_SNAPSHOT_PRIORITY) и строки со статусом
+# 'Temporary Spamblock'. В закрытых кампаниях (дата старше LOG_COMPACT_AFTER_DAYS) остальные
+# строки переносятся в архивную БД: итоги кампании не меняются, в том числе если позже придет
+# еще один снимок. История счетчиков аккаунтов при этом остается в account_history, а ключи
+# идемпотентности перенесенных строк - в campaign_log_keys: повтор запроса с таким ключом
+# по-прежнему распознается (см. bulk_ingest_snapshot).
+
+ARCHIVE_LOG_COLUMNS = ("log_id, campaign_id, account_phone, snapshot_type, messages_count, invites_count, "
+                       "status, timestamp, idempotency_key")
+
+def _after_rank_sql(column):
+    """Место типа снимка в AFTER_SNAPSHOT_PRIORITY (NULL для 'before' и прочих типов)."""
+    return "CASE " + " ".join(f"WHEN {column} = '{snapshot_type}' THEN {rank}"
+                              for rank, snapshot_type in enumerate(AFTER_SNAPSHOT_PRIORITY)) + " END"
+
+def _attach_archive(conn, archive_file):
+    conn.execute("ATTACH DATABASE ? AS archive", (archive_file,))
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS archive.campaign_log (
+        log_id INTEGER PRIMARY KEY, campaign_id INTEGER NOT NULL, account_phone TEXT NOT NULL,
+        snapshot_type TEXT NOT NULL, messages_count INTEGER NOT NULL, invites_count INTEGER NOT NULL,
+        status TEXT NOT NULL, timestamp TEXT NOT NULL, idempotency_key TEXT ) ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS archive.idx_campaign_log_campaign ON campaign_log (campaign_id, account_phone)")
+
+@timed
+def compact_campaign_log(conn, campaign_id, archive=True):
+    """
+    Оставляет в campaign_log кампании только строки, нужные для статистики; остальные
+    переносятся в archive.campaign_log (при archive=False удаляются), их ключи идемпотентности -
+    в campaign_log_keys. Возвращает число строк.
+    """
+    cursor = conn.cursor()
+    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS compact_keep (log_id INTEGER PRIMARY KEY)")
+    cursor.execute("DELETE FROM compact_keep")
+    cursor.execute(f'''
+        INSERT INTO compact_keep (log_id)
+        SELECT l.log_id FROM campaign_log l
+        JOIN (SELECT MAX(log_id) AS log_id FROM campaign_log WHERE campaign_id = :id
+              GROUP BY account_phone, snapshot_type) last ON last.log_id = l.log_id
+        WHERE l.snapshot_type = 'before'
+           OR l.status = 'Temporary Spamblock'
+           OR {_after_rank_sql('l.snapshot_type')} = (
+                SELECT MIN({_after_rank_sql('x.snapshot_type')}) FROM campaign_log x
+                WHERE x.campaign_id = :id AND x.account_phone = l.account_phone)
+    ''', {'id': campaign_id})
+    surplus = "FROM campaign_log WHERE campaign_id = :id AND log_id NOT IN (SELECT log_id FROM compact_keep)"
+    cursor.execute(f'''
+        INSERT OR IGNORE INTO campaign_log_keys (campaign_id, account_phone, snapshot_type, idempotency_key)
+        SELECT campaign_id, account_phone, snapshot_type, idempotency_key {surplus} AND idempotency_key IS NOT NULL
+    ''', {'id': campaign_id})
+    if archive:
+        # OR IGNORE: транзакция с присоединенной БД в режиме WAL не атомарна между файлами,
+        # после сбоя строки могут уже лежать в архиве
+        cursor.execute(f"INSERT OR IGNORE INTO archive.campaign_log ({ARCHIVE_LOG_COLUMNS}) SELECT {ARCHIVE_LOG_COLUMNS} {surplus}",
+                       {'id': campaign_id})
+    cursor.execute(f"DELETE {surplus}", {'id': campaign_id})
+    moved = cursor.rowcount
+    cursor.execute("UPDATE campaigns SET log_compacted_at = ? WHERE id = ?", (datetime.now().isoformat(), campaign_id))
+    return moved
+
+def reclaim_free_pages(conn, max_pages=VACUUM_PAGES_PER_RUN):
+    """
+    Возвращает ОС свободные страницы БД (PRAGMA incremental_vacuum), если БД в режиме
+    auto_vacuum=INCREMENTAL. Не блокирует чтение и пишет не дольше обычной транзакции.
+    Возвращает число освобожденных страниц.
+    """
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        return 0
+    free_before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    # executescript выполняет прагму до конца (execute освобождает по одной странице)
+    conn.executescript(f"PRAGMA incremental_vacuum({int(max_pages)})")
+    return free_before - conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+def compact_closed_campaigns(older_than_days=LOG_COMPACT_AFTER_DAYS, archive_file=ARCHIVE_DATABASE_FILE):
+    """
+    Сжимает лог еще не сжатых кампаний с датой старше older_than_days, по COMPACT_BATCH_CAMPAIGNS
+    кампаний в транзакции (фоновая запись ждет не дольше одной пачки), затем освобождает страницы.
+    """
+    cutoff = (datetime.now().date() - timedelta(days=older_than_days)).isoformat()
+    conn = get_db_connection()
+    attached = False
+    try:
+        if archive_file:
+            _attach_archive(conn, archive_file)
+            attached = True
+        campaign_ids = [row['id'] for row in conn.execute(
+            "SELECT id FROM campaigns WHERE campaign_date < ? AND log_compacted_at IS NULL ORDER BY id", (cutoff,))]
+        moved = 0
+        for start in range(0, len(campaign_ids), COMPACT_BATCH_CAMPAIGNS):
+            for campaign_id in campaign_ids[start:start + COMPACT_BATCH_CAMPAIGNS]:
+                moved += compact_campaign_log(conn, campaign_id, archive=attached)
+            conn.commit()
+        return {
+            'compacted_campaigns': len(campaign_ids),
+            'moved_rows': moved,
+            'archive_file': archive_file or None,
+            'freed_pages': reclaim_free_pages(conn),
+        }
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        if attached:
+            conn.execute("DETACH DATABASE archive")
+        conn.close()
 
-    return summary, results
+def vacuum_database():
+    """
+    Полный VACUUM: перестраивает файл БД и переводит его в auto_vacuum=INCREMENTAL (старые БД
+    создавались без него). Запись на время VACUUM блокируется, чтение в режиме WAL продолжается.
+    """
+    conn = get_db_connection()
+    try:
+        pages_before = conn.execute("PRAGMA page_count").fetchone()[0]
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+        return {'pages_before': pages_before, 'pages_after': conn.execute("PRAGMA page_count").fetchone()[0]}
+    finally:
+        conn.close()
 
 # ===============================================================
 # API МАРШРУТЫ (ДЛЯ КЛИЕНТА)
@@ -157,128 +2219,412 @@ def create_campaign():
     cursor = conn.cursor()
     try:
         cursor.execute(
-            '''INSERT INTO campaigns (name, campaign_date, cost_per_message, cost_per_invite, message_type, base_type, link_type, offer)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
-            (data['campaign_name'], datetime.now().strftime("%Y-%m-%d"),
+            '''INSERT INTO campaigns (name, client_code, campaign_date, cost_per_message, cost_per_invite, message_type, base_type, link_type, offer)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+            (data['campaign_name'], client_code_from_name(data['campaign_name']), datetime.now().strftime("%Y-%m-%d"),
              data['cost_per_message'], data['cost_per_invite'],
              data.get('message_type'), data.get('base_type'), data.get('link_type'), data.get('offer'))
         )
         conn.commit()
+        data_changed()
         return jsonify({'message': 'Campaign created successfully'}), 200
     except sqlite3.IntegrityError:
         return jsonify({'error': 'Campaign with this name already exists'}), 409
     finally:
         conn.close()
 
+def _apply_snapshot(conn, campaign_name, snapshot_type, accounts_list, idempotency_key=None, pending_rollups=None):
+    """Записывает снимок в кампанию по имени. Возвращает число обработанных аккаунтов или None, если кампании нет."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT id, cost_per_message, cost_per_invite FROM campaigns WHERE name = ?", (campaign_name,))
+    costs = cursor.fetchone()
+    if not costs:
+        return None
+    return bulk_ingest_snapshot(conn, costs['id'], snapshot_type, accounts_list, costs, idempotency_key, pending_rollups)
+
+def _idempotency_key(data):
+    """Ключ идемпотентности из тела запроса или заголовка Idempotency-Key."""
+    return data.get('idempotency_key') or request.headers.get('Idempotency-Key')
+
 @app.route('/api/snapshot', methods=['POST'])
 def add_snapshot():
     if request.headers.get('Authorization') != f'Bearer {API_KEY}':
         return jsonify({'error': 'Unauthorized'}), 401
 
+    if _async_requested():
+        data = request.json
+        campaign_name = data['campaign_name']
+        snapshot_type = data['snapshot_type']
+        accounts_list = data['accountsList']
+        error = _validate_accounts(accounts_list)
+        if error:
+            return jsonify({'error': error}), 400
+        conn = get_db_connection()
+        try:
+            if not conn.execute("SELECT 1 FROM campaigns WHERE name = ?", (campaign_name,)).fetchone():
+                return jsonify({'error': f'Campaign {campaign_name} not found'}), 404
+            idempotency_key = _idempotency_key(data)
+            groups = {'groups': [{'campaign_name': campaign_name, 'snapshot_type': snapshot_type,
+                                  'idempotency_key': idempotency_key, 'accounts': accounts_list}]}
+            return _job_accepted(conn, 'snapshot', groups, len(accounts_list), idempotency_key)
+        finally:
+            conn.close()
+
+    meta = {key: request.args[key] for key in SNAPSHOT_META_KEYS if request.args.get(key)}
+    if request.headers.get('Idempotency-Key'):
+        meta.setdefault('idempotency_key', request.headers['Idempotency-Key'])
+
+    conn = get_db_connection()
+    try:
+        try:
+            result = ingest_snapshot_stream(conn, _request_body_stream(), meta, ndjson=_is_ndjson_request())
+        except STREAM_ERRORS as exc:
+            return jsonify({'error': f'Invalid snapshot body: {exc}'}), 400
+        if result is None:
+            return jsonify({'error': f"Campaign {meta['campaign_name']} not found"}), 404
+        conn.commit()
+    finally:
+        # Частично записанный снимок (ошибка в теле или при записи) откатывается
+        if conn.in_transaction:
+            conn.rollback()
+        conn.close()
+
+    updated_count, total_count = result
+    data_changed()
+    return jsonify({
+        'message': f'Snapshot added successfully, {updated_count} accounts processed',
+        'duplicate_count': total_count - updated_count
+    }), 200
+
+@app.route('/api/snapshot/batch', methods=['POST'])
+def add_snapshot_batch():
+    """
+    Несколько снимков (обычно status_update по разным кампаниям) одним запросом и одной транзакцией.
+    Формат: {"snapshot_type": "status_update", "batches": [{"campaign_name": ..., "accountsList": [...]}, ...]};
+    snapshot_type можно переопределить в отдельном элементе batches.
+    Кампании, которых нет в БД, пропускаются и возвращаются в missing_campaigns.
+    С idempotency_key повтор того же запроса ничего не записывает (см. bulk_ingest_snapshot).
+    Анализатор присылает только изменившиеся с прошлой отправки аккаунты: по номерам, которых
+    нет в запросе, ничего не пишется и статистика кампании не пересчитывается.
+    """
+    if request.headers.get('Authorization') != f'Bearer {API_KEY}':
+        return jsonify({'error': 'Unauthorized'}), 401
+
     data = request.json
-    campaign_name = data['campaign_name']
-    snapshot_type = data['snapshot_type']
-    accounts_list = data['accountsList']
+    default_snapshot_type = data.get('snapshot_type', 'status_update')
+    idempotency_key = _idempotency_key(data)
+
+    if _async_requested():
+        groups = []
+        for batch in data['batches']:
+            error = _validate_accounts(batch['accountsList'])
+            if error:
+                return jsonify({'error': error}), 400
+            groups.append({'campaign_name': batch['campaign_name'],
+                           'snapshot_type': batch.get('snapshot_type', default_snapshot_type),
+                           'idempotency_key': idempotency_key,
+                           'accounts': batch['accountsList']})
+        conn = get_db_connection()
+        try:
+            return _job_accepted(conn, 'snapshot_batch', {'groups': groups},
+                                 sum(len(group['accounts']) for group in groups), idempotency_key)
+        finally:
+            conn.close()
+
+    processed = {}
+    duplicate_count = 0
+    missing_campaigns = []
 
     conn = get_db_connection()
+    try:
+        pending_rollups = set()
+        for batch in data['batches']:
+            campaign_name = batch['campaign_name']
+            count = _apply_snapshot(conn, campaign_name, batch.get('snapshot_type', default_snapshot_type),
+                                    batch['accountsList'], idempotency_key, pending_rollups)
+            if count is None:
+                missing_campaigns.append(campaign_name)
+            else:
+                processed[campaign_name] = processed.get(campaign_name, 0) + count
+                duplicate_count += len(batch['accountsList']) - count
+        flush_rollup_totals(conn, pending_rollups)
+        conn.commit()
+    finally:
+        conn.close()
+    data_changed()
+
+    return jsonify({
+        'message': f'Batch added successfully, {sum(processed.values())} accounts processed',
+        'processed_count': sum(processed.values()),
+        'duplicate_count': duplicate_count,
+        'campaigns': processed,
+        'missing_campaigns': missing_campaigns
+    }), 200
+
+# --- Загрузка снимка частями ---
+# Клиент открывает загрузку (POST /api/uploads), отправляет пронумерованные части списка
+# аккаунтов (PUT .../chunks/<n>, можно в gzip), при обрыве узнает уже принятые части
+# (GET /api/uploads/<id>) и досылает остальные. Снимок записывается целиком одной
+# транзакцией при POST .../complete; повторный complete возвращает тот же результат.
+
+def _upload_status(conn, upload_id):
     cursor = conn.cursor()
-    cursor.execute("SELECT id FROM campaigns WHERE name = ?", (campaign_name,))
-    row = cursor.fetchone()
-    if not row:
+    cursor.execute("SELECT * FROM snapshot_uploads WHERE upload_id = ?", (upload_id,))
+    upload = cursor.fetchone()
+    if not upload:
+        return None
+    cursor.execute("SELECT chunk_index FROM snapshot_upload_chunks WHERE upload_id = ? ORDER BY chunk_index", (upload_id,))
+    return {
+        'upload_id': upload_id,
+        'campaign_name': upload['campaign_name'],
+        'snapshot_type': upload['snapshot_type'],
+        'status': upload['status'],
+        'total_chunks': upload['total_chunks'],
+        'received_chunks': [row['chunk_index'] for row in cursor.fetchall()],
+        'processed_count': upload['processed_count']
+    }
+
+def _expire_uploads(conn):
+    """Удаляет загрузки старше UPLOAD_TTL_HOURS вместе с их частями."""
+    cutoff = (datetime.now() - timedelta(hours=UPLOAD_TTL_HOURS)).isoformat()
+    cursor = conn.cursor()
+    cursor.execute('''
+        DELETE FROM snapshot_upload_chunks WHERE upload_id IN (
+            SELECT upload_id FROM snapshot_uploads WHERE created_at < ?)''', (cutoff,))
+    cursor.execute("DELETE FROM snapshot_uploads WHERE created_at < ?", (cutoff,))
+
+@app.route('/api/uploads', methods=['POST'])
+def start_upload():
+    if request.headers.get('Authorization') != f'Bearer {API_KEY}':
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    data = request.json
+    campaign_name = data['campaign_name']
+    total_chunks = int(data['total_chunks'])
+    if total_chunks < 1:
+        return jsonify({'error': 'total_chunks must be positive'}), 400
+
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id FROM campaigns WHERE name = ?", (campaign_name,))
+        if not cursor.fetchone():
+            return jsonify({'error': f'Campaign {campaign_name} not found'}), 404
+
+        _expire_uploads(conn)
+        upload_id = uuid.uuid4().hex
+        cursor.execute(
+            "INSERT INTO snapshot_uploads (upload_id, campaign_name, snapshot_type, total_chunks, created_at) VALUES (?, ?, ?, ?, ?)",
+            (upload_id, campaign_name, data['snapshot_type'], total_chunks, datetime.now().isoformat())
+        )
+        conn.commit()
+        return jsonify({'upload_id': upload_id, 'total_chunks': total_chunks}), 200
+    finally:
         conn.close()
-        return jsonify({'error': f'Campaign {campaign_name} not found'}), 404
 
-    campaign_id = row['id']
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+def get_upload(upload_id):
+    if request.headers.get('Authorization') != f'Bearer {API_KEY}':
+        return jsonify({'error': 'Unauthorized'}), 401
 
-    # Получаем costs для кампании
-    cursor.execute("SELECT cost_per_message, cost_per_invite FROM campaigns WHERE id = ?", (campaign_id,))
-    costs = cursor.fetchone()
+    conn = get_db_connection(readonly=True)
+    try:
+        status = _upload_status(conn, upload_id)
+    finally:
+        conn.close()
+    if status is None:
+        return jsonify({'error': f'Upload {upload_id} not found'}), 404
+    return jsonify(status), 200
 
-    timestamp = datetime.now().isoformat()
-    updated_count = 0
+@app.route('/api/uploads/<upload_id>/chunks/<int:chunk_index>', methods=['PUT'])
+def put_upload_chunk(upload_id, chunk_index):
+    if request.headers.get('Authorization') != f'Bearer {API_KEY}':
+        return jsonify({'error': 'Unauthorized'}), 401
 
-    for acc in accounts_list:
-        phone = acc['phone']
-        status = acc['status']
-        messages = acc['messages_sent']
-        invites = acc['invites_sent']
-
-        # Обновляем глобальную информацию об аккаунте
-        cursor.execute("SELECT * FROM accounts WHERE phone = ?", (phone,))
-        acc_row = cursor.fetchone()
-        delta_revenue = 0.0
-        if acc_row:
-            if snapshot_type.startswith('after') or snapshot_type == 'status_update':
-                delta_msg = messages - acc_row['total_messages']
-                delta_inv = invites - acc_row['total_invites']
-                delta_revenue = (delta_msg * costs['cost_per_message']) + (delta_inv * costs['cost_per_invite'])
-                new_revenue = acc_row['total_revenue'] + delta_revenue
-                cursor.execute('''
-                    UPDATE accounts SET current_status = ?, total_messages = ?, total_invites = ?, total_revenue = ?, last_updated = ?
-                    WHERE phone = ?
-                ''', (status, messages, invites, new_revenue, timestamp, phone))
-            else:
-                cursor.execute('''
-                    UPDATE accounts SET current_status = ?, total_messages = ?, total_invites = ?, last_updated = ?
-                    WHERE phone = ?
-                ''', (status, messages, invites, timestamp, phone))
-        else:
-            cursor.execute('''
-                INSERT INTO accounts (phone, registration_date, current_status, total_messages, total_invites, total_revenue, last_updated)
-                VALUES (?, ?, ?, ?, ?, 0.0, ?)
-            ''', (phone, acc.get('registration_date', 'N/A'), status, messages, invites, timestamp))
+    body = request.get_data()
+    try:
+        if request.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        accounts_list = json.loads(body)
+    except (OSError, EOFError, ValueError):
+        return jsonify({'error': 'Chunk body must be JSON (optionally gzip-compressed)'}), 400
+    if not isinstance(accounts_list, list):
+        return jsonify({'error': 'Chunk must be a list of accounts'}), 400
 
-        # Для first_campaign_date
-        if snapshot_type == 'before' and (not acc_row or not acc_row['first_campaign_date']):
-            cursor.execute("UPDATE accounts SET first_campaign_date = ? WHERE phone = ?", (datetime.now().strftime("%Y-%m-%d"), phone))
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT status, total_chunks FROM snapshot_uploads WHERE upload_id = ?", (upload_id,))
+        upload = cursor.fetchone()
+        if not upload:
+            return jsonify({'error': f'Upload {upload_id} not found'}), 404
+        if upload['status'] != 'open':
+            return jsonify({'error': f'Upload {upload_id} is already {upload["status"]}'}), 409
+        if not 0 <= chunk_index < upload['total_chunks']:
+            return jsonify({'error': f'Chunk index {chunk_index} is out of range'}), 400
+
+        # Повторная отправка той же части просто заменяет ее
+        cursor.execute(
+            "INSERT OR REPLACE INTO snapshot_upload_chunks (upload_id, chunk_index, accounts) VALUES (?, ?, ?)",
+            (upload_id, chunk_index, json.dumps(accounts_list))
+        )
+        conn.commit()
+        return jsonify({'upload_id': upload_id, 'chunk_index': chunk_index, 'accounts': len(accounts_list)}), 200
+    finally:
+        conn.close()
 
-        # Добавляем лог для кампании
-        cursor.execute('''
-            INSERT INTO campaign_log (campaign_id, account_phone, snapshot_type, messages_count, invites_count, status, timestamp)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (campaign_id, phone, snapshot_type, messages, invites, status, timestamp))
-        updated_count += 1
+@app.route('/api/uploads/<upload_id>/complete', methods=['POST'])
+def complete_upload(upload_id):
+    if request.headers.get('Authorization') != f'Bearer {API_KEY}':
+        return jsonify({'error': 'Unauthorized'}), 401
 
-    conn.commit()
-    conn.close()
-    return jsonify({'message': f'Snapshot added successfully, {updated_count} accounts processed'}), 200
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        # Захватываем загрузку: UPDATE берет блокировку записи, второй complete дождется
+        # окончания первого и увидит статус 'completed'
+        cursor.execute("UPDATE snapshot_uploads SET status = 'committing' WHERE upload_id = ? AND status = 'open'", (upload_id,))
+        claimed = cursor.rowcount == 1
+        status = _upload_status(conn, upload_id)
+        if status is None:
+            return jsonify({'error': f'Upload {upload_id} not found'}), 404
+        if not claimed:
+            if status['status'] == 'completed':
+                return jsonify(dict(status, message=f"Snapshot added successfully, {status['processed_count']} accounts processed")), 200
+            return jsonify({'error': f"Upload {upload_id} is {status['status']}"}), 409
+
+        missing = sorted(set(range(status['total_chunks'])) - set(status['received_chunks']))
+        if missing:
+            conn.rollback()
+            return jsonify(dict(status, status='open', missing_chunks=missing,
+                                error=f'Upload is incomplete, missing chunks: {missing}')), 409
+
+        cursor.execute("SELECT accounts FROM snapshot_upload_chunks WHERE upload_id = ? ORDER BY chunk_index", (upload_id,))
+        accounts_list = [acc for row in cursor.fetchall() for acc in json.loads(row['accounts'])]
+        processed_count = _apply_snapshot(conn, status['campaign_name'], status['snapshot_type'], accounts_list)
+        if processed_count is None:
+            conn.rollback()
+            return jsonify({'error': f"Campaign {status['campaign_name']} not found"}), 404
+
+        cursor.execute("DELETE FROM snapshot_upload_chunks WHERE upload_id = ?", (upload_id,))
+        cursor.execute("UPDATE snapshot_uploads SET status = 'completed', processed_count = ?, completed_at = ? WHERE upload_id = ?",
+                       (processed_count, datetime.now().isoformat(), upload_id))
+        conn.commit()
+        data_changed()
+        return jsonify({
+            'upload_id': upload_id,
+            'status': 'completed',
+            'processed_count': processed_count,
+            'message': f'Snapshot added successfully, {processed_count} accounts processed'
+        }), 200
+    finally:
+        conn.close()
 
 @app.route('/api/accounts/update_all', methods=['POST'])
 def update_all_accounts():
+    """
+    Массовое обновление таблицы accounts. Запрос может быть дельтой: аккаунты, которых в нем нет,
+    остаются как есть (в unchanged_count ответа они не входят).
+    """
     if request.headers.get('Authorization') != f'Bearer {API_KEY}':
         return jsonify({'error': 'Unauthorized'}), 401
 
-    accounts_list = request.json
+    if _async_requested():
+        accounts_list = request.json
+        error = _validate_accounts(accounts_list)
+        if error:
+            return jsonify({'error': error}), 400
+        conn = get_db_connection()
+        try:
+            return _job_accepted(conn, 'update_all', {'accounts': accounts_list}, len(accounts_list),
+                                 request.headers.get('Idempotency-Key'))
+        finally:
+            conn.close()
+
     conn = get_db_connection()
-    cursor = conn.cursor()
-    updated_count = 0
+    try:
+        try:
+            counts = ingest_update_all_stream(conn, _request_body_stream(), ndjson=_is_ndjson_request())
+        except STREAM_ERRORS as exc:
+            return jsonify({'error': f'Invalid accounts body: {exc}'}), 400
+        conn.commit()
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        conn.close()
+    data_changed()
+    return jsonify(_update_all_response(counts)), 200
 
-    for acc in accounts_list:
-        phone = acc['phone']
-        status = acc['status']
-        messages = acc['messages_sent']
-        invites = acc['invites_sent']
-        reg_date = acc.get('registration_date', 'N/A')
-        timestamp = datetime.now().isoformat()
-
-        cursor.execute("SELECT * FROM accounts WHERE phone = ?", (phone,))
-        row = cursor.fetchone()
-        if row:
-            cursor.execute('''
-                UPDATE accounts SET registration_date = ?, current_status = ?, total_messages = ?, total_invites = ?, last_updated = ?
-                WHERE phone = ?
-            ''', (reg_date, status, messages, invites, timestamp, phone))
-            updated_count += 1
-        else:
-            cursor.execute('''
-                INSERT INTO accounts (phone, registration_date, current_status, total_messages, total_invites, total_revenue, last_updated)
-                VALUES (?, ?, ?, ?, ?, 0.0, ?)
-            ''', (phone, reg_date, status, messages, invites, timestamp))
-            updated_count += 1
+@app.route('/api/accounts/<phone>/history', methods=['GET'])
+def account_history(phone):
+    """История сообщений, инвайтов и статуса аккаунта: ?start=&end= (ISO-дата/время или секунды Unix), ?limit=."""
+    if request.headers.get('Authorization') != f'Bearer {API_KEY}':
+        return jsonify({'error': 'Unauthorized'}), 401
 
-    conn.commit()
-    conn.close()
-    return jsonify({'updated_count': updated_count}), 200
+    try:
+        start = _history_bound(request.args['start']) if request.args.get('start') else None
+        end = _history_bound(request.args['end'], end=True) if request.args.get('end') else None
+        limit = min(int(request.args.get('limit', HISTORY_MAX_POINTS)), HISTORY_MAX_POINTS)
+    except ValueError:
+        return jsonify({'error': 'Invalid start, end or limit'}), 400
+    if limit <= 0:
+        return jsonify({'error': 'Invalid start, end or limit'}), 400
+
+    conn = get_db_connection(readonly=True)
+    try:
+        history = get_account_history(conn, phone, start, end, limit)
+    finally:
+        conn.close()
+    if history is None:
+        return jsonify({'error': f'Account {phone} not found'}), 404
+    return jsonify(history), 200
+
+@app.route('/api/jobs', methods=['GET'])
+def ingest_queue_status():
+    if request.headers.get('Authorization') != f'Bearer {API_KEY}':
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    conn = get_db_connection(readonly=True)
+    try:
+        return jsonify(get_ingest_queue(conn)), 200
+    finally:
+        conn.close()
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def ingest_job_status(job_id):
+    if request.headers.get('Authorization') != f'Bearer {API_KEY}':
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    conn = get_db_connection(readonly=True)
+    try:
+        status = get_ingest_job(conn, job_id)
+    finally:
+        conn.close()
+    if status is None:
+        return jsonify({'error': f'Job {job_id} not found'}), 404
+    return jsonify(status), 200
+
+@app.route('/api/maintenance/compact', methods=['POST'])
+def maintenance_compact():
+    """
+    Сжатие лога закрытых кампаний. Необязательное JSON-тело: older_than_days, archive (false -
+    удалить лишние строки без архива), vacuum=true - затем полный VACUUM.
+    """
+    if request.headers.get('Authorization') != f'Bearer {API_KEY}':
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    options = request.get_json(silent=True) or {}
+    try:
+        older_than_days = int(options.get('older_than_days', LOG_COMPACT_AFTER_DAYS))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'older_than_days must be an integer'}), 400
+    if older_than_days < 0:
+        return jsonify({'error': 'older_than_days must be an integer'}), 400
+
+    result = compact_closed_campaigns(older_than_days, ARCHIVE_DATABASE_FILE if options.get('archive', True) else '')
+    if options.get('vacuum'):
+        result['vacuum'] = vacuum_database()
+    return jsonify(result), 200
 
 @app.route('/api/campaigns/edit/<int:campaign_id>', methods=['POST'])
 def api_edit_campaign(campaign_id):
@@ -289,11 +2635,17 @@ def api_edit_campaign(campaign_id):
     conn = get_db_connection()
     cursor = conn.cursor()
     try:
+        previous = cursor.execute("SELECT campaign_date, client_code FROM campaigns WHERE id = ?", (campaign_id,)).fetchone()
         cursor.execute('''
-            UPDATE campaigns SET name = ?, cost_per_message = ?, cost_per_invite = ?, message_type = ?, base_type = ?, link_type = ?, offer = ?
+            UPDATE campaigns SET name = ?, client_code = ?, cost_per_message = ?, cost_per_invite = ?, message_type = ?, base_type = ?, link_type = ?, offer = ?
             WHERE id = ?
-        ''', (data['name'], data['cost_per_message'], data['cost_per_invite'], data['message_type'], data['base_type'], data['link_type'], data['offer'], campaign_id))
+        ''', (data['name'], client_code_from_name(data['name']), data['cost_per_message'], data['cost_per_invite'], data['message_type'], data['base_type'], data['link_type'], data['offer'], campaign_id))
+        reprice_campaign_stats(conn, campaign_id)
+        if previous:
+            # Смена названия меняет клиента: прежняя группа дневных сводок теряет кампанию
+            refresh_rollup_group(conn, previous['campaign_date'], previous['client_code'])
         conn.commit()
+        data_changed()
         return jsonify({'message': 'Campaign updated successfully'}), 200
     except sqlite3.IntegrityError:
         return jsonify({'error': 'Campaign name already exists'}), 409
@@ -316,13 +2668,14 @@ def manage_campaigns():
         data = request.form
         try:
             cursor.execute(
-                '''INSERT INTO campaigns (name, campaign_date, cost_per_message, cost_per_invite, message_type, base_type, link_type, offer)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
-                (data['name'], datetime.now().strftime("%Y-%m-%d"),
+                '''INSERT INTO campaigns (name, client_code, campaign_date, cost_per_message, cost_per_invite, message_type, base_type, link_type, offer)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                (data['name'], client_code_from_name(data['name']), datetime.now().strftime("%Y-%m-%d"),
                  float(data['cost_per_message']), float(data['cost_per_invite']),
                  data.get('message_type'), data.get('base_type'), data.get('link_type'), data.get('offer'))
             )
             conn.commit()
+            data_changed()
         except sqlite3.IntegrityError:
             return "Campaign with this name already exists", 409
 
@@ -353,11 +2706,14 @@ def edit_campaign(campaign_id):
         data = request.form
         try:
             cursor.execute('''
-                UPDATE campaigns SET name = ?, cost_per_message = ?, cost_per_invite = ?, message_type = ?, base_type = ?, link_type = ?, offer = ?
+                UPDATE campaigns SET name = ?, client_code = ?, cost_per_message = ?, cost_per_invite = ?, message_type = ?, base_type = ?, link_type = ?, offer = ?
                 WHERE id = ?
-            ''', (data['name'], float(data['cost_per_message']), float(data['cost_per_invite']), data['message_type'], data['base_type'], data['link_type'], data['offer'], campaign_id))
+            ''', (data['name'], client_code_from_name(data['name']), float(data['cost_per_message']), float(data['cost_per_invite']), data['message_type'], data['base_type'], data['link_type'], data['offer'], campaign_id))
+            reprice_campaign_stats(conn, campaign_id)
+            refresh_rollup_group(conn, campaign['campaign_date'], campaign['client_code'])
             conn.commit()
             conn.close()
+            data_changed()
             return redirect(url_for('manage_campaigns'))
         except sqlite3.IntegrityError:
             return "Campaign name already exists", 409
@@ -369,23 +2725,26 @@ def edit_campaign(campaign_id):
     return render_template('campaign_edit.html', campaign=campaign, existing_offers=existing_offers)
 
 @app.route('/report/campaign', methods=['GET'])
+@cached_report
 def report_campaign():
-    conn = get_db_connection()
+    conn = get_db_connection(readonly=True)
     cursor = conn.cursor()
 
-    clients = sorted(set([c['name'].split('_')[0] for c in cursor.execute("SELECT name FROM campaigns").fetchall()]))
+    clients = [row['client_code'] for row in cursor.execute("SELECT DISTINCT client_code FROM campaigns ORDER BY client_code").fetchall()]
     selected_client = request.args.get('client_code')
     selected_campaign_name = request.args.get('campaign_name')
 
     if selected_client:
-        cursor.execute("SELECT name FROM campaigns WHERE name LIKE ?", (f"{selected_client}%",))
+        cursor.execute("SELECT name FROM campaigns WHERE client_code = ?", (selected_client,))
         campaigns_for_client = sorted([row['name'] for row in cursor.fetchall()])
 
         if selected_campaign_name:
             cursor.execute("SELECT id FROM campaigns WHERE name = ?", (selected_campaign_name,))
             campaign_id = cursor.fetchone()['id']
-            summary, results = calculate_campaign_stats(campaign_id, conn)
-            report_data = {'summary': summary, 'results': results}
+            # Строки аккаунтов страница загружает отдельно, постранично (report_campaign_accounts)
+            summary, _ = get_campaign_stats(campaign_id, conn, with_results=False)
+            report_data = {'summary': summary, 'campaign_id': campaign_id,
+                           'statuses': get_campaign_result_statuses(conn, campaign_id)}
         else:
             report_data = None
     else:
@@ -397,96 +2756,72 @@ def report_campaign():
                            campaigns_for_client=campaigns_for_client, selected_campaign_name=selected_campaign_name,
                            report_data=report_data)
 
+@app.route('/report/campaign/<int:campaign_id>/accounts', methods=['GET'])
+def report_campaign_accounts(campaign_id):
+    """
+    Строки таблицы аккаунтов отчета по кампании в формате server-side DataTables:
+    draw, start, length, order[0][column], order[0][dir], search[value] (начало номера)
+    и status (итоговый статус).
+    """
+    args = request.args
+    conn = get_db_connection(readonly=True)
+    try:
+        total, filtered, rows = get_campaign_results_page(
+            conn, campaign_id,
+            start=args.get('start', 0, type=int),
+            length=args.get('length', 50, type=int),
+            sort_column=args.get('order[0][column]', 0, type=int),
+            descending=args.get('order[0][dir]') == 'desc',
+            status=args.get('status'),
+            phone_prefix=args.get('search[value]', '').strip())
+    finally:
+        conn.close()
+    return jsonify({'draw': args.get('draw', 0, type=int), 'recordsTotal': total,
+                    'recordsFiltered': filtered, 'data': rows}), 200
+
+def _preset_period(period_param):
+    """Даты (начало, конец) для готовых периодов 'today', 'yesterday', 'week', 'month', 'quarter'; None для остальных."""
+    today = datetime.now().date()
+    if period_param == 'today':
+        return today, today
+    if period_param == 'yesterday':
+        return today - timedelta(days=1), today - timedelta(days=1)
+    if period_param == 'week':
+        return today - timedelta(days=6), today
+    if period_param == 'month':
+        return today - timedelta(days=29), today
+    if period_param == 'quarter':
+        return today - timedelta(days=89), today
+    return None
+
 @app.route('/report/period', methods=['GET'])
+@cached_report
 def report_period():
     period_param = request.args.get('period')
     start_date_str = request.args.get('start_date')
     end_date_str = request.args.get('end_date')
 
-    if period_param == 'today':
-        start_date = datetime.now().date()
-        end_date = start_date
-    elif period_param == 'yesterday':
-        start_date = datetime.now().date() - timedelta(days=1)
-        end_date = start_date
-    elif period_param == 'week':
-        end_date = datetime.now().date()
-        start_date = end_date - timedelta(days=6)
-    elif period_param == 'month':
-        end_date = datetime.now().date()
-        start_date = end_date - timedelta(days=29)
+    preset = _preset_period(period_param)
+    if preset:
+        start_date, end_date = preset
     elif start_date_str and end_date_str:
         start_date = datetime.strptime(start_date_str, '%Y-%m-%d').date()
         end_date = datetime.strptime(end_date_str, '%Y-%m-%d').date()
     else:
         return render_template('report_period.html')
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM campaigns WHERE campaign_date BETWEEN ? AND ? ORDER BY campaign_date DESC",
-                   (start_date.isoformat(), end_date.isoformat()))
-    campaigns_in_period = cursor.fetchall()
+    conn = get_db_connection(readonly=True)
+    period_summary, campaigns_in_period = aggregate_period_report(conn, start_date, end_date)
+    conn.close()
 
-    if not campaigns_in_period:
-        conn.close()
+    if not period_summary:
         return render_template('report_period.html', period=period_param, start_date_str=start_date.isoformat(), end_date_str=end_date.isoformat())
 
-    total_campaigns = len(campaigns_in_period)
-    unique_accounts = set()
-    total_revenue = 0
-    total_messages = 0
-    total_invites = 0
-    total_restricted_accounts = 0
-    total_messages_restricted = 0
-    total_revenue_restricted = 0
-
-    for campaign in campaigns_in_period:
-        summary, results = calculate_campaign_stats(campaign['id'], conn)
-        total_revenue += summary['total_revenue']
-        total_messages += summary['total_messages']
-        total_invites += summary['total_invites']
-        unique_accounts.update([res['phone'] for res in results])
-        restricted_phones = {res['phone'] for res in results if res['status_after'] not in ('Working', 'Temporary Spamblock (Resolved)')}
-        total_restricted_accounts += len(restricted_phones)
-        for res in results:
-            if res['phone'] in restricted_phones:
-                total_messages_restricted += res['msg_sent']
-                total_revenue_restricted += res['revenue']
-
-    total_unique_accounts = len(unique_accounts)
-    percentage_restricted = (total_restricted_accounts / total_unique_accounts * 100) if total_unique_accounts > 0 else 0
-    avg_revenue_per_account = total_revenue / total_unique_accounts if total_unique_accounts > 0 else 0
-    avg_messages_all_accounts = total_messages / total_unique_accounts if total_unique_accounts > 0 else 0
-    avg_messages_restricted_accounts = total_messages_restricted / total_restricted_accounts if total_restricted_accounts > 0 else 0
-    avg_revenue_per_restricted_account = total_revenue_restricted / total_restricted_accounts if total_restricted_accounts > 0 else 0
-
-    period_summary = {
-        'total_campaigns': total_campaigns,
-        'total_unique_accounts': total_unique_accounts,
-        'total_revenue': total_revenue,
-        'total_messages': total_messages,
-        'total_invites': total_invites,
-        'avg_revenue_per_account': avg_revenue_per_account,
-        'avg_messages_all_accounts': avg_messages_all_accounts,
-        'total_restricted_accounts': total_restricted_accounts,
-        'percentage_restricted': percentage_restricted,
-        'avg_revenue_per_restricted_account': avg_revenue_per_restricted_account,
-        'avg_messages_restricted_accounts': avg_messages_restricted_accounts
-    }
-
-    # Для совместимости с шаблоном, добавляем 'date' в каждый campaign
-    campaigns_in_period_with_date = []
-    for camp in campaigns_in_period:
-        camp_dict = dict(camp)
-        camp_dict['date'] = camp['campaign_date']
-        camp_dict['summary'] = calculate_campaign_stats(camp['id'], conn)[0]
-        campaigns_in_period_with_date.append(camp_dict)
-
-    conn.close()
-    return render_template('report_period.html', period_summary=period_summary, campaigns_in_period=campaigns_in_period_with_date,
+    return render_template('report_period.html', period_summary=period_summary, campaigns_in_period=campaigns_in_period,
                            start_date_str=start_date.isoformat(), end_date_str=end_date.isoformat())
 
 @app.route('/report/client', methods=['GET'])
+@cached_report
 def report_client():
     client_code = request.args.get('client_code')
     period_param = request.args.get('period')
@@ -499,181 +2834,298 @@ def report_client():
     if start_date_str and end_date_str:
         start_date = datetime.strptime(start_date_str, '%Y-%m-%d').date()
         end_date = datetime.strptime(end_date_str, '%Y-%m-%d').date()
-    elif period_param == 'today':
-        start_date = end_date = datetime.now().date()
-    elif period_param == 'yesterday':
-        start_date = end_date = datetime.now().date() - timedelta(days=1)
-    elif period_param == 'week':
-        end_date = datetime.now().date()
-        start_date = end_date - timedelta(days=6)
-    elif period_param == 'month':
-        end_date = datetime.now().date()
-        start_date = end_date - timedelta(days=29)
     else:
-        start_date = end_date = None
-
-    conn = get_db_connection()
-    cursor = conn.cursor()
-
-    query = "SELECT * FROM campaigns WHERE name LIKE ?"
-    params = (f"{client_code}%",)
-    if start_date and end_date:
-        query += " AND campaign_date BETWEEN ? AND ?"
-        params += (start_date.isoformat(), end_date.isoformat())
+        start_date, end_date = _preset_period(period_param) or (None, None)
 
-    cursor.execute(query, params)
-    campaigns = cursor.fetchall()
+    conn = get_db_connection(readonly=True)
+    client_summary, client_campaigns = aggregate_client_report(conn, client_code, start_date, end_date)
+    conn.close()
 
-    if not campaigns:
-        conn.close()
+    if not client_summary:
         return render_template('report_client.html', client_code=client_code, start_date_str=start_date_str, end_date_str=end_date_str)
 
-    unique_accounts = set()
-    total_revenue = 0
-    total_messages = 0
-    total_invites = 0
-    unique_restricted_accounts = set()
-    total_revenue_from_restricted = 0
-    total_messages_from_restricted = 0
-
-    client_campaigns = []
-    for camp in campaigns:
-        summary, results = calculate_campaign_stats(camp['id'], conn)
-        client_campaigns.append({
-            'name': camp['name'],
-            'date': camp['campaign_date'],
-            'total_revenue': summary['total_revenue'],
-            'total_messages': summary['total_messages'],
-            'total_invites': summary['total_invites'],
-            'accounts_in_report': len(results),
-            'percentage_restricted': summary['percentage_restricted'],
-            'avg_msg_all': summary['avg_msg_all'],
-            'avg_revenue_per_account': summary['avg_revenue_per_account']
-        })
-
-        for res in results:
-            unique_accounts.add(res['phone'])
-
-        restricted_in_camp = {res['phone'] for res in results if res['status_after'] not in ('Working', 'Temporary Spamblock (Resolved)')}
-        unique_restricted_accounts.update(restricted_in_camp)
-
-        for res in results:
-            if res['phone'] in restricted_in_camp:
-                total_revenue_from_restricted += res['revenue']
-                total_messages_from_restricted += res['msg_sent']
-
-        total_revenue += summary['total_revenue']
-        total_messages += summary['total_messages']
-        total_invites += summary['total_invites']
-
-    total_unique_accounts = len(unique_accounts)
-    total_restricted_accounts = len(unique_restricted_accounts)
-    percentage_restricted = (total_restricted_accounts / total_unique_accounts * 100) if total_unique_accounts > 0 else 0
-    avg_revenue_per_account = total_revenue / total_unique_accounts if total_unique_accounts > 0 else 0
-    avg_messages_all_accounts = total_messages / total_unique_accounts if total_unique_accounts > 0 else 0
-    avg_messages_restricted_accounts = total_messages_from_restricted / total_restricted_accounts if total_restricted_accounts > 0 else 0
-    avg_revenue_per_restricted_account = total_revenue_from_restricted / total_restricted_accounts if total_restricted_accounts > 0 else 0
-
-    client_summary = {
-        'client_code': client_code,
-        'total_campaigns': len(campaigns),
-        'total_unique_accounts': total_unique_accounts,
-        'total_messages': total_messages,
-        'total_invites': total_invites,
-        'total_revenue': total_revenue,
-        'avg_revenue_per_account': avg_revenue_per_account,
-        'total_restricted_accounts': total_restricted_accounts,
-        'percentage_restricted': percentage_restricted,
-        'avg_messages_all_accounts': avg_messages_all_accounts,
-        'avg_messages_restricted_accounts': avg_messages_restricted_accounts,
-        'avg_revenue_per_restricted_account': avg_revenue_per_restricted_account
-    }
-
-    conn.close()
     return render_template('report_client.html', client_summary=client_summary, client_campaigns=client_campaigns,
                            client_code=client_code, start_date_str=start_date_str, end_date_str=end_date_str)
 
+def warmup_bracket_names(boundaries=WARMUP_BRACKETS):
+    """Названия групп прогрева по верхним границам: (7, 14) -> ['0 - 7', '08 - 14', '15+']."""
+    names, lower = [], 0
+    for upper in boundaries:
+        names.append(f"{lower} - {upper}" if lower == 0 else f"{lower:02d} - {upper}")
+        lower = upper + 1
+    names.append(f"{lower}+")
+    return names
+
+@timed
+def aggregate_warmup_report(conn, boundaries=WARMUP_BRACKETS):
+    """
+    Сводка по группам прогрева (дни от регистрации до первой кампании) одним GROUP BY
+    по accounts.rest_days. Аккаунты с отрицательным отдыхом не учитываются, с датами,
+    которые не удалось разобрать, попадают в группу 'N/A' (она идет последней).
+    """
+    names = warmup_bracket_names(boundaries)
+    bracket_sql = "CASE WHEN rest_days IS NULL THEN -1 " + "".join(
+        f"WHEN rest_days <= ? THEN {i} " for i in range(len(boundaries))) + f"ELSE {len(boundaries)} END"
+    rows = conn.execute(f"""
+        SELECT {bracket_sql} AS bracket,
+               COUNT(*) AS account_count,
+               SUM(total_revenue) AS total_revenue,
+               SUM(total_messages) AS total_messages,
+               SUM(current_status = 'Working') AS working_count,
+               SUM(current_status IN ('Permanent Spamblock', 'Banned')) AS perm_spam_count,
+               SUM(current_status = 'Frozen') AS frozen_count
+        FROM accounts
+        WHERE registration_date IS NOT NULL
+          AND registration_date != 'N/A'
+          AND first_campaign_date IS NOT NULL
+          AND (rest_days IS NULL OR rest_days >= 0)
+        GROUP BY bracket
+    """, tuple(boundaries)).fetchall()
+
+    report_data = []
+    for row in sorted(rows, key=lambda r: r['bracket'] if r['bracket'] >= 0 else len(names)):
+        count = row['account_count']
+        report_data.append({
+            'bracket': names[row['bracket']] if row['bracket'] >= 0 else 'N/A',
+            'account_count': count,
+            'avg_ltv': row['total_revenue'] / count,
+            'avg_messages': row['total_messages'] / count,
+            'percent_working': (row['working_count'] / count) * 100,
+            'percent_perm_spam': (row['perm_spam_count'] / count) * 100,
+            'percent_frozen': (row['frozen_count'] / count) * 100
+        })
+    return report_data
+
 @app.route('/report/warmup')
+@cached_report
 def report_warmup():
-    conn = get_db_connection()
-    query = """
-    SELECT 
-        phone,
-        total_revenue,
-        total_messages,
-        current_status,
-        (JULIANDAY(first_campaign_date) - JULIANDAY(registration_date)) as rest_days
-    FROM 
-        accounts
-    WHERE 
-        registration_date IS NOT NULL 
-        AND registration_date != 'N/A'
-        AND first_campaign_date IS NOT NULL
-    """
-    accounts = conn.execute(query).fetchall()
+    conn = get_db_connection(readonly=True)
+    report_data = aggregate_warmup_report(conn)
     conn.close()
+    return render_template('report_warmup.html', report_data=report_data)
 
-    brackets = {
-        '0 - 7': {'total_revenue': 0, 'total_messages': 0, 'working_count': 0, 'perm_spam_count': 0, 'frozen_count': 0, 'accounts': []},
-        '08 - 14': {'total_revenue': 0, 'total_messages': 0, 'working_count': 0, 'perm_spam_count': 0, 'frozen_count': 0, 'accounts': []},
-        '15 - 30': {'total_revenue': 0, 'total_messages': 0, 'working_count': 0, 'perm_spam_count': 0, 'frozen_count': 0, 'accounts': []},
-        '31 - 60': {'total_revenue': 0, 'total_messages': 0, 'working_count': 0, 'perm_spam_count': 0, 'frozen_count': 0, 'accounts': []},
-        '61+': {'total_revenue': 0, 'total_messages': 0, 'working_count': 0, 'perm_spam_count': 0, 'frozen_count': 0, 'accounts': []},
-        'N/A': {'total_revenue': 0, 'total_messages': 0, 'working_count': 0, 'perm_spam_count': 0, 'frozen_count': 0, 'accounts': []},
-    }
+# ===============================================================
+# ВЫГРУЗКА ОТЧЕТОВ (CSV / PARQUET)
+# ===============================================================
+# Выгрузки читают БД курсором пачками и отдают ответ генератором: в памяти одновременно
+# только EXPORT_FETCH_SIZE строк (CSV) или одна группа строк Parquet, независимо от объема
+# выгрузки. Весь ответ строится на одном снимке БД (читающее соединение WAL).
+
+# (колонка файла, выражение SQL, тип)
+ACCOUNT_EXPORT_COLUMNS = (
+    ('campaign', 'c.name', 'str'),
+    ('campaign_date', 'c.campaign_date', 'str'),
+    ('phone', 'cas.account_phone', 'str'),
+    ('status_before', 'cas.status_before', 'str'),
+    ('status_after', 'cas.report_status', 'str'),
+    ('msg_sent', 'cas.msg_sent', 'int'),
+    ('inv_sent', 'cas.inv_sent', 'int'),
+    ('revenue', 'cas.revenue', 'float'),
+)
+CAMPAIGN_EXPORT_COLUMNS = (
+    ('campaign', 'c.name', 'str'),
+    ('client_code', 'c.client_code', 'str'),
+    ('campaign_date', 'c.campaign_date', 'str'),
+    ('cost_per_message', 'c.cost_per_message', 'float'),
+    ('cost_per_invite', 'c.cost_per_invite', 'float'),
+    ('accounts_in_report', 'COALESCE(s.accounts_in_report, 0)', 'int'),
+) + tuple((field, f'COALESCE(s.{field}, 0)', 'float' if field == 'total_revenue' else 'int')
+          for field in SUMMARY_COUNTER_FIELDS)
+
+ACCOUNT_EXPORT_FROM = "campaign_account_stats cas JOIN campaigns c ON c.id = cas.campaign_id"
+CAMPAIGN_EXPORT_FROM = "campaigns c LEFT JOIN campaign_stats_summary s ON s.campaign_id = c.id"
+EXPORT_FORMATS = ('csv', 'parquet')
+
+def iter_export_batches(query, params, batch_size):
+    """Строки запроса пачками по batch_size (кортежи). Соединение закрывается и при обрыве выгрузки."""
+    conn = get_db_connection(readonly=True)
+    # Выгрузка читает данные один раз подряд: без отображения файла в память и с маленьким
+    # кэшем страниц память процесса не растет с объемом выгрузки
+    conn.execute("PRAGMA mmap_size=0")
+    conn.execute(f"PRAGMA cache_size=-{EXPORT_CACHE_SIZE_KB}")
+    try:
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        cursor.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+        cursor.close()
+    finally:
+        conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+        conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+        conn.close()
 
-    for acc in accounts:
-        bracket_name = _get_warmup_bracket(acc['rest_days'])
-        
-        if bracket_name == 'N/A' and acc['rest_days'] is not None and acc['rest_days'] < 0:
-            continue
+def iter_csv(columns, batches):
+    """CSV в UTF-8 с BOM (чтобы Excel узнал кодировку), по куску на пачку строк."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([name for name, _, _ in columns])
+    yield '\ufeff' + buffer.getvalue()
+    for rows in batches:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(rows)
+        yield buffer.getvalue()
+
+class _ParquetSink(io.RawIOBase):
+    """Файл только для записи: накапливает байты, которые ParquetWriter записал с прошлого drain()."""
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def iter_parquet(columns, batches):
+    """Parquet по группе строк на пачку: каждая группа отдается клиенту сразу после записи."""
+    arrow_types = {'str': pa.string(), 'int': pa.int64(), 'float': pa.float64()}
+    schema = pa.schema([(name, arrow_types[kind]) for name, _, kind in columns])
+    sink = _ParquetSink()
+    writer = pq.ParquetWriter(sink, schema)
+    for rows in batches:
+        table = pa.Table.from_arrays(
+            [pa.array(values, type=field.type) for values, field in zip(zip(*rows), schema)], schema=schema)
+        writer.write_table(table)
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+def export_response(columns, table_sql, where, params, order_by, filename):
+    """Потоковый ответ с выгрузкой в формате ?format= (csv по умолчанию, parquet при наличии pyarrow)."""
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'error': f"Unknown format {export_format}, expected one of {', '.join(EXPORT_FORMATS)}"}), 400
+    if export_format == 'parquet' and pa is None:
+        return jsonify({'error': 'Parquet export requires pyarrow to be installed on the server'}), 501
+
+    query = f"SELECT {', '.join(expression for _, expression, _ in columns)} FROM {table_sql}{where} ORDER BY {order_by}"
+    filename = re.sub(r'[^\w.-]+', '_', f"{filename}.{export_format}")
+    headers = {'Content-Disposition': f'attachment; filename="{filename}"'}
+    if export_format == 'parquet':
+        body = iter_parquet(columns, iter_export_batches(query, params, EXPORT_PARQUET_ROW_GROUP))
+        return Response(stream_with_context(body), mimetype='application/vnd.apache.parquet', headers=headers)
+    body = iter_csv(columns, iter_export_batches(query, params, EXPORT_FETCH_SIZE))
+    return Response(stream_with_context(body), mimetype='text/csv', headers=headers)
+
+@app.route('/export/campaign/<int:campaign_id>', methods=['GET'])
+def export_campaign(campaign_id):
+    """Итоги аккаунтов кампании (как таблица отчета по кампании)."""
+    conn = get_db_connection(readonly=True)
+    campaign = conn.execute("SELECT name FROM campaigns WHERE id = ?", (campaign_id,)).fetchone()
+    conn.close()
+    if not campaign:
+        return jsonify({'error': f'Campaign {campaign_id} not found'}), 404
+    return export_response(ACCOUNT_EXPORT_COLUMNS, ACCOUNT_EXPORT_FROM, " WHERE cas.campaign_id = ?", [campaign_id],
+                           "cas.account_phone", f"campaign_{campaign['name']}")
 
-        b = brackets[bracket_name]
-        b['accounts'].append(acc['phone'])
-        b['total_revenue'] += acc['total_revenue']
-        b['total_messages'] += acc['total_messages']
-        
-        if acc['current_status'] == 'Working':
-            b['working_count'] += 1
-        elif acc['current_status'] == 'Permanent Spamblock' or acc['current_status'] == 'Banned':
-            b['perm_spam_count'] += 1
-        elif acc['current_status'] == 'Frozen':
-            b['frozen_count'] += 1
+def _export_selection(where, params, order_by, filename):
+    """
+    Выгрузка выборки кампаний: ?detail=campaigns (строка на кампанию) или accounts (строка на аккаунт
+    в кампании). order_by должен совпадать с порядком индекса кампаний (дата, id), тогда аккаунты
+    читаются по первичному ключу уже упорядоченными и SQLite не сортирует всю выгрузку.
+    """
+    detail = request.args.get('detail', 'campaigns')
+    if detail == 'accounts':
+        return export_response(ACCOUNT_EXPORT_COLUMNS, ACCOUNT_EXPORT_FROM, where, params,
+                               f"{order_by}, cas.account_phone", f"{filename}_accounts")
+    if detail == 'campaigns':
+        return export_response(CAMPAIGN_EXPORT_COLUMNS, CAMPAIGN_EXPORT_FROM, where, params, order_by, filename)
+    return jsonify({'error': f'Unknown detail {detail}, expected campaigns or accounts'}), 400
+
+@app.route('/export/period', methods=['GET'])
+def export_period():
+    """Кампании за период (period= или start_date/end_date, как в /report/period)."""
+    start_date_str = request.args.get('start_date')
+    end_date_str = request.args.get('end_date')
+    preset = _preset_period(request.args.get('period'))
+    if preset:
+        start_date, end_date = preset
+    elif start_date_str and end_date_str:
+        start_date = datetime.strptime(start_date_str, '%Y-%m-%d').date()
+        end_date = datetime.strptime(end_date_str, '%Y-%m-%d').date()
+    else:
+        return jsonify({'error': 'period or start_date and end_date are required'}), 400
 
-    report_data = []
-    for name, data in brackets.items():
-        count = len(data['accounts'])
-        if count == 0:
-            continue
+    where, params = _campaign_filter(start_date, end_date)
+    return _export_selection(where, params, "c.campaign_date DESC, c.id DESC",
+                             f"period_{start_date.isoformat()}_{end_date.isoformat()}")
 
-        report_data.append({
-            'bracket': name,
-            'account_count': count,
-            'avg_ltv': data['total_revenue'] / count,
-            'avg_messages': data['total_messages'] / count,
-            'percent_working': (data['working_count'] / count) * 100,
-            'percent_perm_spam': (data['perm_spam_count'] / count) * 100,
-            'percent_frozen': (data['frozen_count'] / count) * 100
-        })
+@app.route('/export/client', methods=['GET'])
+def export_client():
+    """Кампании клиента, по желанию за период (параметры как в /report/client)."""
+    client_code = request.args.get('client_code')
+    if not client_code:
+        return jsonify({'error': 'client_code is required'}), 400
+    start_date_str = request.args.get('start_date')
+    end_date_str = request.args.get('end_date')
+    if start_date_str and end_date_str:
+        start_date = datetime.strptime(start_date_str, '%Y-%m-%d').date()
+        end_date = datetime.strptime(end_date_str, '%Y-%m-%d').date()
+    else:
+        start_date, end_date = _preset_period(request.args.get('period')) or (None, None)
 
-    return render_template('report_warmup.html', report_data=report_data)
+    where, params = _campaign_filter(start_date, end_date, client_code=client_code)
+    filename = f"client_{client_code}" + (f"_{start_date.isoformat()}_{end_date.isoformat()}" if start_date else "")
+    return _export_selection(where, params, "c.campaign_date, c.id", filename)
 
-def _get_warmup_bracket(rest_days):
-    if rest_days is None or rest_days < 0:
-        return 'N/A'
-    if rest_days <= 7:
-        return '0 - 7'
-    if rest_days <= 14:
-        return '08 - 14'
-    if rest_days <= 30:
-        return '15 - 30'
-    if rest_days <= 60:
-        return '31 - 60'
-    return '61+'
+# ===============================================================
+#  МЕТРИКИ (ЗАМЕР ЗАПРОСОВ И ОТДАЧА)
+# ===============================================================
+@app.before_request
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+    g.db_seconds = 0.0
+    g.db_statements = 0
+
+@app.after_request
+def _record_request_timing(response):
+    """Время маршрута в гистограмму; для потоковых ответов (выгрузки) - время до заголовков."""
+    started = g.get('request_started')
+    if not METRICS_ENABLED or started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    metrics.observe('http_request_duration_seconds',
+                    (('method', request.method), ('route', route), ('status', str(response.status_code))), elapsed)
+    if SERVER_TIMING_HEADER:
+        response.headers['Server-Timing'] = (
+            f'app;dur={elapsed * 1000:.1f}, '
+            f'db;dur={g.db_seconds * 1000:.1f};desc="{g.db_statements} statements"')
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Метрики в текстовом формате Prometheus."""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/api/metrics/slow_queries', methods=['GET'])
+def api_slow_queries():
+    """Последние медленные запросы (дольше SLOW_QUERY_MS) с планами, новые первыми."""
+    if request.headers.get('Authorization') != f'Bearer {API_KEY}':
+        return jsonify({'error': 'Unauthorized'}), 401
+    return jsonify({'threshold_ms': SLOW_QUERY_MS, 'queries': list(reversed(slow_queries))})
 
 # ===============================================================
 # ЗАПУСК ПРИЛОЖЕНИЯ
 # ===============================================================
 if __name__ == '__main__':
     init_db() 
+    ingest_writer.start()  # досписывает задания, оставшиеся в очереди с прошлого запуска
     app.run(host='0.0.0.0', port=5000, debug=False)
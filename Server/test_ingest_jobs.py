@@ -0,0 +1,106 @@
+"""
+Ключ идемпотентности снимка в очереди фоновой записи: строки, записанные заданием, несут ключ,
+поэтому повтор синхронным запросом или новым заданием после сбоя не пишет аккаунты второй раз.
+
+Запуск из папки Server:
+    python -m pytest -q test_ingest_jobs.py
+    python -m unittest test_ingest_jobs
+"""
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+import server
+
+CAMPAIGN = 'AA_1'
+ACCOUNT_COUNT = 10
+
+class AsyncIdempotencyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (server.DATABASE_FILE, server.INGEST_BATCH_SIZE)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        server.close_db_pools()
+        server.DATABASE_FILE = os.path.join(self.tmp_dir.name, 'test.db')
+        server.INGEST_BATCH_SIZE = 4
+        server.init_db()
+        # Задания применяются в тесте вызовом process_batch, без фонового потока
+        patcher = mock.patch.object(server.ingest_writer, 'start')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = server.app.test_client()
+        self.headers = {'Authorization': f'Bearer {server.API_KEY}'}
+        self.client.post('/api/campaigns', headers=self.headers,
+                         json={'campaign_name': CAMPAIGN, 'cost_per_message': 1.5, 'cost_per_invite': 2.0})
+        self.accounts = [{'phone': f"7{i:010d}", 'registration_date': '2024-01-01', 'status': 'Working',
+                          'messages_sent': i, 'invites_sent': 1} for i in range(ACCOUNT_COUNT)]
+
+    def tearDown(self):
+        server.close_db_pools()
+        server.DATABASE_FILE, server.INGEST_BATCH_SIZE = self.saved
+        self.tmp_dir.cleanup()
+
+    def post_async(self, key):
+        response = self.client.post('/api/snapshot?async=1', headers=dict(self.headers, **{'Idempotency-Key': key}),
+                                    json={'campaign_name': CAMPAIGN, 'snapshot_type': 'before', 'accountsList': self.accounts})
+        self.assertEqual(response.status_code, 202)
+        return response.get_json()['job_id']
+
+    def drain_queue(self):
+        while server.ingest_writer.process_batch():
+            pass
+
+    def job(self, job_id):
+        return self.client.get(f'/api/jobs/{job_id}', headers=self.headers).get_json()
+
+    def log_rows(self):
+        conn = server.get_db_connection(readonly=True)
+        try:
+            return conn.execute("SELECT account_phone, idempotency_key FROM campaign_log ORDER BY log_id").fetchall()
+        finally:
+            conn.close()
+
+    def test_sync_retry_after_async_ingest(self):
+        job_id = self.post_async('key-1')
+        self.drain_queue()
+        self.assertEqual(self.job(job_id)['status'], 'done')
+        self.assertEqual({row['idempotency_key'] for row in self.log_rows()}, {'key-1'})
+
+        response = self.client.post('/api/snapshot', headers=dict(self.headers, **{'Idempotency-Key': 'key-1'}),
+                                    json={'campaign_name': CAMPAIGN, 'snapshot_type': 'before', 'accountsList': self.accounts})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['duplicate_count'], ACCOUNT_COUNT)
+        self.assertEqual(len(self.log_rows()), ACCOUNT_COUNT)
+
+    def test_resubmit_after_job_failed_midway(self):
+        real_ingest = server.bulk_ingest_snapshot
+        calls = []
+
+        def fail_on_second_batch(*args, **kwargs):
+            calls.append(1)
+            if len(calls) == 2:
+                raise sqlite3.OperationalError("сбой записи")
+            return real_ingest(*args, **kwargs)
+
+        failed_job = self.post_async('key-2')
+        with mock.patch.object(server, 'bulk_ingest_snapshot', side_effect=fail_on_second_batch):
+            self.drain_queue()
+        self.assertEqual(self.job(failed_job)['status'], 'failed')
+        # Первая пачка (INGEST_BATCH_SIZE аккаунтов) записана до сбоя
+        self.assertEqual(len(self.log_rows()), server.INGEST_BATCH_SIZE)
+
+        retry_job = self.post_async('key-2')
+        self.assertNotEqual(retry_job, failed_job)
+        self.assertEqual(self.post_async('key-2'), retry_job)
+        self.drain_queue()
+        job = self.job(retry_job)
+        self.assertEqual(job['status'], 'done')
+        self.assertEqual(job['result']['processed_count'], ACCOUNT_COUNT - server.INGEST_BATCH_SIZE)
+        self.assertEqual(job['result']['duplicate_count'], server.INGEST_BATCH_SIZE)
+        self.assertEqual(sorted(row['account_phone'] for row in self.log_rows()),
+                         [account['phone'] for account in self.accounts])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+"""
+Векторный расчет статистики кампании (numpy) должен давать тот же результат, что и построчный
+_campaign_stats_python, в том числе когда numpy не установлен.
+
+Запуск из папки Server:
+    python -m pytest -q test_stats.py
+    python -m unittest test_stats
+"""
+import os
+import random
+import tempfile
+import unittest
+from unittest import mock
+
+import server
+
+SNAPSHOT_TYPES = ['before', 'after_immediate', 'after_day_2', 'status_update']
+LOG_STATUSES = ['Working', 'Working', 'Working', 'Frozen', 'Temporary Spamblock', 'Permanent Spamblock', 'Banned']
+RANDOM_LOGS = 300
+
+class CampaignStatsEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (server.DATABASE_FILE, server.STATS_ENGINE)
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        server.close_db_pools()
+        server.DATABASE_FILE = os.path.join(self.tmp_dir.name, 'test.db')
+        server.init_db()
+        self.conn = server.get_db_connection()
+        self.rnd = random.Random(5)
+
+    def tearDown(self):
+        self.conn.close()
+        server.close_db_pools()
+        server.DATABASE_FILE, server.STATS_ENGINE = self.saved
+        self.tmp_dir.cleanup()
+
+    def random_campaign(self, number, counter=int):
+        """Случайный лог кампании: повторы снимков одного типа, пропуски 'ДО'/'ПОСЛЕ', нулевые дельты."""
+        rnd = self.rnd
+        cursor = self.conn.execute(
+            "INSERT INTO campaigns (name, client_code, campaign_date, cost_per_message, cost_per_invite) VALUES (?, ?, ?, ?, ?)",
+            (f"AA_{number}", 'AA', '2024-01-01', rnd.choice([0.5, 1.5, 0.1]), rnd.choice([0.0, 2.0, 0.3])))
+        campaign_id = cursor.lastrowid
+        phones = [f"7{i:010d}" for i in range(rnd.randint(1, 40))]
+        self.conn.executemany(
+            "INSERT INTO campaign_log (campaign_id, account_phone, snapshot_type, messages_count, invites_count, status, timestamp) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            ((campaign_id, rnd.choice(phones), rnd.choice(SNAPSHOT_TYPES), counter(rnd.randint(0, 30)),
+              counter(rnd.randint(0, 3)), rnd.choice(LOG_STATUSES), '2024-01-01T00:00:00')
+             for _ in range(rnd.randint(0, 200))))
+        self.conn.commit()
+        return campaign_id
+
+    def python_stats(self, campaign_id):
+        logs = self.conn.execute(
+            "SELECT account_phone, snapshot_type, messages_count, invites_count, status FROM campaign_log "
+            "WHERE campaign_id = ? ORDER BY log_id", (campaign_id,)).fetchall()
+        costs = self.conn.execute("SELECT cost_per_message, cost_per_invite FROM campaigns WHERE id = ?",
+                                  (campaign_id,)).fetchone()
+        return server._campaign_stats_python(logs, costs)
+
+    def assert_engine_matches_python(self, counter=int):
+        server.STATS_ENGINE = 'numpy'
+        for number in range(RANDOM_LOGS):
+            campaign_id = self.random_campaign(number, counter)
+            with self.subTest(campaign_id=campaign_id):
+                self.assertEqual(server.calculate_campaign_stats(campaign_id, self.conn), self.python_stats(campaign_id))
+
+    @unittest.skipIf(server.np is None, "numpy не установлен")
+    def test_numpy_matches_python(self):
+        self.assert_engine_matches_python()
+
+    @unittest.skipIf(server.np is None, "numpy не установлен")
+    def test_numpy_falls_back_on_float_counters(self):
+        # Целые значения с плавающей точкой столбец INTEGER хранит как целые, поэтому дробные
+        self.assert_engine_matches_python(counter=lambda value: value + 0.5)
+
+    def test_without_numpy(self):
+        with mock.patch.object(server, 'np', None):
+            self.assert_engine_matches_python()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,15 @@
 import os
+import gzip
 import json
+import random
 import shutil
+import time
+import uuid
+import logging
 import requests
 import sqlite3
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from datetime import datetime, timezone
 
 # ===============================================================
@@ -15,6 +22,26 @@ LOCAL_DB_FILE = 'client_database.db'
 DEAD_AFTER_CAMPAIGN_FOLDER = 'accounts/Мертвые после рассылки'  # Для снимков кампаний
 DEAD_PERMANENT_FOLDER = 'accounts/Мертвые'  # Для режима 4
 
+# --- Сканирование файлов аккаунтов ---
+SCAN_WORKERS = min(32, (os.cpu_count() or 1) * 2)  # 1 - читать файлы последовательно
+SCAN_USE_PROCESSES = False  # True - пул процессов вместо потоков (выгоднее на очень больших деревьях)
+SCAN_PARALLEL_THRESHOLD = 64  # меньше файлов читаем без пула
+PARSE_CACHE_ENABLED = True  # неизмененные файлы (по mtime и размеру) берутся из file_cache в локальной БД
+
+# --- Отправка на сервер ---
+HTTP_POOL_SIZE = 4  # keep-alive соединений с сервером
+HTTP_RETRIES = 3  # повторов идемпотентных запросов при сбое связи или ответе 502/503/504
+HTTP_BACKOFF_BASE = 0.5  # секунд перед первым повтором, дальше удваивается (со случайным разбросом)
+HTTP_BACKOFF_MAX = 8
+HTTP_LOG_FILE = 'analyzer_http.log'  # журнал времени запросов к серверу (None - не вести)
+STATUS_UPDATE_CHUNK_SIZE = 500  # мертвых аккаунтов в одном запросе /api/snapshot/batch
+UPDATE_ALL_ASYNC = True  # полное обновление через очередь сервера (ответ 202 и ожидание задания)
+JOB_POLL_INTERVAL = 2  # секунд между проверками состояния задания на сервере
+UPLOAD_CHUNK_SIZE = 2000  # аккаунтов в одной части при загрузке снимка
+UPLOAD_RETRIES = 5  # попыток продолжить загрузку после обрыва связи
+UPLOAD_RETRY_DELAY = 2  # секунд, растет с каждой попыткой
+DELTA_UPDATES = True  # режим 4 отправляет только аккаунты, изменившиеся с прошлой подтвержденной отправки
+
 # --- Глобальная переменная для запоминания последней рассылки ---
 last_campaign_name = None
 
@@ -30,57 +57,348 @@ def is_path_inside_folder(path, folder):
     except ValueError:
         return False
 
+# ===============================================================
+# HTTP-КЛИЕНТ
+# ===============================================================
+# Все запросы к серверу идут через одну сессию requests: соединения переиспользуются
+# (keep-alive), идемпотентные запросы повторяются с экспоненциальной задержкой.
+RETRY_STATUS_CODES = (502, 503, 504)
+
+http_log = logging.getLogger('analyzer.http')
+_http_session = None
+
+def setup_http_log():
+    """Включает запись времени запросов в HTTP_LOG_FILE."""
+    if not HTTP_LOG_FILE:
+        return
+    handler = logging.FileHandler(HTTP_LOG_FILE, encoding='utf-8')
+    handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    http_log.addHandler(handler)
+    http_log.setLevel(logging.INFO)
+
+def get_http_session():
+    global _http_session
+    if _http_session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers.update(HEADERS)
+        _http_session = session
+    return _http_session
+
+def api_request(method, path, idempotent=False, **kwargs):
+    """
+    Выполняет запрос к серверу (path - например '/api/campaigns'), kwargs передаются в requests.
+    idempotent=True - запрос можно безопасно повторить: при сбое связи или 502/503/504 делается
+    до HTTP_RETRIES повторов. Исключение requests.exceptions.RequestException пробрасывается дальше.
+    """
+    session = get_http_session()
+    attempts = 1 + (HTTP_RETRIES if idempotent else 0)
+    for attempt in range(1, attempts + 1):
+        started = time.perf_counter()
+        try:
+            response = session.request(method, f"{SERVER_URL}{path}", **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as exc:
+            http_log.info("%s %s -> %s, %.1f мс (попытка %d/%d)", method, path, type(exc).__name__,
+                          (time.perf_counter() - started) * 1000, attempt, attempts)
+            if attempt == attempts:
+                raise
+        else:
+            http_log.info("%s %s -> %d, %.1f мс (попытка %d/%d)", method, path, response.status_code,
+                          (time.perf_counter() - started) * 1000, attempt, attempts)
+            if response.status_code not in RETRY_STATUS_CODES or attempt == attempts:
+                return response
+        delay = min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * 2 ** (attempt - 1))
+        time.sleep(random.uniform(delay / 2, delay))
+
 # ===============================================================
 # ЛОКАЛЬНАЯ БАЗА ДАННЫХ
 # ===============================================================
+LOCAL_DB_VERSION = 1  # PRAGMA user_version локальной БД
+
 def init_local_db():
-    """Создает локальную БД и таблицу для хранения состава кампаний."""
+    """Создает локальную БД: список кампаний, состав кампаний, кэш разбора файлов и отправленное состояние."""
     conn = sqlite3.connect(LOCAL_DB_FILE)
     cursor = conn.cursor()
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS local_campaigns (
         campaign_name TEXT PRIMARY KEY,
-        scan_date TEXT NOT NULL,
-        associated_accounts TEXT NOT NULL
+        scan_date TEXT NOT NULL
     )
     ''')
+    create_campaign_members_table(cursor)
+    create_file_cache_table(cursor)
+    create_sent_state_table(cursor)
     conn.commit()
+    migrate_local_db(conn)
     conn.close()
 
+def create_campaign_members_table(cursor):
+    """Состав кампаний: одна строка на (кампания, телефон), scan_date продублирована для поиска по телефону."""
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS campaign_members (
+        campaign_name TEXT NOT NULL,
+        phone TEXT NOT NULL,
+        scan_date TEXT NOT NULL,
+        PRIMARY KEY (campaign_name, phone)
+    )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_campaign_members_phone ON campaign_members (phone, scan_date)")
+
+def migrate_local_db(conn):
+    """Переводит локальную БД старого формата (JSON-список телефонов в local_campaigns) на campaign_members."""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version >= LOCAL_DB_VERSION:
+        return
+
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(local_campaigns)")]
+    conn.execute("BEGIN")
+    try:
+        if 'associated_accounts' in columns:
+            rows = conn.execute("SELECT campaign_name, scan_date, associated_accounts FROM local_campaigns").fetchall()
+            conn.executemany(
+                "INSERT OR IGNORE INTO campaign_members (campaign_name, phone, scan_date) VALUES (?, ?, ?)",
+                ((campaign_name, phone, scan_date)
+                 for campaign_name, scan_date, associated_accounts in rows
+                 for phone in json.loads(associated_accounts))
+            )
+            # Пересоздаем таблицу без JSON-колонки, сохраняя rowid (порядок сохранения кампаний)
+            conn.execute('''
+            CREATE TABLE local_campaigns_new (
+                campaign_name TEXT PRIMARY KEY,
+                scan_date TEXT NOT NULL
+            )
+            ''')
+            conn.execute("INSERT INTO local_campaigns_new (rowid, campaign_name, scan_date) "
+                         "SELECT rowid, campaign_name, scan_date FROM local_campaigns")
+            conn.execute("DROP TABLE local_campaigns")
+            conn.execute("ALTER TABLE local_campaigns_new RENAME TO local_campaigns")
+            print(f"ℹ️ Локальная БД обновлена: состав {len(rows)} кампаний перенесен в campaign_members.")
+        conn.execute(f"PRAGMA user_version = {LOCAL_DB_VERSION}")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
 def save_campaign_locally(campaign_name, accounts_list):
     """Сохраняет или обновляет информацию о кампании в локальной БД."""
     conn = sqlite3.connect(LOCAL_DB_FILE)
     cursor = conn.cursor()
-    phone_numbers = json.dumps([acc['phone'] for acc in accounts_list])
     scan_date = datetime.now().strftime("%Y-%m-%d")
     
     cursor.execute(
-        "INSERT OR REPLACE INTO local_campaigns (campaign_name, scan_date, associated_accounts) VALUES (?, ?, ?)",
-        (campaign_name, scan_date, phone_numbers)
+        "INSERT OR REPLACE INTO local_campaigns (campaign_name, scan_date) VALUES (?, ?)",
+        (campaign_name, scan_date)
+    )
+    cursor.execute("DELETE FROM campaign_members WHERE campaign_name = ?", (campaign_name,))
+    cursor.executemany(
+        "INSERT OR IGNORE INTO campaign_members (campaign_name, phone, scan_date) VALUES (?, ?, ?)",
+        ((campaign_name, acc['phone'], scan_date) for acc in accounts_list)
     )
     conn.commit()
     conn.close()
     print(f"ℹ️ Информация о составе кампании '{campaign_name}' ({len(accounts_list)} акк.) сохранена/обновлена локально.")
 
+def get_campaign_members(campaign_name):
+    """Возвращает множество телефонов кампании или None, если кампании нет в локальной БД."""
+    conn = sqlite3.connect(LOCAL_DB_FILE)
+    cursor = conn.cursor()
+    cursor.execute("SELECT 1 FROM local_campaigns WHERE campaign_name = ?", (campaign_name,))
+    if not cursor.fetchone():
+        conn.close()
+        return None
+    cursor.execute("SELECT phone FROM campaign_members WHERE campaign_name = ?", (campaign_name,))
+    phones = {row[0] for row in cursor.fetchall()}
+    conn.close()
+    return phones
+
+def get_last_campaigns_for_accounts(phones):
+    """
+    Находит последнюю кампанию (по max scan_date) сразу для многих аккаунтов одним запросом.
+    Возвращает словарь {phone: campaign_name}; аккаунтов без кампаний в нем нет.
+    """
+    conn = sqlite3.connect(LOCAL_DB_FILE)
+    cursor = conn.cursor()
+    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS lookup_phones (phone TEXT PRIMARY KEY)")
+    cursor.executemany("INSERT OR IGNORE INTO lookup_phones (phone) VALUES (?)", ((phone,) for phone in phones))
+    # При равной дате побеждает кампания, сохраненная раньше (меньший rowid), как в прежнем переборе
+    cursor.execute('''
+        SELECT phone, campaign_name FROM (
+            SELECT cm.phone, cm.campaign_name,
+                   ROW_NUMBER() OVER (PARTITION BY cm.phone ORDER BY cm.scan_date DESC, lc.rowid) AS rn
+            FROM lookup_phones lp
+            JOIN campaign_members cm ON cm.phone = lp.phone
+            JOIN local_campaigns lc ON lc.campaign_name = cm.campaign_name
+        ) WHERE rn = 1
+    ''')
+    last_campaigns = dict(cursor.fetchall())
+    conn.close()
+    return last_campaigns
+
 def get_last_campaign_for_account(phone):
     """Находит последнюю кампанию для аккаунта по max scan_date."""
+    return get_last_campaigns_for_accounts([phone]).get(phone)
+
+# ===============================================================
+# КЭШ РАЗБОРА ФАЙЛОВ АККАУНТОВ
+# ===============================================================
+# Типы, которые SQLite хранит без потерь; остальные значения (списки, словари, bool) не кэшируем
+CACHEABLE_TYPES = (str, int, float, type(None))
+
+def create_file_cache_table(cursor):
+    """Кэш разобранных JSON-файлов: ключ - абсолютный путь, актуальность проверяется по (mtime_ns, size)."""
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS file_cache (
+        path TEXT PRIMARY KEY,
+        mtime_ns INTEGER NOT NULL,
+        size INTEGER NOT NULL,
+        registration_date,
+        spamblock,
+        freeze_until,
+        messages_sent,
+        invites_sent
+    )
+    ''')
+
+def open_parse_cache():
+    conn = sqlite3.connect(LOCAL_DB_FILE)
+    create_file_cache_table(conn.cursor())
+    return conn
+
+def file_signature(filepath):
+    """(mtime_ns, size) файла или None, если файл недоступен."""
+    try:
+        st = os.stat(filepath)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+def load_cached_fields(conn, keys, signatures):
+    """Возвращает поля из кэша для файлов с совпадающими (mtime_ns, size), иначе None - файл надо прочитать."""
+    cursor = conn.cursor()
+    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS scan_paths (path TEXT PRIMARY KEY)")
+    cursor.execute("DELETE FROM scan_paths")
+    cursor.executemany("INSERT OR IGNORE INTO scan_paths (path) VALUES (?)", ((key,) for key in keys))
+    cursor.execute('''
+        SELECT fc.path, fc.mtime_ns, fc.size, fc.registration_date, fc.spamblock, fc.freeze_until,
+               fc.messages_sent, fc.invites_sent
+        FROM file_cache fc JOIN scan_paths sp ON sp.path = fc.path
+    ''')
+    cached = {row[0]: row[1:] for row in cursor.fetchall()}
+
+    result = []
+    for key, signature in zip(keys, signatures):
+        row = cached.get(key)
+        if signature is None or row is None or (row[0], row[1]) != signature:
+            result.append(None)
+            continue
+        result.append({
+            "registration_date": row[2],
+            "spamblock": row[3],
+            "freeze_until": row[4],
+            "messages_sent": row[5],
+            "invites_sent": row[6]
+        })
+    return result
+
+def store_cached_fields(conn, entries):
+    """Сохраняет в кэш только что разобранные файлы. entries - тройки (путь, (mtime_ns, size), поля)."""
+    rows = []
+    stale = []
+    for key, signature, fields in entries:
+        if signature is None or fields is None or not all(
+                type(value) in CACHEABLE_TYPES for value in fields.values()):
+            stale.append((key,))
+            continue
+        rows.append((key, signature[0], signature[1], fields["registration_date"], fields["spamblock"],
+                     fields["freeze_until"], fields["messages_sent"], fields["invites_sent"]))
+    cursor = conn.cursor()
+    cursor.executemany("DELETE FROM file_cache WHERE path = ?", stale)
+    cursor.executemany('''
+        INSERT OR REPLACE INTO file_cache
+            (path, mtime_ns, size, registration_date, spamblock, freeze_until, messages_sent, invites_sent)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ''', rows)
+
+def prune_parse_cache(conn):
+    """Удаляет из кэша файлы, которых нет среди только что просканированных (таблица scan_paths)."""
+    conn.execute("DELETE FROM file_cache WHERE path NOT IN (SELECT path FROM scan_paths)")
+
+# ===============================================================
+# ДЕЛЬТА-ОТПРАВКА
+# ===============================================================
+# sent_state - значения, которые сервер последними подтвердил для номера. Область (scope)
+# 'update_all' соответствует строке таблицы accounts на сервере, 'status_update:<кампания>' -
+# последнему status_update номера в кампании. Повторно отправляются только отличающиеся аккаунты.
+UPDATE_ALL_SCOPE = 'update_all'
+SENT_FIELDS = ('registration_date', 'status', 'messages_sent', 'invites_sent')
+
+def status_update_scope(campaign_name):
+    return f"status_update:{campaign_name}"
+
+def create_sent_state_table(cursor):
+    """Колонки значений без типа: SQLite не приводит их, и сравнение с данными файла идет без потерь."""
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS sent_state (
+        scope TEXT NOT NULL,
+        phone TEXT NOT NULL,
+        registration_date,
+        status,
+        messages_sent,
+        invites_sent,
+        sent_at TEXT NOT NULL,
+        PRIMARY KEY (scope, phone)
+    ) WITHOUT ROWID
+    ''')
+
+def last_per_phone(accounts_list):
+    """Оставляет по одной записи на номер - последнюю, как и в итоговом состоянии на сервере."""
+    latest = {}
+    for acc in accounts_list:
+        latest.pop(acc['phone'], None)
+        latest[acc['phone']] = acc
+    return list(latest.values())
+
+def filter_changed_accounts(scope, accounts_list):
+    """Возвращает аккаунты, которые в scope еще не отправлялись или отправлялись с другими значениями."""
+    conn = sqlite3.connect(LOCAL_DB_FILE)
+    create_sent_state_table(conn.cursor())
+    rows = conn.execute(f"SELECT phone, {', '.join(SENT_FIELDS)} FROM sent_state WHERE scope = ?", (scope,)).fetchall()
+    conn.close()
+    sent = {row[0]: row[1:] for row in rows}
+    return [acc for acc in accounts_list if sent.get(acc['phone']) != tuple(acc[field] for field in SENT_FIELDS)]
+
+def record_sent_accounts(scope, accounts_list):
+    """Запоминает аккаунты, запись которых сервер подтвердил. Значения, которые SQLite исказит, не запоминаются."""
+    sent_at = datetime.now().isoformat()
+    rows = []
+    stale = []
+    for acc in accounts_list:
+        values = tuple(acc[field] for field in SENT_FIELDS)
+        if all(type(value) in CACHEABLE_TYPES for value in values):
+            rows.append((scope, acc['phone']) + values + (sent_at,))
+        else:
+            stale.append((scope, acc['phone']))
     conn = sqlite3.connect(LOCAL_DB_FILE)
     cursor = conn.cursor()
-    cursor.execute("SELECT campaign_name, scan_date, associated_accounts FROM local_campaigns")
-    rows = cursor.fetchall()
+    create_sent_state_table(cursor)
+    cursor.executemany("DELETE FROM sent_state WHERE scope = ? AND phone = ?", stale)
+    cursor.executemany(f'''
+        INSERT OR REPLACE INTO sent_state (scope, phone, {', '.join(SENT_FIELDS)}, sent_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', rows)
+    conn.commit()
+    conn.close()
+
+def forget_sent_accounts(scope, phones):
+    """Сбрасывает запомненное состояние номеров: следующая дельта отправит их заново."""
+    conn = sqlite3.connect(LOCAL_DB_FILE)
+    cursor = conn.cursor()
+    create_sent_state_table(cursor)
+    cursor.executemany("DELETE FROM sent_state WHERE scope = ? AND phone = ?", ((scope, phone) for phone in phones))
+    conn.commit()
     conn.close()
-    
-    last_campaign = None
-    max_date = None
-    for row in rows:
-        campaign_name, scan_date, associated_accounts = row
-        accounts = json.loads(associated_accounts)
-        if phone in accounts:
-            date_obj = datetime.strptime(scan_date, "%Y-%m-%d")
-            if max_date is None or date_obj > max_date:
-                max_date = date_obj
-                last_campaign = campaign_name
-    return last_campaign
 
 # ===============================================================
 # ОСНОВНЫЕ ФУНКЦИИ
@@ -98,65 +416,225 @@ def get_account_status(data):
             return "Frozen"
     return "Working"
 
-def read_account_file(filepath, is_dead=False):
-    """Читает JSON-файл аккаунта."""
+def extract_account_fields(data):
+    """Достает из JSON аккаунта поля, нужные для снимков. Статус не считается: он зависит от текущего времени."""
+    registration_date = "N/A"
+    reg_epoch = data.get("register_time")
+    if isinstance(reg_epoch, (int, float)) and reg_epoch > 0:
+        registration_date = datetime.fromtimestamp(int(reg_epoch), timezone.utc).date().isoformat()  # Исправлено
+    else:
+        reg_date_raw = data.get("session_created_date")
+        if isinstance(reg_date_raw, str) and len(reg_date_raw) >= 10:
+            registration_date = reg_date_raw[:10]
+
+    return {
+        "registration_date": registration_date,
+        "spamblock": data.get("spamblock"),
+        "freeze_until": data.get("freeze_until"),
+        "messages_sent": data.get("stats_spam_count", 0),
+        "invites_sent": data.get("stats_invites_count", 0)
+    }
+
+def parse_account_file(filepath):
+    """Читает JSON-файл аккаунта и возвращает поля extract_account_fields (None для нечитаемого файла)."""
     try:
         with open(filepath, 'r', encoding='utf-8') as f:
             data = json.load(f)
-
-        registration_date = "N/A"
-        reg_epoch = data.get("register_time")
-        if isinstance(reg_epoch, (int, float)) and reg_epoch > 0:
-            registration_date = datetime.fromtimestamp(int(reg_epoch), timezone.utc).date().isoformat()  # Исправлено
-        else:
-            reg_date_raw = data.get("session_created_date")
-            if isinstance(reg_date_raw, str) and len(reg_date_raw) >= 10:
-                registration_date = reg_date_raw[:10]
-
-        filename = os.path.basename(filepath)
-        phone = filename.split('.')[0]
-        
-        status = "Banned" if is_dead else get_account_status(data)
-        
-        return {
-            "phone": phone,
-            "registration_date": registration_date,
-            "status": status,
-            "messages_sent": data.get("stats_spam_count", 0),
-            "invites_sent": data.get("stats_invites_count", 0)
-        }
+        return extract_account_fields(data)
     except (json.JSONDecodeError, FileNotFoundError):
         print(f"⚠️ Предупреждение: Не удалось прочитать файл {filepath}. Пропускаем.")
         return None
 
+def build_account_data(filepath, fields, is_dead=False):
+    """Собирает данные аккаунта для сервера. Статус (в т.ч. окончание заморозки) считается на момент вызова."""
+    filename = os.path.basename(filepath)
+    phone = filename.split('.')[0]
+
+    status = "Banned" if is_dead else get_account_status(fields)
+
+    return {
+        "phone": phone,
+        "registration_date": fields["registration_date"],
+        "status": status,
+        "messages_sent": fields["messages_sent"],
+        "invites_sent": fields["invites_sent"]
+    }
+
+def read_account_file(filepath, is_dead=False):
+    """Читает JSON-файл аккаунта."""
+    fields = parse_account_file(filepath)
+    if fields is None:
+        return None
+    return build_account_data(filepath, fields, is_dead=is_dead)
+
 def scan_folder(folder_path, is_dead=False):
     """Сканирует папку и возвращает список данных аккаунтов."""
     if not os.path.isdir(folder_path):
         print(f"❌ Ошибка: Папка '{folder_path}' не найдена.")
         return []
-    
-    accounts_list = []
-    for f in os.listdir(folder_path):
-        if f.endswith('.json'):
-            acc_data = read_account_file(os.path.join(folder_path, f), is_dead=is_dead)
-            if acc_data:
-                accounts_list.append(acc_data)
-    return accounts_list
+
+    with os.scandir(folder_path) as it:
+        jobs = [(entry.path, is_dead) for entry in it if entry.name.endswith('.json')]
+    return [acc_data for acc_data in scan_account_files(jobs) if acc_data]
+
+# ===============================================================
+# ПАРАЛЛЕЛЬНОЕ СКАНИРОВАНИЕ ФАЙЛОВ АККАУНТОВ
+# ===============================================================
+def iter_json_files(folder):
+    """Рекурсивно обходит папку через os.scandir в том же порядке, что и os.walk: сначала файлы папки, затем подпапки."""
+    try:
+        with os.scandir(folder) as it:
+            entries = list(it)
+    except OSError:
+        return
+
+    subfolders = []
+    for entry in entries:
+        try:
+            if entry.is_dir():
+                # Как и os.walk, не заходим в символические ссылки на папки
+                if not entry.is_symlink():
+                    subfolders.append(entry.path)
+                continue
+        except OSError:
+            continue
+        if entry.name.endswith('.json'):
+            yield entry.path
+
+    for subfolder in subfolders:
+        yield from iter_json_files(subfolder)
+
+def _parse_account_files_chunk(paths):
+    return [parse_account_file(filepath) for filepath in paths]
+
+def _parse_account_files(paths, workers, use_processes):
+    """Разбирает файлы аккаунтов, при большом количестве - пулом потоков или процессов."""
+    if workers <= 1 or len(paths) < SCAN_PARALLEL_THRESHOLD:
+        return _parse_account_files_chunk(paths)
+
+    # Файлы раздаются пачками, чтобы накладные расходы пула не съедали выигрыш
+    chunk_size = max(16, min(512, len(paths) // (workers * 8) or 1))
+    chunks = [paths[i:i + chunk_size] for i in range(0, len(paths), chunk_size)]
+    executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with executor_class(max_workers=workers) as executor:
+        return [fields for chunk_results in executor.map(_parse_account_files_chunk, chunks) for fields in chunk_results]
+
+def scan_account_files(jobs, workers=None, use_processes=None, prune_cache=False):
+    """
+    Читает файлы аккаунтов параллельно. jobs - список пар (filepath, is_dead).
+    Возвращает список результатов read_account_file в том же порядке (None для нечитаемых файлов).
+    Неизмененные с прошлого сканирования файлы берутся из кэша разбора (см. PARSE_CACHE_ENABLED).
+    prune_cache=True - jobs покрывают все папки аккаунтов, записи кэша для остальных путей удаляются.
+    """
+    jobs = list(jobs)
+    workers = SCAN_WORKERS if workers is None else workers
+    use_processes = SCAN_USE_PROCESSES if use_processes is None else use_processes
+
+    paths = [filepath for filepath, _ in jobs]
+    if not PARSE_CACHE_ENABLED:
+        parsed = _parse_account_files(paths, workers, use_processes)
+    else:
+        conn = open_parse_cache()
+        try:
+            keys = [os.path.abspath(filepath) for filepath in paths]
+            signatures = [file_signature(filepath) for filepath in paths]
+            parsed = load_cached_fields(conn, keys, signatures)
+
+            misses = [i for i, fields in enumerate(parsed) if fields is None]
+            for i, fields in zip(misses, _parse_account_files([paths[i] for i in misses], workers, use_processes)):
+                parsed[i] = fields
+            store_cached_fields(conn, [(keys[i], signatures[i], parsed[i]) for i in misses])
+            if prune_cache:
+                prune_parse_cache(conn)
+            conn.commit()
+        finally:
+            conn.close()
+        if jobs:
+            print(f"ℹ️ Кэш разбора: {len(jobs) - len(misses)} файлов без изменений, {len(misses)} прочитано заново.")
+
+    return [build_account_data(filepath, fields, is_dead=is_dead) if fields is not None else None
+            for (filepath, is_dead), fields in zip(jobs, parsed)]
+
+# ===============================================================
+# ЗАГРУЗКА СНИМКОВ НА СЕРВЕР
+# ===============================================================
+def upload_snapshot(campaign_name, snapshot_type, accounts_list):
+    """
+    Загружает снимок частями по UPLOAD_CHUNK_SIZE аккаунтов в gzip. Сервер записывает снимок
+    целиком только по запросу complete. При обрыве связи загрузка продолжается с частей,
+    которые сервер еще не подтвердил. Возвращает ответ сервера (на complete или ошибку);
+    requests.exceptions.RequestException - если связь не восстановилась за UPLOAD_RETRIES попыток.
+    """
+    # Снимок перезаписывает строки accounts на сервере: update_all должен отправить эти номера заново
+    forget_sent_accounts(UPDATE_ALL_SCOPE, {acc['phone'] for acc in accounts_list})
+    chunks = [accounts_list[i:i + UPLOAD_CHUNK_SIZE] for i in range(0, len(accounts_list), UPLOAD_CHUNK_SIZE)] or [[]]
+    response = api_request('POST', '/api/uploads', timeout=30, json={
+        "campaign_name": campaign_name, "snapshot_type": snapshot_type, "total_chunks": len(chunks)})
+    if response.status_code != 200:
+        return response
+    upload_id = response.json()['upload_id']
+    upload_path = f"/api/uploads/{upload_id}"
+
+    acknowledged = set()
+    attempt = 0
+    while True:
+        try:
+            for index, chunk in enumerate(chunks):
+                if index in acknowledged:
+                    continue
+                body = gzip.compress(json.dumps(chunk).encode('utf-8'))
+                response = api_request('PUT', f"{upload_path}/chunks/{index}", idempotent=True,
+                                       headers={'Content-Encoding': 'gzip'}, data=body, timeout=30)
+                if response.status_code != 200:
+                    return response
+                acknowledged.add(index)
+                if len(chunks) > 1:
+                    print(f"   Часть {index + 1}/{len(chunks)} принята сервером.")
+            # complete идемпотентен: при повторе сервер вернет уже записанный результат
+            return api_request('POST', f"{upload_path}/complete", idempotent=True, timeout=120)
+        except requests.exceptions.RequestException as exc:
+            attempt += 1
+            if attempt > UPLOAD_RETRIES:
+                raise
+            print(f"⚠️ Обрыв связи при загрузке ({exc}). Повтор {attempt}/{UPLOAD_RETRIES}...")
+            time.sleep(UPLOAD_RETRY_DELAY * attempt)
+            try:
+                status_response = api_request('GET', upload_path, idempotent=True, timeout=30)
+            except requests.exceptions.RequestException:
+                continue
+            if status_response.status_code == 200:
+                status = status_response.json()
+                if status['status'] == 'completed':
+                    # Снимок уже записан, потерялся только ответ: осталось повторить complete
+                    acknowledged = set(range(len(chunks)))
+                else:
+                    acknowledged = set(status['received_chunks'])
+
+def wait_for_job(job_id):
+    """Ждет завершения фонового задания на сервере, показывая прогресс. Возвращает описание задания."""
+    last_progress = None
+    while True:
+        response = api_request('GET', f"/api/jobs/{job_id}", idempotent=True, timeout=30)
+        if response.status_code != 200:
+            return {'status': 'failed', 'error': response.json().get('error', 'Неизвестная ошибка')}
+        job = response.json()
+        if job['status'] in ('done', 'failed'):
+            return job
+        progress = (job['processed_items'], job['queue_position'])
+        if progress != last_progress:
+            waiting = f", заданий перед ним в очереди: {job['queue_position']}" if job['queue_position'] else ""
+            print(f"   Сервер записал {job['processed_items']}/{job['total_items']}{waiting}...")
+            last_progress = progress
+        time.sleep(JOB_POLL_INTERVAL)
 
 def find_and_scan_accounts(campaign_name, snapshot_type):
     """Ищет аккаунты для кампании, включая 'Мертвые после рассылки'."""
     print(f"Ищем аккаунты для кампании '{campaign_name}' по списку из локальной БД...")
-    conn = sqlite3.connect(LOCAL_DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT associated_accounts FROM local_campaigns WHERE campaign_name = ?", (campaign_name,))
-    row = cursor.fetchone()
-    conn.close()
-
-    if not row:
+    phone_numbers = get_campaign_members(campaign_name)
+    if phone_numbers is None:
         print(f"❌ Ошибка: В локальной БД нет информации о кампании '{campaign_name}'.")
         return None
 
-    phone_numbers = set(json.loads(row[0]))
     print(f"   Нужно найти {len(phone_numbers)} аккаунтов из 'ДО'.")
 
     search_paths = [
@@ -168,22 +646,21 @@ def find_and_scan_accounts(campaign_name, snapshot_type):
     accounts_details = []
     new_dead_accounts = []
     seen = set()
-    
+
+    jobs = []
     for path in search_paths:
         if not os.path.isdir(path):
             continue
-        for root, dirs, files in os.walk(path):
-            for file in files:
-                if file.endswith('.json'):
-                    filepath = os.path.join(root, file)
-                    is_dead = is_path_inside_folder(filepath, DEAD_AFTER_CAMPAIGN_FOLDER)
-                    acc_data = read_account_file(filepath, is_dead=is_dead)
-                    if acc_data and acc_data['phone'] not in seen:
-                        seen.add(acc_data['phone'])
-                        if acc_data['phone'] in phone_numbers or is_dead:
-                            accounts_details.append(acc_data)
-                            if is_dead and acc_data['phone'] not in phone_numbers:
-                                new_dead_accounts.append(acc_data)
+        for filepath in iter_json_files(path):
+            jobs.append((filepath, is_path_inside_folder(filepath, DEAD_AFTER_CAMPAIGN_FOLDER)))
+
+    for (filepath, is_dead), acc_data in zip(jobs, scan_account_files(jobs)):
+        if acc_data and acc_data['phone'] not in seen:
+            seen.add(acc_data['phone'])
+            if acc_data['phone'] in phone_numbers or is_dead:
+                accounts_details.append(acc_data)
+                if is_dead and acc_data['phone'] not in phone_numbers:
+                    new_dead_accounts.append(acc_data)
 
     if new_dead_accounts:
         print(f"ℹ️ Найдено {len(new_dead_accounts)} новых мертвых аккаунтов. Добавляем в БД для '{campaign_name}'.")
@@ -211,13 +688,10 @@ def link_accounts_to_campaign():
 
     print(f"Чтение аккаунтов из '{source_folder}'...")
     accounts_map = {}
-    for root, _, files in os.walk(source_folder):
-        for file in files:
-            if file.endswith('.json'):
-                filepath = os.path.join(root, file)
-                acc_data = read_account_file(filepath, is_dead=False)
-                if acc_data:
-                    accounts_map[acc_data['phone']] = (acc_data, filepath)
+    jobs = [(filepath, False) for filepath in iter_json_files(source_folder)]
+    for (filepath, _), acc_data in zip(jobs, scan_account_files(jobs)):
+        if acc_data:
+            accounts_map[acc_data['phone']] = (acc_data, filepath)
 
     if not accounts_map:
         print("❌ Не найдено ни одного JSON-файла аккаунта в указанной папке.")
@@ -257,7 +731,7 @@ def link_accounts_to_campaign():
 
     print("Создание кампании на сервере...")
     try:
-        response = requests.post(f"{SERVER_URL}/api/campaigns", headers=HEADERS, json=campaign_payload, timeout=30)
+        response = api_request('POST', '/api/campaigns', json=campaign_payload, timeout=30)
     except requests.exceptions.RequestException as exc:
         print(f"❌ Ошибка сети при создании кампании: {exc}")
         return
@@ -275,14 +749,8 @@ def link_accounts_to_campaign():
         return
 
     print("Отправка снимка 'ДО'...")
-    snapshot_payload = {
-        "campaign_name": campaign_name,
-        "snapshot_type": "before",
-        "accountsList": accounts_list
-    }
-
     try:
-        snapshot_response = requests.post(f"{SERVER_URL}/api/snapshot", headers=HEADERS, json=snapshot_payload, timeout=30)
+        snapshot_response = upload_snapshot(campaign_name, "before", accounts_list)
     except requests.exceptions.RequestException as exc:
         print(f"❌ Ошибка сети при отправке снимка 'ДО': {exc}")
         return
@@ -334,10 +802,8 @@ def scan_after_immediate():
 
     print(f"Найдено {len(accounts_list)} аккаунтов. Отправка на сервер...")
 
-    payload = {"campaign_name": campaign_name, "snapshot_type": "after_immediate", "accountsList": accounts_list}
-
     try:
-        response = requests.post(f"{SERVER_URL}/api/snapshot", headers=HEADERS, json=payload, timeout=30)
+        response = upload_snapshot(campaign_name, "after_immediate", accounts_list)
         if response.status_code == 200:
             print(f"✅ Успех! Снимок 'ПОСЛЕ' для '{campaign_name}' отправлен.")
             last_campaign_name = campaign_name
@@ -366,10 +832,8 @@ def scan_after_next_day():
         return
 
     print(f"Найдено {len(accounts_list)} аккаунтов. Отправка на сервер...")
-    payload = {"campaign_name": campaign_name, "snapshot_type": "after_day_2", "accountsList": accounts_list}
-
     try:
-        response = requests.post(f"{SERVER_URL}/api/snapshot", headers=HEADERS, json=payload, timeout=30)
+        response = upload_snapshot(campaign_name, "after_day_2", accounts_list)
         if response.status_code == 200:
             print(f"✅ Успех! Снимок 'На следующий день' для рассылки '{campaign_name}' успешно отправлен.")
             last_campaign_name = campaign_name
@@ -378,20 +842,23 @@ def scan_after_next_day():
     except requests.exceptions.RequestException as e:
         print(f"❌ Ошибка сети: {e}")
 
-def update_all_accounts():
-    """Сканирует все аккаунты, включая 'Мертвые', и фиксирует баны в последних кампаниях."""
+def update_all_accounts(full=False):
+    """
+    Сканирует все аккаунты, включая 'Мертвые', и фиксирует баны в последних кампаниях.
+    При DELTA_UPDATES отправляются только изменившиеся аккаунты; full=True - отправить все
+    (например, после восстановления БД сервера из резервной копии).
+    """
     print("\n--- Запуск полного сканирования всех аккаунтов ---")
+    delta = DELTA_UPDATES and not full
     
     search_paths = ['accounts', 'clients']
-    unique_files = set()
+    unique_files = {}
 
     for path in search_paths:
         if not os.path.isdir(path):
             continue
-        for root, dirs, files in os.walk(path):
-            for file in files:
-                if file.endswith('.json'):
-                    unique_files.add(os.path.join(root, file))
+        for filepath in iter_json_files(path):
+            unique_files[filepath] = None
 
     if not unique_files:
         print("Не найдено ни одного .json файла для сканирования.")
@@ -401,9 +868,8 @@ def update_all_accounts():
     
     all_accounts_data = []
     dead_accounts = []
-    for filepath in unique_files:
-        is_dead = is_path_inside_folder(filepath, DEAD_PERMANENT_FOLDER)
-        account_data = read_account_file(filepath, is_dead=is_dead)
+    jobs = [(filepath, is_path_inside_folder(filepath, DEAD_PERMANENT_FOLDER)) for filepath in unique_files]
+    for (_, is_dead), account_data in zip(jobs, scan_account_files(jobs, prune_cache=True)):
         if account_data:
             all_accounts_data.append(account_data)
             if is_dead:
@@ -413,34 +879,102 @@ def update_all_accounts():
         print("Не удалось прочитать данные ни одного аккаунта.")
         return
 
-    print("Отправка данных на сервер для массового обновления...")
-    try:
-        response = requests.post(f"{SERVER_URL}/api/accounts/update_all", headers=HEADERS, json=all_accounts_data, timeout=60)
-        if response.status_code == 200:
-            print(f"✅ Успех! {response.json().get('updated_count', 0)} аккаунтов были обновлены на сервере.")
-        else:
-            print(f"❌ Ошибка сервера ({response.status_code}): {response.json().get('error', 'Неизвестная ошибка')}")
-    except requests.exceptions.RequestException as e:
-        print(f"❌ Ошибка сети: {e}")
+    if delta:
+        accounts_to_send = filter_changed_accounts(UPDATE_ALL_SCOPE, last_per_phone(all_accounts_data))
+        print(f"ℹ️ Изменилось с прошлой отправки: {len(accounts_to_send)} из {len(all_accounts_data)} аккаунтов.")
+    else:
+        accounts_to_send = all_accounts_data
+
+    if accounts_to_send:
+        send_update_all(accounts_to_send)
+    else:
+        print("✅ Изменений нет, отправка на сервер не требуется.")
 
     if dead_accounts:
         print(f"ℹ️ Обработка {len(dead_accounts)} мертвых аккаунтов из '{DEAD_PERMANENT_FOLDER}'.")
+        last_campaigns = get_last_campaigns_for_accounts([acc['phone'] for acc in dead_accounts])
+        by_campaign = {}
         for acc in dead_accounts:
             phone = acc['phone']
-            last_campaign = get_last_campaign_for_account(phone)
+            last_campaign = last_campaigns.get(phone)
             if last_campaign:
-                print(f"   Аккаунт {phone}: Последняя кампания '{last_campaign}'. Отправка status_update.")
-                payload = {"campaign_name": last_campaign, "snapshot_type": "status_update", "accountsList": [acc]}
-                try:
-                    response = requests.post(f"{SERVER_URL}/api/snapshot", headers=HEADERS, json=payload, timeout=30)
-                    if response.status_code == 200:
-                        print(f"     ✅ Фиксация бана для {phone} в '{last_campaign}' успешна.")
-                    else:
-                        print(f"     ❌ Ошибка: {response.json().get('error')}")
-                except requests.exceptions.RequestException as e:
-                    print(f"     ❌ Ошибка сети: {e}")
+                by_campaign.setdefault(last_campaign, []).append(acc)
             else:
                 print(f"   ⚠️ Аккаунт {phone}: Не найдена последняя кампания. Пропускаем фиксацию.")
+        unchanged = 0
+        for campaign_name in list(by_campaign):
+            if delta:
+                accounts = last_per_phone(by_campaign[campaign_name])
+                changed = filter_changed_accounts(status_update_scope(campaign_name), accounts)
+                unchanged += len(accounts) - len(changed)
+                if not changed:
+                    del by_campaign[campaign_name]
+                    continue
+                by_campaign[campaign_name] = changed
+            print(f"   Кампания '{campaign_name}': {len(by_campaign[campaign_name])} акк. для status_update.")
+        if unchanged:
+            print(f"   Бан уже зафиксирован ранее для {unchanged} акк., повторно не отправляются.")
+        send_status_updates(by_campaign)
+
+def send_update_all(accounts_list):
+    """Отправляет аккаунты в /api/accounts/update_all и запоминает их после подтверждения сервера."""
+    print("Отправка данных на сервер для массового обновления...")
+    try:
+        # Повтор безопасен: сервер записывает абсолютные значения счетчиков
+        response = api_request('POST', '/api/accounts/update_all', idempotent=True,
+                               params={'async': 1} if UPDATE_ALL_ASYNC else None,
+                               headers={'Idempotency-Key': uuid.uuid4().hex}, json=accounts_list, timeout=60)
+        result = None
+        if response.status_code == 202:
+            print("   Данные приняты сервером в очередь, ожидаем записи...")
+            job = wait_for_job(response.json()['job_id'])
+            if job['status'] == 'done':
+                result = job['result']
+            else:
+                print(f"❌ Ошибка сервера при записи: {job.get('error', 'Неизвестная ошибка')}")
+        elif response.status_code == 200:
+            result = response.json()
+        else:
+            print(f"❌ Ошибка сервера ({response.status_code}): {response.json().get('error', 'Неизвестная ошибка')}")
+        if result is not None:
+            print(f"✅ Успех! {result.get('updated_count', 0)} аккаунтов были обновлены на сервере "
+                  f"(новых: {result.get('inserted_count', 0)}, изменено: {result.get('changed_count', 0)}, "
+                  f"без изменений: {result.get('unchanged_count', 0)}).")
+            record_sent_accounts(UPDATE_ALL_SCOPE, last_per_phone(accounts_list))
+    except requests.exceptions.RequestException as e:
+        print(f"❌ Ошибка сети: {e}")
+
+def send_status_updates(by_campaign):
+    """
+    Отправляет status_update для мертвых аккаунтов пачками через /api/snapshot/batch (до STATUS_UPDATE_CHUNK_SIZE акк. в запросе).
+    Подтвержденные сервером аккаунты запоминаются в sent_state по кампаниям.
+    """
+    items = [(campaign_name, acc) for campaign_name, accounts in by_campaign.items() for acc in accounts]
+    chunks = []
+    for start in range(0, len(items), STATUS_UPDATE_CHUNK_SIZE):
+        batches = {}
+        for campaign_name, acc in items[start:start + STATUS_UPDATE_CHUNK_SIZE]:
+            batches.setdefault(campaign_name, []).append(acc)
+        chunks.append([{"campaign_name": campaign_name, "accountsList": accounts} for campaign_name, accounts in batches.items()])
+
+    for number, chunk in enumerate(chunks, 1):
+        # С ключом идемпотентности сервер не запишет пачку дважды, поэтому запрос можно повторять
+        payload = {"snapshot_type": "status_update", "batches": chunk, "idempotency_key": uuid.uuid4().hex}
+        try:
+            response = api_request('POST', '/api/snapshot/batch', idempotent=True, json=payload, timeout=60)
+            if response.status_code == 200:
+                result = response.json()
+                print(f"     ✅ Пачка {number}/{len(chunks)}: бан зафиксирован для {result.get('processed_count', 0)} акк.")
+                missing_campaigns = result.get('missing_campaigns', [])
+                for campaign_name in missing_campaigns:
+                    print(f"     ❌ Ошибка: Campaign {campaign_name} not found")
+                for batch in chunk:
+                    if batch['campaign_name'] not in missing_campaigns:
+                        record_sent_accounts(status_update_scope(batch['campaign_name']), batch['accountsList'])
+            else:
+                print(f"     ❌ Ошибка (пачка {number}/{len(chunks)}): {response.json().get('error')}")
+        except requests.exceptions.RequestException as e:
+            print(f"     ❌ Ошибка сети (пачка {number}/{len(chunks)}): {e}")
 
 def main_menu():
     while True:
@@ -451,6 +985,7 @@ def main_menu():
         print("3. Сканирование на следующий день после рассылки")
         print("--- Обслуживание ---")
         print("4. Обновить информацию по ВСЕМ аккаунтам")
+        print("5. Полная отправка ВСЕХ аккаунтов (без учета прошлых отправок)")
         print("---")
         print("0. Выход")
         
@@ -460,6 +995,7 @@ def main_menu():
         elif choice == '2': scan_after_immediate()
         elif choice == '3': scan_after_next_day()
         elif choice == '4': update_all_accounts()
+        elif choice == '5': update_all_accounts(full=True)
         elif choice == '0':
             print("Выход из программы."); break
         else:
@@ -480,5 +1016,6 @@ if __name__ == '__main__':
     if not os.path.isdir(DEAD_PERMANENT_FOLDER):
         os.makedirs(DEAD_PERMANENT_FOLDER)
         print(f"Создана папка '{DEAD_PERMANENT_FOLDER}'.")
+    setup_http_log()
     init_local_db()
     main_menu()
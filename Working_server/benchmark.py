@@ -0,0 +1,121 @@
+"""
+Бенчмарки клиента-анализатора.
+
+Запуск из папки Working_server:
+    python benchmark.py scan --files 20000 --workers 1 4 8 16
+    python benchmark.py rescan --files 20000 --changed 1
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+import analyzer
+
+# ===============================================================
+# ГЕНЕРАЦИЯ ТЕСТОВОГО ДЕРЕВА
+# ===============================================================
+def generate_tree(root, files, rnd, per_folder=500):
+    """Создает дерево accounts/clients с JSON-файлами аккаунтов, похожими на настоящие."""
+    paths = []
+    for i in range(files):
+        folder = os.path.join(root, 'accounts' if i % 3 else 'clients', f"group_{i // per_folder}")
+        os.makedirs(folder, exist_ok=True)
+        phone = f"7{i:010d}"
+        data = {
+            "phone": phone,
+            "register_time": 1700000000 + rnd.randint(0, 10 ** 7),
+            "stats_spam_count": rnd.randint(0, 5000),
+            "stats_invites_count": rnd.randint(0, 300),
+            "spamblock": rnd.choice([None, None, None, 'temporary', 'permanent']),
+            "device": {"model": "SM-G991B", "system": "Android 13", "app_version": "10.3.2"},
+            "proxy": ["socks5", "127.0.0.1", 1080, True, "user", "password"],
+            "session_file": f"{phone}.session",
+            "twoFA": "".join(rnd.choice("abcdef0123456789") for _ in range(32)),
+        }
+        path = os.path.join(folder, f"{phone}.json")
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        paths.append(path)
+    return paths
+
+# ===============================================================
+# СЦЕНАРИИ
+# ===============================================================
+def bench_scan(files, workers_list):
+    """Скорость чтения файлов аккаунтов: последовательно, пулом потоков и пулом процессов."""
+    rnd = random.Random(1)
+    with tempfile.TemporaryDirectory() as root:
+        print(f"Генерация {files} файлов...")
+        generate_tree(root, files, rnd)
+
+        started = time.perf_counter()
+        jobs = [(path, False) for folder in ('accounts', 'clients')
+                for path in analyzer.iter_json_files(os.path.join(root, folder))]
+        print(f"Обход дерева (os.scandir): {len(jobs)} файлов за {time.perf_counter() - started:.3f} с")
+
+        # Здесь меряется само чтение файлов, кэш разбора отключен
+        analyzer.PARSE_CACHE_ENABLED = False
+        print(f"{'режим':<10} | {'потоков':>7} | {'время, с':>9} | {'файлов/с':>10}")
+        for use_processes in (False, True):
+            for workers in workers_list:
+                if use_processes and workers <= 1:
+                    continue
+                started = time.perf_counter()
+                results = analyzer.scan_account_files(jobs, workers=workers, use_processes=use_processes)
+                elapsed = time.perf_counter() - started
+                assert sum(1 for r in results if r) == len(jobs)
+                mode = 'процессы' if use_processes else 'потоки'
+                print(f"{mode:<10} | {workers:>7} | {elapsed:>9.3f} | {len(jobs) / elapsed:>10.0f}")
+
+def bench_rescan(files, changed_percent):
+    """Повторное сканирование с кэшем разбора: холодный кэш, теплый кэш и изменение части файлов."""
+    rnd = random.Random(2)
+    with tempfile.TemporaryDirectory() as root:
+        print(f"Генерация {files} файлов...")
+        paths = generate_tree(root, files, rnd)
+        analyzer.LOCAL_DB_FILE = os.path.join(root, 'client_database.db')
+        analyzer.PARSE_CACHE_ENABLED = True
+        jobs = [(path, False) for folder in ('accounts', 'clients')
+                for path in analyzer.iter_json_files(os.path.join(root, folder))]
+
+        def timed(title):
+            started = time.perf_counter()
+            results = analyzer.scan_account_files(jobs, prune_cache=True)
+            elapsed = time.perf_counter() - started
+            assert sum(1 for r in results if r) == len(jobs)
+            print(f"{title:<36} | {elapsed:>9.3f} с")
+
+        timed("холодный кэш")
+        timed("теплый кэш, без изменений")
+        for path in rnd.sample(paths, max(1, files * changed_percent // 100)):
+            with open(path, 'r+', encoding='utf-8') as f:
+                data = json.load(f)
+                data['stats_spam_count'] += 1
+                f.seek(0)
+                json.dump(data, f)
+                f.truncate()
+        timed(f"изменено {changed_percent}% файлов")
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки анализатора")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    scan = subparsers.add_parser('scan', help="скорость сканирования файлов аккаунтов")
+    scan.add_argument('--files', type=int, default=20000)
+    scan.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8, 16])
+
+    rescan = subparsers.add_parser('rescan', help="повторное сканирование с кэшем разбора")
+    rescan.add_argument('--files', type=int, default=20000)
+    rescan.add_argument('--changed', type=int, default=1, help="процент измененных файлов")
+
+    args = parser.parse_args()
+    if args.command == 'scan':
+        bench_scan(args.files, args.workers)
+    elif args.command == 'rescan':
+        bench_rescan(args.files, args.changed)
+
+if __name__ == '__main__':
+    main()